@@ -0,0 +1,407 @@
+import math
+import time
+from array import array
+
+from bdd import colonnes_matchs
+from evolution_bdd import calculateur_elo
+from historique_scores import HistoriqueScores
+
+
+class PointsControle:
+    """
+    Points de contrôle des scores : tous les `intervalle` matchs, le score de chaque personnage à l'issue de ce match
+    est enregistré sous la forme d'un tableau dense (indice : identifiant du personnage, NaN pour un personnage qui n'a
+    pas encore joué). Pour recalculer les scores à partir d'un match donné, il suffit alors de repartir du point de
+    contrôle précédent au lieu de rejouer tout l'historique.
+    """
+
+    def __init__(self, bdd, intervalle=10000):
+        """
+        Crée la table des points de contrôle si elle n'existe pas déjà.
+
+        :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+        :param intervalle: nombre de matchs entre deux points de contrôle (int)
+        """
+
+        self.bdd = bdd
+        self.intervalle = intervalle
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''CREATE TABLE IF NOT EXISTS points_controle_scores (
+                               id_match INTEGER PRIMARY KEY,
+                               scores   BLOB NOT NULL
+                           )''')
+        self.bdd.connexion.commit()
+
+    def charger(self, id_match):
+        """
+        Renvoie le dernier point de contrôle antérieur au match donné.
+
+        :param id_match: identifiant du match (int)
+        :return: 2-uplet (identifiant du dernier match pris en compte dans le point de contrôle, 0 s'il n'y en a pas
+        (int) ; scores (array de float))
+        """
+
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''SELECT id_match, scores
+                           FROM points_controle_scores
+                           WHERE id_match < ?
+                           ORDER BY id_match DESC
+                           LIMIT 1''', (id_match,))
+        ligne = curseur.fetchone()
+        if ligne is None:
+            return 0, array("d")
+        scores = array("d")
+        scores.frombytes(ligne[1])
+        return ligne[0], scores
+
+    def supprimer_depuis(self, id_match):
+        """
+        Supprime les points de contrôle qui prennent en compte le match donné, devenus faux si ce match est modifié.
+
+        :param id_match: identifiant du match (int)
+        :return: None
+        """
+
+        self.bdd.connexion.execute("DELETE FROM points_controle_scores WHERE id_match >= ?", (id_match,))
+        self.bdd.connexion.commit()
+
+    def mettre_a_jour(self, taille_lot=10000, id_limite=math.inf):
+        """
+        Crée les points de contrôle manquants à partir du dernier existant, en ne lisant que les matchs suivants.
+
+        :param taille_lot: nombre de matchs lus à la fois (int)
+        :param id_limite: identifiant du premier match à ne plus lire (int), par exemple le premier match annulé
+        :return: nombre de points de contrôle créés (int)
+        """
+
+        id_depart, scores = self.charger(math.inf)
+        nb_points = 0
+        nb_matchs_depuis_point = 0
+        for lot in _lots_matchs(self.bdd, id_depart, taille_lot):
+            nouveaux_points = []
+            lot_complet = len(lot)
+            lot = [match for match in lot if match[0] < id_limite]
+            for (id_match, id_gagnant, id_perdant, _, _, nouveau_score_gagnant, nouveau_score_perdant, _) in lot:
+                _agrandir(scores, max(id_gagnant, id_perdant))
+                scores[id_gagnant] = nouveau_score_gagnant
+                scores[id_perdant] = nouveau_score_perdant
+                nb_matchs_depuis_point += 1
+                if nb_matchs_depuis_point == self.intervalle:
+                    nouveaux_points.append((id_match, scores.tobytes()))
+                    nb_matchs_depuis_point = 0
+            self.bdd.connexion.executemany("INSERT INTO points_controle_scores (id_match, scores) VALUES (?, ?)",
+                                           nouveaux_points)
+            self.bdd.connexion.commit()
+            nb_points += len(nouveaux_points)
+            if len(lot) < lot_complet:
+                break
+        return nb_points
+
+
+def _agrandir(scores, id_personnage):
+    """
+    Agrandit si besoin un tableau dense de scores pour qu'il contienne l'indice donné (les nouvelles cases valent NaN).
+
+    :param scores: scores (array de float)
+    :param id_personnage: identifiant du personnage (int)
+    :return: None
+    """
+
+    if id_personnage >= len(scores):
+        scores.extend([math.nan] * (id_personnage + 1 - len(scores)))
+
+
+def _lots_matchs(bdd, id_depart, taille_lot):
+    """
+    Parcourt par lots les matchs postérieurs à un identifiant, archives comprises. Chaque lot est lu par une requête
+    distincte (pagination par identifiant) : les matchs peuvent être modifiés entre deux lots.
+
+    :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param id_depart: identifiant à partir duquel lire les matchs (exclu) (int)
+    :param taille_lot: nombre de matchs par lot (int)
+    :return: générateur de listes de tuples (colonnes de `colonnes_matchs`)
+    """
+
+    while True:
+        curseur = bdd.connexion.execute('''SELECT %s
+                                           FROM %s
+                                           WHERE id > ?
+                                           ORDER BY id
+                                           LIMIT ?''' % (colonnes_matchs, bdd.table_matchs),
+                                        (id_depart, taille_lot))
+        lot = curseur.fetchall()
+        if not lot:
+            return
+        yield lot
+        id_depart = lot[-1][0]
+
+
+def annuler_votes(bdd, ids_matchs, points_controle=None, taille_lot=5000):
+    """
+    Annule des votes frauduleux : les matchs sont déplacés dans la table `matchs_annules` et les scores de tous les
+    matchs suivants sont recalculés comme si ces votes n'avaient jamais eu lieu. Le recalcul repart du dernier point de
+    contrôle antérieur au premier match annulé et ne rejoue que les matchs suivants, sur un tableau dense de scores ;
+    son coût dépend du nombre de matchs rejoués et non de la taille de l'historique.
+
+    Les réécritures sont faites par lots, chacun dans sa propre transaction. Une annulation interrompue peut être
+    relancée avec les mêmes matchs : ceux déjà déplacés sont ignorés et le recalcul reprend depuis le même point de
+    contrôle. Les votes doivent être suspendus pendant l'annulation (application arrêtée), un vote enregistré entre deux
+    lots partant de scores pas encore corrigés.
+
+    :param bdd: objet base de données ouvert en écriture (type BDD du fichier `bdd.py`)
+    :param ids_matchs: identifiants des matchs à annuler (itérable d'int)
+    :param points_controle: points de contrôle à utiliser (type PointsControle), ou None pour ceux par défaut
+    :param taille_lot: nombre de matchs rejoués par transaction (int)
+    :return: dictionnaire (clés : matchs_annules, matchs_rejoues, matchs_reecrits, personnages_modifies ; valeurs :
+    nombres (int))
+    """
+
+    ids_matchs = set(ids_matchs)
+    if points_controle is None:
+        points_controle = PointsControle(bdd)
+    curseur = bdd.connexion.cursor()
+    curseur.execute('''CREATE TABLE IF NOT EXISTS matchs_annules (
+                           id                    INTEGER PRIMARY KEY,
+                           id_gagnant            INTEGER NOT NULL,
+                           id_perdant            INTEGER NOT NULL,
+                           ancien_score_gagnant  REAL NOT NULL,
+                           ancien_score_perdant  REAL NOT NULL,
+                           nouveau_score_gagnant REAL NOT NULL,
+                           nouveau_score_perdant REAL NOT NULL,
+                           date                  REAL,
+                           date_annulation       REAL NOT NULL
+                       )''')
+    bdd.connexion.commit()
+
+    # Seuls les matchs de la base principale peuvent être annulés (les archives ne sont pas modifiées)
+    ids_existants = set()
+    ids_deja_annules = set()
+    liste_ids = sorted(ids_matchs)
+    for debut in range(0, len(liste_ids), 500):
+        morceau = liste_ids[debut:debut + 500]
+        marques = ", ".join("?" * len(morceau))
+        curseur.execute("SELECT id FROM main.matchs WHERE id IN (%s)" % marques, morceau)
+        ids_existants.update(ligne[0] for ligne in curseur)
+        curseur.execute("SELECT id FROM matchs_annules WHERE id IN (%s)" % marques, morceau)
+        ids_deja_annules.update(ligne[0] for ligne in curseur)
+    ids_inconnus = ids_matchs - ids_existants - ids_deja_annules
+    if ids_inconnus:
+        raise ValueError("Matchs introuvables dans la base principale : %s" % sorted(ids_inconnus))
+    resultat = {"matchs_annules": 0, "matchs_rejoues": 0, "matchs_reecrits": 0, "personnages_modifies": 0}
+    if not ids_matchs:
+        return resultat
+
+    premier_id = min(ids_matchs)
+    # Les points de contrôle manquants avant le premier match annulé sont créés pour ne pas rejouer tout l'historique,
+    # et ceux postérieurs sont faux dès la première réécriture
+    points_controle.mettre_a_jour(taille_lot, premier_id)
+    points_controle.supprimer_depuis(premier_id)
+    curseur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'historique_scores_etat'")
+    if curseur.fetchone()[0]:
+        curseur.execute("SELECT type_seau, taille_seau FROM historique_scores_etat")
+        for type_seau, taille_seau in curseur.fetchall():
+            HistoriqueScores(bdd, type_seau, taille_seau).revenir_avant(premier_id)
+
+    id_depart, scores = points_controle.charger(premier_id)
+    ids_modifies = set()
+    for lot in _lots_matchs(bdd, id_depart, taille_lot):
+        a_annuler = []
+        reecritures = []
+        for (id_match, id_gagnant, id_perdant, ancien_score_gagnant, ancien_score_perdant, nouveau_score_gagnant,
+             nouveau_score_perdant, _) in lot:
+            _agrandir(scores, max(id_gagnant, id_perdant))
+            if id_match < premier_id:
+                # Match antérieur au premier match annulé : ses scores sont déjà justes
+                scores[id_gagnant] = nouveau_score_gagnant
+                scores[id_perdant] = nouveau_score_perdant
+                continue
+            if id_match in ids_matchs:
+                # Sans le match annulé, les personnages gardent leur score d'avant ce match : s'il était inconnu (aucun
+                # match depuis le point de contrôle), c'est le score d'avant le match annulé
+                if math.isnan(scores[id_gagnant]):
+                    scores[id_gagnant] = ancien_score_gagnant
+                if math.isnan(scores[id_perdant]):
+                    scores[id_perdant] = ancien_score_perdant
+                ids_modifies.add(id_gagnant)
+                ids_modifies.add(id_perdant)
+                a_annuler.append(id_match)
+                continue
+
+            # Le score d'un personnage qui n'avait pas encore joué ne dépend d'aucun autre match
+            score_gagnant = scores[id_gagnant]
+            if math.isnan(score_gagnant):
+                score_gagnant = ancien_score_gagnant
+            score_perdant = scores[id_perdant]
+            if math.isnan(score_perdant):
+                score_perdant = ancien_score_perdant
+            scores[id_gagnant] = calculateur_elo.nouveau_score_gagnant(score_gagnant, score_perdant)
+            scores[id_perdant] = calculateur_elo.nouveau_score_perdant(score_perdant, score_gagnant)
+            ids_modifies.add(id_gagnant)
+            ids_modifies.add(id_perdant)
+            nouvelles_valeurs = (score_gagnant, score_perdant, scores[id_gagnant], scores[id_perdant])
+            if nouvelles_valeurs != (ancien_score_gagnant, ancien_score_perdant, nouveau_score_gagnant,
+                                     nouveau_score_perdant):
+                reecritures.append(nouvelles_valeurs + (id_match,))
+
+        if a_annuler:
+            marques = ", ".join("?" * len(a_annuler))
+            curseur.execute('''INSERT OR IGNORE INTO matchs_annules (%s, date_annulation)
+                               SELECT %s, ?
+                               FROM main.matchs
+                               WHERE id IN (%s)''' % (colonnes_matchs, colonnes_matchs, marques),
+                            [time.time()] + a_annuler)
+            curseur.execute("DELETE FROM main.matchs WHERE id IN (%s)" % marques, a_annuler)
+        curseur.executemany('''UPDATE main.matchs
+                               SET ancien_score_gagnant = ?, ancien_score_perdant = ?,
+                                   nouveau_score_gagnant = ?, nouveau_score_perdant = ?
+                               WHERE id = ?''', reecritures)
+        bdd.connexion.commit()
+        resultat["matchs_annules"] += len(a_annuler)
+        resultat["matchs_rejoues"] += len(lot)
+        resultat["matchs_reecrits"] += len(reecritures)
+
+    # Scores finaux des personnages ayant joué après le premier match annulé
+    curseur.execute("SELECT id, score FROM personnages")
+    nouveaux_scores = [(scores[id_personnage], id_personnage) for id_personnage, score in curseur.fetchall()
+                       if id_personnage in ids_modifies and scores[id_personnage] != score]
+    for debut in range(0, len(nouveaux_scores), taille_lot):
+        curseur.executemany("UPDATE personnages SET score = ? WHERE id = ?", nouveaux_scores[debut:debut + taille_lot])
+        bdd.connexion.commit()
+    resultat["personnages_modifies"] = len(nouveaux_scores)
+    return resultat
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestAnnulationVotes:
+    @staticmethod
+    def _bdd_test(nb_matchs):
+        """
+        Crée une base de données en mémoire vive avec des matchs joués par `evolution_bdd.appliquer_resultat_match`.
+
+        :param nb_matchs: nombre de matchs (int)
+        :return: objet base de données (type BDD du fichier `bdd.py`)
+        """
+
+        import random
+        from bdd import BDD
+        from evolution_bdd import appliquer_resultat_match
+        bdd = BDD(":memory:")
+        bdd.ajouter_personnages([{"nom": "Personnage %d" % numero, "url_image": "", "acteur": None, "score": 1400}
+                                 for numero in range(20)])
+        generateur = random.Random(4)
+        for _ in range(nb_matchs):
+            id_personnage1, id_personnage2 = generateur.sample(range(1, 21), 2)
+            id_match_en_cours = bdd.ajouter_match_en_cours({"id_personnage1": id_personnage1,
+                                                            "id_personnage2": id_personnage2})
+            appliquer_resultat_match(bdd, id_match_en_cours, generateur.choice((1, 2)))
+        return bdd
+
+    def test_annuler_votes(self):
+        bdd = self._bdd_test(300)
+        points_controle = PointsControle(bdd, intervalle=50)
+        assert points_controle.mettre_a_jour() == 6
+        assert points_controle.mettre_a_jour() == 0
+        historique = HistoriqueScores(bdd, "matchs", 20)
+        historique.rattraper()
+
+        # Référence : les mêmes matchs, sans les votes annulés, rejoués depuis le début
+        ids_annules = {130, 131, 200, 290}
+        matchs_gardes = [match for match in reversed(bdd.matchs()) if match["id"] not in ids_annules]
+        scores_attendus = {id_personnage: 1400 for id_personnage in range(1, 21)}
+        for match in matchs_gardes:
+            score_gagnant = scores_attendus[match["id_gagnant"]]
+            score_perdant = scores_attendus[match["id_perdant"]]
+            scores_attendus[match["id_gagnant"]] = calculateur_elo.nouveau_score_gagnant(score_gagnant, score_perdant)
+            scores_attendus[match["id_perdant"]] = calculateur_elo.nouveau_score_perdant(score_perdant, score_gagnant)
+
+        resultat = annuler_votes(bdd, ids_annules, points_controle, taille_lot=40)
+        assert resultat["matchs_annules"] == 4
+        # Seuls les matchs à partir du point de contrôle précédent (id 100) sont rejoués
+        assert resultat["matchs_rejoues"] == 200
+        for personnage in bdd.personnages():
+            assert math.isclose(personnage["score"], scores_attendus[personnage["id"]])
+        assert len(bdd.matchs()) == 296
+        assert bdd.connexion.execute("SELECT COUNT(*) FROM matchs_annules").fetchone()[0] == 4
+
+        # Les matchs suivants sont cohérents entre eux : chacun part des scores laissés par le précédent
+        derniers_scores = {}
+        for match in reversed(bdd.matchs()):
+            for id_personnage, ancien_score, nouveau_score in (
+                    (match["id_gagnant"], match["ancien_score_gagnant"], match["nouveau_score_gagnant"]),
+                    (match["id_perdant"], match["ancien_score_perdant"], match["nouveau_score_perdant"])):
+                assert derniers_scores.get(id_personnage, 1400) == ancien_score
+                derniers_scores[id_personnage] = nouveau_score
+
+        # Relancer l'annulation ne change rien, l'historique des scores est recalculé à partir du premier match annulé
+        assert annuler_votes(bdd, ids_annules, points_controle)["personnages_modifies"] == 0
+        assert historique.dernier_id_match() == 119
+        historique.rattraper()
+        assert historique.points(1)[-1]["score_dernier"] == bdd.personnage(1)["score"]
+        assert points_controle.mettre_a_jour() == 3
+
+        try:
+            annuler_votes(bdd, [100000], points_controle)
+            assert False
+        except ValueError:
+            pass
+        bdd.fermer()
+
+    def test_annuler_sans_point_de_controle(self):
+        from bdd import BDD
+        from evolution_bdd import appliquer_resultat_match
+        # Le match annulé est le dernier de ses deux personnages, ou le premier d'un personnage qui rejoue ensuite
+        for matchs, id_annule in (([(1, 2), (3, 4), (1, 2)], 3), ([(1, 2), (3, 4), (1, 3)], 1)):
+            bdd = BDD(":memory:")
+            bdd.ajouter_personnages([{"nom": "Personnage %d" % numero, "url_image": "", "acteur": None, "score": 1400}
+                                     for numero in range(4)])
+            for id_gagnant, id_perdant in matchs:
+                id_match_en_cours = bdd.ajouter_match_en_cours({"id_personnage1": id_gagnant,
+                                                                "id_personnage2": id_perdant})
+                appliquer_resultat_match(bdd, id_match_en_cours, 1)
+            scores_attendus = {id_personnage: 1400 for id_personnage in range(1, 5)}
+            for numero, (id_gagnant, id_perdant) in enumerate(matchs, 1):
+                if numero != id_annule:
+                    score_gagnant, score_perdant = scores_attendus[id_gagnant], scores_attendus[id_perdant]
+                    scores_attendus[id_gagnant] = calculateur_elo.nouveau_score_gagnant(score_gagnant, score_perdant)
+                    scores_attendus[id_perdant] = calculateur_elo.nouveau_score_perdant(score_perdant, score_gagnant)
+
+            # Aucun point de contrôle n'existe avant l'annulation
+            points_controle = PointsControle(bdd, intervalle=1)
+            resultat = annuler_votes(bdd, [id_annule], points_controle)
+            assert resultat["matchs_annules"] == 1 and resultat["personnages_modifies"] >= 2
+            for personnage in bdd.personnages():
+                assert math.isclose(personnage["score"], scores_attendus[personnage["id"]])
+            # Les points de contrôle manquants avant le match annulé ont été créés : seuls les suivants sont rejoués
+            assert resultat["matchs_rejoues"] == 3 - (id_annule - 1)
+            bdd.fermer()
+
+
+if __name__ == "__main__":
+    import argparse
+    from bdd import BDD
+
+    analyseur = argparse.ArgumentParser(description="Annule des votes frauduleux et recalcule les scores des matchs "
+                                                    "suivants, application arrêtée.")
+    analyseur.add_argument("fichier_bdd", help="fichier de base de données SQLite 3")
+    analyseur.add_argument("ids_matchs", nargs="*", type=int, help="identifiants des matchs à annuler")
+    analyseur.add_argument("--entree-standard", action="store_true",
+                           help="annule aussi les matchs dont l'identifiant est lu, un par ligne, sur l'entrée "
+                                "standard")
+    analyseur.add_argument("--intervalle", type=int, default=10000,
+                           help="nombre de matchs entre deux points de contrôle")
+    analyseur.add_argument("--taille-lot", type=int, default=5000, help="nombre de matchs rejoués par transaction")
+    arguments = analyseur.parse_args()
+
+    bdd = BDD(arguments.fichier_bdd)
+    points_controle = PointsControle(bdd, arguments.intervalle)
+    ids_matchs = list(arguments.ids_matchs)
+    if arguments.entree_standard:
+        import sys
+        ids_matchs.extend(int(ligne) for ligne in sys.stdin if ligne.strip())
+    if ids_matchs:
+        print(annuler_votes(bdd, ids_matchs, points_controle, arguments.taille_lot))
+    print("%d points de contrôle créés" % points_controle.mettre_a_jour())
+    bdd.fermer()
@@ -1,8 +1,29 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+
 import flask
+import jinja2
 
-from bdd import BDD
+import export
+from bdd import BDD, LigneMatch, LignePersonnage, colonnes_matchs
+from cache_personnages import CachePersonnages
+from classement_fenetre import ClassementFenetre
+from compression import Compression
+from detection_fraude import DetecteurFraude
+from diffusion import Diffuseur, calculer_delta
+from ecrivain_votes import ClientEcrivain
+from historique_scores import HistoriqueScores
 from initialisation_bdd import remplir_bdd
+from intervalles_confiance import IntervallesConfiance
+from journal_votes import JournalVotes, TirageInstantanes
+from metadonnees import ClassementsFacettes, MetadonneesPersonnages, facettes
+from ressources import RessourcesStatiques
+from sauvegarde import ServiceSauvegarde
 from evolution_bdd import appliquer_resultat_match, creer_nouveau_match_en_cours
+from graphe_personnages import GrapheRelations
 
 
 # Valeur initiale du score pour les nouveaux personnages
@@ -10,47 +31,815 @@ score_initial = 1400
 # Lors du remplissage initial de la BDD, nombre d'apparitions minimum pour que le personnage soit ajouté
 # (en nombre d'épisodes)
 nb_apparences_min = 60
+# Classements sur des fenêtres de temps glissantes : nom dans l'URL -> (titre, durée, durée d'un seau) en secondes
+fenetres_classement = {
+    "24h": ("dernières 24 heures", 24 * 3600, 3600),
+    "7j":  ("7 derniers jours", 7 * 24 * 3600, 6 * 3600)
+}
+# Durée d'un seau de l'historique des scores, en secondes
+duree_seau_historique = 3600
+# Dossier des archives de matchs (voir `archivage.py`), lues en plus de la base principale
+dossier_archives = "archives"
+# Dossier du cache des gabarits Jinja compilés, partagé par les processus web et conservé entre deux démarrages
+dossier_cache_gabarits = "cache_gabarits"
+# Gabarits compilés dès la création de l'application
+gabarits = ["layout.html.jinja2", "match.html.jinja2", "classement.html.jinja2", "classement_fenetre.html.jinja2",
+            "classement_facettes.html.jinja2", "classement_voisinage.html.jinja2"]
+# Taille minimale des morceaux envoyés lors du rendu d'une page en flux, en caractères
+taille_morceaux_flux = 16 * 1024
+# Ressources statiques servies minifiées, compressées et avec empreinte (voir `ressources.py`)
+ressources_statiques = ["css/style.css", "js/classement.js"]
+# Taille minimale d'une réponse pour qu'elle soit compressée, en octets
+seuil_compression = 1024
+# Dossier des sauvegardes à chaud de la base de données (voir `sauvegarde.py`), ou None pour ne pas en faire
+dossier_sauvegardes = None
+# Durée entre deux sauvegardes, en secondes, et nombre de sauvegardes gardées
+intervalle_sauvegardes = 3600
+nb_sauvegardes = 24
+# Réplique en lecture seule publiée à chaque sauvegarde et lue par les longues lectures (exports), ou None
+replique_lecture = None
+# Dossier partagé des journaux de votes quand l'application tourne sur plusieurs machines avec un classement global
+# (voir `journal_votes.py`), ou None pour une seule machine
+dossier_journaux = None
+# Nom de cette machine dans les journaux, et durée entre deux lectures du classement global, en secondes
+nom_noeud = socket.gethostname()
+intervalle_tirage_classement = 2.0
+# Si vrai, les votes automatisés sont mis en quarantaine au lieu d'être pris en compte (voir `detection_fraude.py`).
+# Désactivé par défaut : la limite de votes par adresse IP bloquerait une classe entière derrière un même NAT
+detection_fraude = False
+# Choix du second personnage d'un match : "aleatoire", ou "rival" pour l'un des proches du premier (voir
+# `graphe_personnages.py`)
+mode_matchs = "aleatoire"
+# Dossier des fichiers du graphe des relations entre personnages
+dossier_graphe = "graphe"
+
+
+class ServicesApplication:
+    """
+    Regroupe la base de données et les structures calculées à partir d'elle (cache des personnages, classements sur
+    fenêtre glissante, historique des scores), ainsi que le diffuseur des changements du classement aux pages ouvertes.
+
+    La base de données n'est ouverte qu'à sa première utilisation, et son remplissage initial (qui peut nécessiter un
+    téléchargement) ainsi que le préchargement des caches se font dans un fil d'exécution en arrière-plan : le
+    démarrage d'un processus ne dépend ni de la taille des données ni du réseau. Les pages ne sont servies qu'une fois
+    l'initialisation terminée (voir `pret`).
+
+    Quand l'application tourne dans plusieurs processus, chaque processus ouvre la base de données en lecture seule et
+    confie les écritures (votes et nouveaux matchs) à un processus écrivain unique (voir `ecrivain_votes.py`) ; les
+    structures calculées sont alors mises à jour à partir des nouveaux matchs écrits par l'écrivain (voir
+    `synchroniser`).
+    """
+
+    def __init__(self, chemin_fichier_bdd, adresse_ecrivain=None, cle_authentification=None):
+        """
+        Prépare les services sans ouvrir la base de données.
+
+        :param chemin_fichier_bdd: chemin du fichier de base de données (str)
+        :param adresse_ecrivain: adresse du processus écrivain (voir ServeurEcrivain), ou None si ce processus écrit
+        lui-même dans la base de données
+        :param cle_authentification: clé partagée avec le processus écrivain (bytes ou None)
+        """
+
+        self.chemin_fichier_bdd = chemin_fichier_bdd
+        self.ecrivain = None
+        if adresse_ecrivain is not None:
+            self.ecrivain = ClientEcrivain(adresse_ecrivain, cle_authentification)
+        # Événement déclenché quand l'initialisation est terminée et que les pages peuvent être servies
+        self.pret = threading.Event()
+        # Exception levée pendant l'initialisation, le cas échéant
+        self.erreur_initialisation = None
+        self.cache_personnages = None
+        self.classements_fenetres = {}
+        self.historique_scores = None
+        # Classements filtrés par maison, culture, allégeance, genre ou personnages vivants
+        self.classements_facettes = None
+        # Intervalles de confiance des scores et des rangs, calculés à part (voir `intervalles_confiance.py`)
+        self.intervalles_confiance = None
+        # Graphe des relations entre personnages, pour les matchs entre rivaux et le classement du voisinage
+        self.graphe = None
+        # Détecteur des votes automatisés, dans le processus qui écrit dans la base de données
+        self.detecteur_fraude = None
+        # Journal des votes de ce nœud, quand le classement est global à plusieurs machines
+        self.journal_votes = None
+        # Sauvegardes à chaud, faites par le processus qui écrit dans la base de données
+        self.sauvegardes = None
+        # Diffuse les changements du classement après chaque vote (voir `/classement/flux`)
+        self.diffuseur = Diffuseur()
+        # Réponses de l'API du classement déjà sérialisées, pour une version du cache des personnages : 2-uplet (version,
+        # dictionnaire (champs, filtres) -> (corps, ETag)). Le 2-uplet est remplacé d'un bloc à chaque nouvelle version,
+        # jamais vidé sur place : une requête d'un autre fil d'exécution ne voit que des réponses de sa propre version
+        self.reponses_classement = (None, {})
+        self._bdd = None
+        self._verrou_bdd = threading.Lock()
+        self._verrou_graphe = threading.Lock()
+        # Sérialise les écritures faites par ce processus
+        self._verrou_ecriture = threading.Lock()
+        # Dernier état de la base de données pris en compte par `synchroniser`
+        self._verrou_synchronisation = threading.Lock()
+        self._version_donnees = None
+        self._dernier_id_match = 0
+
+    @property
+    def bdd(self):
+        """
+        Objet base de données, ouvert à la première utilisation. Ses archives sont réattachées quand les fichiers
+        d'archive changent (voir BDD.rafraichir_archives).
+
+        :return: objet base de données (type BDD du fichier `bdd.py`)
+        """
+
+        with self._verrou_bdd:
+            if self._bdd is None:
+                self._bdd = BDD(self.chemin_fichier_bdd, lecture_seule=self.ecrivain is not None)
+                self._bdd.attacher_archives(dossier_archives)
+                self._bdd.chemin_replique = replique_lecture
+            else:
+                # Archives créées ou fusionnées par `archivage.py` pendant que l'application tourne
+                self._bdd.rafraichir_archives()
+            return self._bdd
+
+    def graphe_relations(self):
+        """
+        Renvoie le graphe des relations entre personnages, chargé à la première utilisation s'il ne l'a pas été à
+        l'initialisation (hors mode rival).
+
+        :return: graphe (type GrapheRelations du fichier `graphe_personnages.py`)
+        """
+
+        with self._verrou_graphe:
+            if self.graphe is None:
+                self.graphe = GrapheRelations.charger(self.bdd, dossier_graphe)
+            return self.graphe
+
+    def initialiser(self):
+        """
+        Remplit la base de données si elle est vide, charge les classements sur fenêtre glissante, rattrape
+        l'historique des scores et précharge le cache des personnages, puis signale que l'application est prête.
+
+        :return: None
+        """
+
+        try:
+            if self.ecrivain is not None:
+                # Le processus écrivain remplit la base de données avant d'accepter des connexions
+                self.ecrivain.connecter()
+            bdd = self.bdd
+            if self.ecrivain is None:
+                remplir_bdd(bdd, score_initial, nb_apparences_min)
+            self._version_donnees = bdd.version_donnees()
+            self._dernier_id_match = bdd.connexion.execute("SELECT MAX(id) FROM %s" %
+                                                           bdd.table_matchs).fetchone()[0] or 0
+
+            classements_fenetres = {}
+            for nom_fenetre, (_, duree_fenetre, duree_seau) in fenetres_classement.items():
+                classements_fenetres[nom_fenetre] = ClassementFenetre(duree_fenetre, duree_seau)
+                classements_fenetres[nom_fenetre].charger(bdd)
+            historique_scores = HistoriqueScores(bdd, "temps", duree_seau_historique)
+            if self.ecrivain is None:
+                historique_scores.rattraper()
+            cache_personnages = CachePersonnages(bdd)
+            cache_personnages.personnages()
+            classements_facettes = ClassementsFacettes(cache_personnages, MetadonneesPersonnages(bdd))
+            # Le graphe ne sert aux matchs qu'en mode rival ; sinon, il n'est chargé qu'à la première page de voisinage
+            graphe = GrapheRelations.charger(bdd, dossier_graphe) if mode_matchs == "rival" else None
+            intervalles_confiance = IntervallesConfiance(bdd)
+            if self.ecrivain is None and detection_fraude:
+                self.detecteur_fraude = DetecteurFraude(bdd)
+            if self.ecrivain is None and dossier_journaux is not None:
+                self.journal_votes = JournalVotes(dossier_journaux, nom_noeud)
+                TirageInstantanes(bdd, dossier_journaux, apres_tirage=cache_personnages.invalider,
+                                  verrou=self._verrou_ecriture).demarrer(intervalle_tirage_classement)
+            if self.ecrivain is None and dossier_sauvegardes is not None and bdd.chemin_fichier_bdd != ":memory:":
+                self.sauvegardes = ServiceSauvegarde(bdd.chemin_fichier_bdd, dossier_sauvegardes, nb_sauvegardes,
+                                                     chemin_replique=replique_lecture)
+                self.sauvegardes.demarrer(intervalle_sauvegardes)
+
+            self.classements_fenetres = classements_fenetres
+            self.historique_scores = historique_scores
+            self.cache_personnages = cache_personnages
+            self.classements_facettes = classements_facettes
+            self.graphe = graphe
+            self.intervalles_confiance = intervalles_confiance
+            self.pret.set()
+        except Exception as erreur:
+            self.erreur_initialisation = erreur
+            raise
+
+    def demarrer_initialisation(self):
+        """
+        Lance l'initialisation (voir `initialiser`) dans un fil d'exécution en arrière-plan.
+
+        :return: fil d'exécution lancé (threading.Thread)
+        """
+
+        fil = threading.Thread(target=self.initialiser, name="initialisation-bdd", daemon=True)
+        fil.start()
+        return fil
+
+    def _relever_classement(self):
+        """
+        Relève le classement avant un vote, pour que _diffuser_changements calcule ce qui a changé. Sans abonné, rien
+        n'est relevé : après chaque vote le cache des personnages est invalidé, et le relever le rechargerait entièrement
+        à chaque vote suivant. Un abonné arrivé pendant le vote ne reçoit les changements qu'à partir du vote suivant.
+
+        :return: classement actuel (liste renvoyée par CachePersonnages.personnages), ou None s'il n'y a aucun abonné
+        """
+
+        if self.diffuseur.nb_abonnes() == 0:
+            return None
+        return self.cache_personnages.personnages()
+
+    def _diffuser_changements(self, ancien_classement, matchs):
+        """
+        Envoie aux abonnés du diffuseur les changements du classement causés par de nouveaux matchs. Le cache des
+        personnages doit avoir été invalidé ; rien n'est calculé s'il n'y a aucun abonné.
+
+        :param ancien_classement: classement avant les matchs (liste renvoyée par CachePersonnages.personnages), ou
+        None s'il n'a pas été relevé faute d'abonnés (voir _relever_classement)
+        :param matchs: nouveaux matchs (liste de dictionnaires, voir `diffusion.calculer_delta`)
+        :return: None
+        """
+
+        if matchs and ancien_classement is not None and self.diffuseur.nb_abonnes() > 0:
+            self.diffuseur.publier("match", calculer_delta(ancien_classement, self.cache_personnages.personnages(),
+                                                           matchs))
+
+    def voter(self, id_match_en_cours, choix, client=None):
+        """
+        Enregistre le vote d'un utilisateur (voir `evolution_bdd.appliquer_resultat_match`), met à jour les
+        structures calculées et diffuse les changements du classement. Les votes jugés automatisés sont mis en
+        quarantaine (voir `detection_fraude.py`).
+
+        :param id_match_en_cours: identifiant du match en cours (int)
+        :param choix: choix fait par l'utilisateur (int, 1 ou 2)
+        :param client: identifiant du client qui a voté, par exemple son adresse IP (str ou None)
+        :return: dictionnaire du match enregistré, ou None si le vote est incorrect ou mis en quarantaine
+        """
+
+        if self.ecrivain is not None:
+            infos_match = self.ecrivain.appliquer_resultat_match(id_match_en_cours, choix, client)
+            self.synchroniser()
+            return infos_match
+
+        with self._verrou_ecriture:
+            ancien_classement = self._relever_classement()
+            if self.detecteur_fraude is not None:
+                infos_match = self.detecteur_fraude.appliquer_resultat_match(id_match_en_cours, choix, client)
+            else:
+                infos_match = appliquer_resultat_match(self.bdd, id_match_en_cours, choix)
+            if infos_match is not None:
+                for classement_fenetre in self.classements_fenetres.values():
+                    classement_fenetre.enregistrer_vote(infos_match["id_gagnant"], infos_match["id_perdant"],
+                                                        infos_match["date"])
+                self._dernier_id_match = infos_match["id"]
+                if self.journal_votes is not None:
+                    self.journal_votes.ajouter(infos_match["id_gagnant"], infos_match["id_perdant"],
+                                               infos_match["date"])
+                self.historique_scores.rattraper()
+                self.cache_personnages.invalider()
+                self._diffuser_changements(ancien_classement, [infos_match])
+        return infos_match
 
+    def nouveau_match(self):
+        """
+        Crée un nouveau match en cours (voir `evolution_bdd.creer_nouveau_match_en_cours`).
 
-# Configuration de l'application
-app = flask.Flask(__name__)
-bdd = BDD("bdd.db")
-remplir_bdd(bdd, score_initial, nb_apparences_min)
+        :return: 3-uplet (id_nouveau_match_en_cours, personnage1, personnage2)
+        """
+
+        if self.ecrivain is not None:
+            return self.ecrivain.creer_nouveau_match_en_cours()
+        with self._verrou_ecriture:
+            return creer_nouveau_match_en_cours(self.bdd, self.graphe if mode_matchs == "rival" else None)
+
+    def synchroniser(self):
+        """
+        Prend en compte les matchs enregistrés par le processus écrivain depuis le dernier appel et diffuse les
+        changements du classement. La vérification ne coûte qu'une lecture de `BDD.version_donnees` quand la base de
+        données n'a pas changé.
+
+        :return: None
+        """
+
+        if self.ecrivain is None:
+            return
+        with self._verrou_synchronisation:
+            bdd = self.bdd
+            version_donnees = bdd.version_donnees()
+            if version_donnees == self._version_donnees:
+                return
+            self._version_donnees = version_donnees
+
+            ancien_classement = self._relever_classement()
+            curseur = bdd.connexion.execute('''SELECT %s
+                                               FROM %s
+                                               WHERE id > ?
+                                               ORDER BY id''' % (colonnes_matchs, bdd.table_matchs),
+                                            (self._dernier_id_match,))
+            champs = [description[0] for description in curseur.description]
+            matchs = [dict(zip(champs, ligne)) for ligne in curseur]
+            for match in matchs:
+                for classement_fenetre in self.classements_fenetres.values():
+                    classement_fenetre.enregistrer_vote(match["id_gagnant"], match["id_perdant"], match["date"])
+                self._dernier_id_match = match["id"]
+            self.cache_personnages.invalider()
+            self._diffuser_changements(ancien_classement, matchs)
+
+
+def services():
+    """
+    Renvoie les services de l'application Flask en cours.
+
+    :return: objet ServicesApplication
+    """
+
+    return flask.current_app.extensions["services"]
+
+
+def url_ressource(chemin):
+    """
+    Renvoie l'URL d'une ressource statique préparée (voir `ressources.py`), qui change avec son contenu.
+
+    :param chemin: chemin du fichier, relatif au dossier static (str, par exemple "css/style.css")
+    :return: URL (str)
+    """
+
+    return flask.url_for("ressource", nom=flask.current_app.extensions["ressources"].nom(chemin))
 
 
 # Points d'entrée
+pages = flask.Blueprint("pages", __name__)
+
+
+# Tant que l'initialisation n'est pas terminée, les pages répondent que le service est indisponible
+@pages.before_request
+def verifier_pret():
+    if services().erreur_initialisation is not None:
+        return flask.Response("Erreur lors de l'initialisation de la base de données.", status=500)
+    if not services().pret.is_set():
+        return flask.Response("Démarrage en cours, réessayez dans quelques instants.", status=503,
+                              headers={"Retry-After": "5"})
+    services().synchroniser()
+    return None
+
 
 # Page principale de match
-@app.route('/')
-@app.route('/vote/<int:id_match_en_cours>/<int:choix>/')
+@pages.route('/')
+@pages.route('/vote/<int:id_match_en_cours>/<int:choix>/')
 def match(id_match_en_cours=None, choix=None):
     if id_match_en_cours is not None:
         assert choix is not None
-        appliquer_resultat_match(bdd, id_match_en_cours, choix)
+        services().voter(id_match_en_cours, choix, flask.request.remote_addr)
 
-    id_nouveau_match_en_cours, personnage1, personnage2 = creer_nouveau_match_en_cours(bdd)
+    id_nouveau_match_en_cours, personnage1, personnage2 = services().nouveau_match()
 
     return flask.Response(flask.render_template(
         "match.html.jinja2",
-        chemin_css=flask.url_for("static", filename="css/style.css"),
+        chemin_css=url_ressource("css/style.css"),
         id_match_en_cours=id_nouveau_match_en_cours,
         personnage1=personnage1,
         personnage2=personnage2
     ))
 
 
-# Page de classement
-@app.route('/classement/')
+def regrouper_morceaux(morceaux, taille_min):
+    """
+    Regroupe les petits morceaux produits par le rendu en flux d'un gabarit (un par balise ou presque) pour ne pas
+    envoyer une multitude de très petits paquets.
+
+    :param morceaux: itérable de chaînes de caractères
+    :param taille_min: taille minimale d'un morceau regroupé, en caractères (int)
+    :return: générateur de chaînes de caractères
+    """
+
+    tampon = []
+    taille = 0
+    for morceau in morceaux:
+        tampon.append(morceau)
+        taille += len(morceau)
+        if taille >= taille_min:
+            yield "".join(tampon)
+            tampon = []
+            taille = 0
+    if tampon:
+        yield "".join(tampon)
+
+
+# Page de classement, envoyée au fur et à mesure de son rendu : le haut de la page part avant que l'historique des
+# matchs, lu depuis la base de données pendant le rendu, soit entièrement parcouru
+@pages.route('/classement/')
 def classement():
-    infos_personnages = bdd.personnages()
-    infos_matchs = bdd.matchs()
-    return flask.Response(flask.render_template(
+    infos_personnages = services().cache_personnages.personnages()
+    infos_matchs = services().bdd.parcourir_matchs(connexion_dediee=True)
+    return flask.Response(regrouper_morceaux(flask.stream_template(
         "classement.html.jinja2",
-        chemin_css=flask.url_for("static", filename="css/style.css"),
+        chemin_css=url_ressource("css/style.css"),
         infos_personnages=infos_personnages,
-        infos_matchs=infos_matchs
+        infos_matchs=infos_matchs,
+        intervalles_confiance=services().intervalles_confiance.intervalles(),
+        fenetres_classement=fenetres_classement,
+        chemin_js=url_ressource("js/classement.js")
+    ), taille_morceaux_flux))
+
+
+# Flux des changements du classement (server-sent events), utilisé par la page de classement pour se mettre à jour
+# sans être rechargée. Chaque client garde une connexion ouverte : le serveur doit traiter les requêtes dans des fils
+# d'exécution (serveur de développement de Flask, ou par exemple `gunicorn --threads`).
+@pages.route('/classement/flux')
+def classement_flux():
+    services_application = services()
+    file_abonne = services_application.diffuseur.abonner()
+    reponse = flask.Response(services_application.diffuseur.flux(file_abonne, services_application.synchroniser),
+                             mimetype="text/event-stream")
+    reponse.headers["Cache-Control"] = "no-cache"
+    # Empêche les serveurs mandataires (nginx) de retenir les événements
+    reponse.headers["X-Accel-Buffering"] = "no"
+    return reponse
+
+
+# Page de classement sur une fenêtre de temps glissante
+@pages.route('/classement/<nom_fenetre>/')
+def classement_fenetre(nom_fenetre):
+    classements_fenetres = services().classements_fenetres
+    if nom_fenetre not in classements_fenetres:
+        flask.abort(404)
+
+    cache_personnages = services().cache_personnages
+    infos_classement = []
+    for ligne in classements_fenetres[nom_fenetre].classement():
+        personnage = cache_personnages.personnage(ligne["id"])
+        if personnage is not None:
+            infos_classement.append(dict(ligne, nom=personnage["nom"], score=personnage["score"]))
+
+    return flask.Response(flask.render_template(
+        "classement_fenetre.html.jinja2",
+        chemin_css=url_ressource("css/style.css"),
+        titre_fenetre=fenetres_classement[nom_fenetre][0],
+        infos_classement=infos_classement,
+        fenetres_classement=fenetres_classement
     ))
 
 
+def filtres_facettes():
+    """
+    Renvoie les filtres de facettes demandés par les paramètres d'URL (par exemple ?maison=House+Stark&vivant=oui).
+    Les valeurs inconnues sont ignorées, pour que les réponses mises en cache par filtre restent en nombre borné.
+
+    :return: dictionnaire facette -> valeur (str -> str)
+    """
+
+    filtres = {facette: flask.request.args[facette] for facette in facettes if flask.request.args.get(facette)}
+    return services().classements_facettes.filtres_connus(filtres) if filtres else filtres
+
+
+# Classement filtré par facettes (maison, culture, allégeance, genre, vivant)
+@pages.route('/classement/facettes/')
+def classement_facettes():
+    classements_facettes = services().classements_facettes
+    filtres = filtres_facettes()
+    return flask.Response(flask.render_template(
+        "classement_facettes.html.jinja2",
+        chemin_css=url_ressource("css/style.css"),
+        facettes=facettes,
+        valeurs_facettes={facette: classements_facettes.valeurs(facette) for facette in facettes},
+        filtres=filtres,
+        infos_personnages=classements_facettes.classement(filtres)
+    ))
+
+
+# Classement d'un personnage et de ses proches (personnages liés dans le graphe des relations)
+@pages.route('/classement/voisinage/<int:id_personnage>/')
+def classement_voisinage(id_personnage):
+    cache_personnages = services().cache_personnages
+    personnage = cache_personnages.personnage(id_personnage)
+    if personnage is None:
+        flask.abort(404)
+
+    ids_voisins, mentions = services().graphe_relations().voisins(id_personnage)
+    voisinage = [(personnage, None)]
+    for id_voisin, nb_mentions in zip(ids_voisins.tolist(), mentions.tolist()):
+        voisin = cache_personnages.personnage(id_voisin)
+        if voisin is not None:
+            voisinage.append((voisin, int(nb_mentions)))
+    voisinage.sort(key=lambda element: element[0]["score"], reverse=True)
+    return flask.Response(flask.render_template(
+        "classement_voisinage.html.jinja2",
+        chemin_css=url_ressource("css/style.css"),
+        personnage=personnage,
+        voisinage=voisinage
+    ))
+
+
+# Historique du score d'un personnage, pour tracer un graphique
+@pages.route('/personnage/<int:id_personnage>/historique.json')
+def historique_personnage(id_personnage):
+    personnage = services().cache_personnages.personnage(id_personnage)
+    if personnage is None:
+        flask.abort(404)
+
+    historique_scores = services().historique_scores
+    nb_points_max = flask.request.args.get("points", 500, type=int)
+    return flask.jsonify({
+        "id":          personnage["id"],
+        "nom":         personnage["nom"],
+        "type_seau":   historique_scores.type_seau,
+        "taille_seau": historique_scores.taille_seau,
+        "points":      historique_scores.points(id_personnage, max(1, nb_points_max))
+    })
+
+
+# Exports complets, envoyés au fur et à mesure de la lecture de la base de données
+def reponse_export(morceaux, type_mime, nom_fichier):
+    """
+    Construit la réponse d'un export en flux, compressée au format gzip si le paramètre d'URL gzip vaut 1.
+
+    :param morceaux: générateur de chaînes de caractères, contenu de l'export
+    :param type_mime: type MIME du contenu (str)
+    :param nom_fichier: nom du fichier proposé au téléchargement (str)
+    :return: réponse Flask
+    """
+
+    if flask.request.args.get("gzip", 0, type=int):
+        morceaux = export.compresser_gzip(morceaux)
+        type_mime = "application/gzip"
+        nom_fichier += ".gz"
+    reponse = flask.Response(morceaux, mimetype=type_mime)
+    reponse.headers["Content-Disposition"] = "attachment; filename=%s" % nom_fichier
+    return reponse
+
+
+@pages.route('/export/matchs.csv')
+def export_matchs_csv():
+    return reponse_export(export.exporter_matchs_csv(services().bdd,
+                                                     flask.request.args.get("id_min", type=int),
+                                                     flask.request.args.get("id_max", type=int)),
+                          "text/csv", "matchs.csv")
+
+
+@pages.route('/export/matchs.jsonl')
+def export_matchs_jsonl():
+    return reponse_export(export.exporter_matchs_jsonl(services().bdd,
+                                                       flask.request.args.get("id_min", type=int),
+                                                       flask.request.args.get("id_max", type=int)),
+                          "application/x-ndjson", "matchs.jsonl")
+
+
+@pages.route('/export/classement.json')
+def export_classement_json():
+    return reponse_export(export.exporter_classement_json(services().bdd), "application/json", "classement.json")
+
+
+# API JSON, pour les clients autres que les navigateurs. Les lignes sont envoyées sous forme de tableaux, les noms des
+# champs n'apparaissant qu'une fois par réponse.
+api = flask.Blueprint("api", __name__, url_prefix="/api")
+api.before_request(verifier_pret)
+
+# Champs des matchs renvoyés par l'API de vote
+champs_match_api = LigneMatch.champs[:8]
+
+
+def reponse_json(donnees, statut=200):
+    """
+    Construit une réponse JSON compacte (sans espaces).
+
+    :param donnees: données sérialisables en JSON
+    :param statut: code de statut HTTP (int)
+    :return: réponse Flask
+    """
+
+    return flask.Response(json.dumps(donnees, ensure_ascii=False, separators=(",", ":")), status=statut,
+                          mimetype="application/json")
+
+
+def champs_demandes(champs_disponibles):
+    """
+    Renvoie les champs demandés par le paramètre d'URL champs (noms séparés par des virgules), ou tous les champs
+    disponibles s'il est absent. Répond 400 si un champ demandé n'existe pas.
+
+    :param champs_disponibles: noms des champs disponibles (tuple de str)
+    :return: noms des champs demandés (tuple de str)
+    """
+
+    parametre = flask.request.args.get("champs")
+    if not parametre:
+        return tuple(champs_disponibles)
+    champs = tuple(parametre.split(","))
+    inconnus = [champ for champ in champs if champ not in champs_disponibles]
+    if inconnus:
+        flask.abort(reponse_json({"erreur": "champs inconnus : %s" % ", ".join(inconnus)}, 400))
+    return champs
+
+
+@api.route('/classement')
+def api_classement():
+    champs = champs_demandes(LignePersonnage.champs)
+    filtres = filtres_facettes()
+    services_application = services()
+    personnages, version = services_application.cache_personnages.personnages_et_version()
+
+    # La réponse n'est sérialisée qu'une fois par version du classement, par sélection de champs et par filtre
+    version_reponses, reponses_classement = services_application.reponses_classement
+    if version_reponses != version:
+        reponses_classement = {}
+        services_application.reponses_classement = (version, reponses_classement)
+    cle = (champs, tuple(sorted(filtres.items())))
+    reponse_serialisee = reponses_classement.get(cle)
+    if reponse_serialisee is None:
+        if filtres:
+            personnages = services_application.classements_facettes.classement(filtres)
+        corps = json.dumps({"champs": champs,
+                            "lignes": [[personnage[champ] for champ in champs] for personnage in personnages]},
+                           ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # L'ETag dépend du contenu et non du numéro de version, propre à chaque processus
+        reponse_serialisee = (corps, hashlib.md5(corps).hexdigest())
+        reponses_classement[cle] = reponse_serialisee
+    corps, etag = reponse_serialisee
+
+    reponse = flask.Response(corps, mimetype="application/json")
+    reponse.set_etag(etag)
+    reponse.headers["Cache-Control"] = "no-cache"
+    return reponse.make_conditional(flask.request)
+
+
+# Nouveau match en cours (équivalent de la page principale)
+@api.route('/match')
+def api_match():
+    champs = champs_demandes(LignePersonnage.champs)
+    id_match_en_cours, personnage1, personnage2 = services().nouveau_match()
+    return reponse_json({"id_match_en_cours": id_match_en_cours,
+                         "champs": champs,
+                         "personnages": [[personnage[champ] for champ in champs]
+                                         for personnage in (personnage1, personnage2)]})
+
+
+# Vote pour un match en cours : paramètres id_match_en_cours et choix (1 ou 2), en JSON ou en formulaire
+@api.route('/vote', methods=["POST"])
+def api_vote():
+    parametres = flask.request.get_json(silent=True) or flask.request.form
+    try:
+        id_match_en_cours = int(parametres["id_match_en_cours"])
+        choix = int(parametres["choix"])
+    except (KeyError, TypeError, ValueError):
+        return reponse_json({"erreur": "paramètres id_match_en_cours et choix attendus"}, 400)
+    if choix not in (1, 2):
+        return reponse_json({"erreur": "choix doit valoir 1 ou 2"}, 400)
+
+    infos_match = services().voter(id_match_en_cours, choix, flask.request.remote_addr)
+    if infos_match is None:
+        return reponse_json({"erreur": "match en cours inconnu ou déjà joué, ou vote refusé"}, 404)
+    return reponse_json({"champs": champs_match_api, "match": [infos_match[champ] for champ in champs_match_api]})
+
+
+def creer_application(chemin_fichier_bdd="bdd.db", initialisation_en_arriere_plan=True, adresse_ecrivain=None):
+    """
+    Crée l'application Flask. L'import de ce fichier ne fait rien d'autre que définir les points d'entrée : la base de
+    données n'est ouverte et initialisée qu'à la création de l'application.
+
+    Exemples de lancement : `python app.py` ou `flask --app "app:creer_application()" run`. Avec plusieurs processus,
+    on lance d'abord le processus écrivain (`python ecrivain_votes.py --adresse ecrivain_votes.sock`) puis les
+    processus web, par exemple `gunicorn -w 4 "app:creer_application(adresse_ecrivain='ecrivain_votes.sock')"`. La
+    clé d'authentification partagée, obligatoire dans ce cas, est lue dans la variable d'environnement
+    CLE_ECRIVAIN_VOTES.
+
+    :param chemin_fichier_bdd: chemin du fichier de base de données (str)
+    :param initialisation_en_arriere_plan: si vrai, l'initialisation se fait en arrière-plan et la fonction rend la
+    main immédiatement ; sinon, la fonction attend la fin de l'initialisation (bool)
+    :param adresse_ecrivain: adresse du processus écrivain, ou None pour que ce processus écrive lui-même dans la base
+    de données (str)
+    :return: application Flask
+    """
+
+    cle = os.environ.get("CLE_ECRIVAIN_VOTES")
+    app = flask.Flask(__name__)
+    # Les gabarits compilés sont gardés sur disque : un nouveau processus n'a pas à les recompiler
+    os.makedirs(dossier_cache_gabarits, exist_ok=True)
+    app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(dossier_cache_gabarits)
+    for nom_gabarit in gabarits:
+        app.jinja_env.get_template(nom_gabarit)
+    app.extensions["services"] = ServicesApplication(chemin_fichier_bdd, adresse_ecrivain,
+                                                     cle.encode("utf-8") if cle else None)
+    app.register_blueprint(pages)
+    app.register_blueprint(api)
+    Compression(seuil_compression).installer(app)
+
+    # Ressources statiques, préparées une fois pour toutes
+    ressources = RessourcesStatiques(app.static_folder)
+    for chemin in ressources_statiques:
+        ressources.ajouter(chemin)
+    app.extensions["ressources"] = ressources
+
+    @app.route('/ressources/<path:nom>')
+    def ressource(nom):
+        reponse = ressources.reponse(nom, flask.request)
+        if reponse is None:
+            flask.abort(404)
+        return reponse
+
+    # Point d'entrée de supervision, toujours disponible : indique si l'application est prête
+    @app.route('/pret')
+    def pret():
+        if app.extensions["services"].pret.is_set():
+            return flask.Response("prêt", status=200)
+        return flask.Response("démarrage en cours", status=503)
+
+    if initialisation_en_arriere_plan:
+        app.extensions["services"].demarrer_initialisation()
+    else:
+        app.extensions["services"].initialiser()
+    return app
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestApplication:
+    def test_api(self):
+        import shutil
+        import app as module_app
+        from initialisation_bdd import simplifier_infos_personnages
+        fichier_bdd_test = "test/test_app.db"
+        dossiers_test = {"dossier_cache_gabarits": "test/test_app_gabarits", "dossier_graphe": "test/test_app_graphe"}
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        configuration = {nom: getattr(module_app, nom) for nom in dossiers_test}
+        for nom, dossier in dossiers_test.items():
+            shutil.rmtree(dossier, ignore_errors=True)
+            setattr(module_app, nom, dossier)
+
+        with open("../API_backup/characters_backup.json", encoding="utf-8") as fichier:
+            infos_personnages = simplifier_infos_personnages(json.load(fichier), nb_apparences_min)
+        bdd = BDD(fichier_bdd_test)
+        bdd.ajouter_personnages([dict(infos, score=score_initial) for infos in infos_personnages])
+        MetadonneesPersonnages(bdd).enregistrer(infos_personnages)
+        bdd.fermer()
+
+        application = creer_application(fichier_bdd_test, initialisation_en_arriere_plan=False)
+        client = application.test_client()
+        try:
+            # Classement : ETag, 304 tant que le classement ne change pas, sélection de champs
+            reponse = client.get("/api/classement")
+            assert reponse.status_code == 200
+            assert len(reponse.get_json()["lignes"]) == len(infos_personnages)
+            etag = reponse.headers["ETag"]
+            assert client.get("/api/classement", headers={"If-None-Match": etag}).status_code == 304
+            reponse = client.get("/api/classement?champs=id,score")
+            assert reponse.get_json()["champs"] == ["id", "score"]
+            assert all(len(ligne) == 2 for ligne in reponse.get_json()["lignes"])
+            assert reponse.headers["ETag"] != etag
+            assert client.get("/api/classement?champs=id,inconnu").status_code == 400
+
+            # Filtres par facette : une valeur inconnue est ignorée et n'ajoute pas de réponse en cache
+            reponse = client.get("/api/classement?vivant=non")
+            assert 0 < len(reponse.get_json()["lignes"]) < len(infos_personnages)
+            nb_reponses = len(application.extensions["services"].reponses_classement[1])
+            for numero in range(5):
+                reponse_inconnue = client.get("/api/classement?vivant=non&maison=Maison+%d" % numero)
+                assert reponse_inconnue.headers["ETag"] == reponse.headers["ETag"]
+            assert len(application.extensions["services"].reponses_classement[1]) == nb_reponses
+
+            # Vote, en JSON puis en formulaire (le match en cours n'existe plus) et avec des paramètres invalides
+            id_match_en_cours = client.get("/api/match?champs=id,nom").get_json()["id_match_en_cours"]
+            reponse = client.post("/api/vote", json={"id_match_en_cours": id_match_en_cours, "choix": 2})
+            assert reponse.status_code == 200
+            match = dict(zip(reponse.get_json()["champs"], reponse.get_json()["match"]))
+            assert match["nouveau_score_gagnant"] > match["ancien_score_gagnant"]
+            assert client.post("/api/vote", data={"id_match_en_cours": id_match_en_cours, "choix": 2}).status_code \
+                == 404
+            assert client.post("/api/vote", json={"id_match_en_cours": id_match_en_cours, "choix": 3}).status_code \
+                == 400
+            assert client.post("/api/vote", json={}).status_code == 400
+
+            # Le vote a changé le classement : l'ancien ETag ne correspond plus
+            reponse = client.get("/api/classement", headers={"If-None-Match": etag})
+            assert reponse.status_code == 200
+            scores = {ligne[0]: ligne[1] for ligne in client.get("/api/classement?champs=id,score").get_json()["lignes"]}
+            assert scores[match["id_gagnant"]] == match["nouveau_score_gagnant"]
+
+            # Sans abonné au flux, un vote ne recharge pas le classement ; avec un abonné, il lui est diffusé
+            services_application = application.extensions["services"]
+            version_cache = services_application.cache_personnages.version
+            for _ in range(2):
+                id_match_en_cours = services_application.nouveau_match()[0]
+                assert services_application.voter(id_match_en_cours, 1) is not None
+            assert services_application.cache_personnages.version == version_cache
+            file_abonne = services_application.diffuseur.abonner()
+            services_application.voter(services_application.nouveau_match()[0], 1)
+            assert not file_abonne.empty()
+            services_application.diffuseur.desabonner(file_abonne)
+
+            # Hors mode rival, le graphe des relations n'est chargé qu'à la première page de voisinage
+            assert services_application.graphe is None
+            assert client.get("/classement/voisinage/%d/" % match["id_gagnant"]).status_code == 200
+            assert services_application.graphe is not None
+        finally:
+            application.extensions["services"].bdd.fermer()
+            for nom, valeur in configuration.items():
+                setattr(module_app, nom, valeur)
+            for dossier in dossiers_test.values():
+                shutil.rmtree(dossier, ignore_errors=True)
+            os.remove(fichier_bdd_test)
+
+
 if __name__ == '__main__':
-    app.run()
+    creer_application().run()
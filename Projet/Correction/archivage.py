@@ -0,0 +1,323 @@
+import glob
+import os
+import sqlite3
+import time
+
+from bdd import colonnes_matchs, nb_archives_max
+
+
+def _periode_sql(format_periode):
+    """
+    Construit l'expression SQL donnant la période d'archivage d'un match à partir de sa date. Les matchs sans date,
+    enregistrés avant l'horodatage des matchs, sont rangés dans la période "sans_date".
+
+    :param format_periode: format de la période, au sens de strftime (str, par exemple "%Y" ou "%Y-%m")
+    :return: expression SQL (str)
+    """
+
+    return "COALESCE(strftime('%s', date, 'unixepoch'), 'sans_date')" % format_periode.replace("'", "''")
+
+
+def fusionner_archives(dossier_archives, nb_max=nb_archives_max):
+    """
+    Fusionne les fichiers d'archive les plus anciens (dans l'ordre des noms de période) en un seul, jusqu'à ce que le
+    dossier n'en contienne plus que nb_max, pour qu'ils puissent tous être attachés à la base (voir
+    BDD.attacher_archives). Le fichier fusionné est nommé d'après la première et la dernière période qu'il couvre (par
+    exemple matchs_2019_a_2022.db).
+
+    Le fichier fusionné est construit sous un nom temporaire, renommé, puis les fichiers fusionnés sont supprimés : les
+    processus qui tournent (voir BDD.rafraichir_archives) lisent l'ancien ensemble de fichiers jusqu'à ce qu'ils
+    réattachent le nouveau, et une fusion interrompue peut simplement être relancée.
+
+    :param dossier_archives: dossier des fichiers d'archive (str)
+    :param nb_max: nombre maximum de fichiers d'archive gardés (int, au moins 1)
+    :return: chemin du fichier fusionné (str), ou None si le dossier contenait déjà au plus nb_max fichiers
+    """
+
+    fichiers_archives = sorted(glob.glob(os.path.join(glob.escape(dossier_archives), "matchs_*.db")))
+    if len(fichiers_archives) <= nb_max:
+        return None
+    a_fusionner = fichiers_archives[:len(fichiers_archives) - max(1, nb_max) + 1]
+
+    def periodes(fichier_archive):
+        return os.path.basename(fichier_archive)[len("matchs_"):-len(".db")].split("_a_")
+
+    chemin_fusion = os.path.join(dossier_archives, "matchs_%s_a_%s.db" % (periodes(a_fusionner[0])[0],
+                                                                        periodes(a_fusionner[-1])[-1]))
+    # Nom temporaire qui ne correspond pas au motif des fichiers d'archive
+    chemin_temporaire = os.path.join(dossier_archives, "fusion-%d.tmp" % os.getpid())
+    connexion = sqlite3.connect(chemin_temporaire)
+    try:
+        source = sqlite3.connect(a_fusionner[0])
+        try:
+            source.backup(connexion)
+        finally:
+            source.close()
+        for fichier_archive in a_fusionner[1:]:
+            connexion.execute("ATTACH DATABASE ? AS fusion", (fichier_archive,))
+            try:
+                connexion.execute("INSERT OR IGNORE INTO main.matchs (%s) SELECT %s FROM fusion.matchs" %
+                                  (colonnes_matchs, colonnes_matchs))
+                connexion.commit()
+            finally:
+                connexion.rollback()
+                connexion.execute("DETACH DATABASE fusion")
+    finally:
+        connexion.close()
+
+    os.replace(chemin_temporaire, chemin_fusion)
+    for fichier_archive in a_fusionner:
+        os.remove(fichier_archive)
+    return chemin_fusion
+
+
+def archiver_matchs(bdd, date_limite, dossier_archives, format_periode="%Y", taille_lot=10000, compacter=False):
+    """
+    Déplace les matchs antérieurs à une date limite de la base principale vers des fichiers d'archive SQLite, un par
+    période (par exemple dossier_archives/matchs_2023.db), puis attache les archives à la base pour que l'historique
+    complet reste lisible de façon transparente (voir BDD.attacher_archives). S'il y a plus de `bdd.nb_archives_max`
+    fichiers d'archive, les plus anciens sont d'abord fusionnés (voir fusionner_archives).
+
+    Le déplacement se fait par lots : chaque lot est copié dans l'archive puis supprimé de la base principale dans une
+    même transaction, un archivage interrompu ne perd donc aucun match. L'archivage peut être lancé pendant que
+    l'application tourne : ses processus réattachent les nouvelles archives dès qu'ils les voient (voir
+    BDD.rafraichir_archives). Le match le plus récent n'est jamais archivé
+    pour que SQLite ne réutilise pas d'identifiants de matchs archivés.
+
+    :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param date_limite: horodatage UNIX, les matchs joués avant cette date sont archivés (float)
+    :param dossier_archives: dossier des fichiers d'archive, créé si besoin (str)
+    :param format_periode: format de la période couverte par chaque fichier d'archive, au sens de strftime (str). Le
+    nombre de fichiers attachés à la base étant limité, mieux vaut des périodes longues : les périodes en trop sont
+    fusionnées.
+    :param taille_lot: nombre de matchs déplacés par transaction (int)
+    :param compacter: si vrai, reconstruit le fichier de la base principale après l'archivage pour qu'il rétrécisse
+    (opération bloquante) ; sinon, l'espace libéré est simplement réutilisé par les nouveaux matchs (bool)
+    :return: dictionnaire (clés : périodes (str), valeurs : nombre de matchs archivés dans la période (int))
+    """
+
+    os.makedirs(dossier_archives, exist_ok=True)
+    connexion = bdd.connexion
+    connexion.commit()
+    periode_sql = _periode_sql(format_periode)
+    condition = "(date IS NULL OR date < ?) AND id < (SELECT MAX(id) FROM main.matchs)"
+
+    curseur = connexion.cursor()
+    curseur.execute("SELECT DISTINCT %s FROM main.matchs WHERE %s" % (periode_sql, condition), (date_limite,))
+    periodes = [ligne[0] for ligne in curseur.fetchall()]
+
+    nb_matchs_archives = {}
+    for periode in periodes:
+        curseur.execute("ATTACH DATABASE ? AS archivage", (os.path.join(dossier_archives, "matchs_%s.db" % periode),))
+        try:
+            curseur.execute('''CREATE TABLE IF NOT EXISTS archivage.matchs (
+                                   id                    INTEGER PRIMARY KEY,
+                                   id_gagnant            INTEGER NOT NULL,
+                                   id_perdant            INTEGER NOT NULL,
+                                   ancien_score_gagnant  REAL NOT NULL,
+                                   ancien_score_perdant  REAL NOT NULL,
+                                   nouveau_score_gagnant REAL NOT NULL,
+                                   nouveau_score_perdant REAL NOT NULL,
+                                   date                  REAL
+                               )''')
+            selection_lot = ("SELECT id FROM main.matchs WHERE %s AND %s = ? ORDER BY id LIMIT ?" %
+                             (condition, periode_sql))
+            nb_matchs_archives[periode] = 0
+            while True:
+                curseur.execute('''INSERT INTO archivage.matchs (%s)
+                                   SELECT %s FROM main.matchs WHERE id IN (%s)''' %
+                                (colonnes_matchs, colonnes_matchs, selection_lot),
+                                (date_limite, periode, taille_lot))
+                nb_lignes = curseur.rowcount
+                if nb_lignes <= 0:
+                    connexion.rollback()
+                    break
+                curseur.execute("DELETE FROM main.matchs WHERE id IN (%s)" % selection_lot,
+                                (date_limite, periode, taille_lot))
+                connexion.commit()
+                nb_matchs_archives[periode] += nb_lignes
+        finally:
+            connexion.rollback()
+            curseur.execute("DETACH DATABASE archivage")
+
+    if compacter:
+        curseur.execute("VACUUM main")
+    fusionner_archives(dossier_archives)
+    bdd.attacher_archives(dossier_archives)
+    return nb_matchs_archives
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestArchivage:
+    def test_archiver_matchs(self):
+        import shutil
+        from bdd import BDD
+        import export
+        fichier_bdd_test = "test/test_archivage.db"
+        dossier_archives_test = "test/test_archivage_archives"
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        shutil.rmtree(dossier_archives_test, ignore_errors=True)
+        bdd = BDD(fichier_bdd_test)
+
+        bdd.ajouter_personnages([{"nom": "A", "url_image": "", "acteur": None, "score": 1400},
+                                 {"nom": "B", "url_image": "", "acteur": None, "score": 1400}])
+        # 2020-01-01, 2020-06-01, 2021-03-01, sans date, 2024-01-01, 2024-01-02
+        dates = [1577836800.0, 1590969600.0, 1614556800.0, None, 1704067200.0, 1704153600.0]
+        for date in dates:
+            bdd.ajouter_match({
+                "id_gagnant": 1,
+                "id_perdant": 2,
+                "ancien_score_gagnant": 1400,
+                "ancien_score_perdant": 1400,
+                "nouveau_score_gagnant": 1416,
+                "nouveau_score_perdant": 1384,
+                "date": date
+            })
+        tous_matchs = bdd.matchs()
+
+        nb_matchs_archives = archiver_matchs(bdd, 1700000000.0, dossier_archives_test, taille_lot=1)
+        assert nb_matchs_archives == {"2020": 2, "2021": 1, "sans_date": 1}
+        assert sorted(os.listdir(dossier_archives_test)) == ["matchs_2020.db", "matchs_2021.db",
+                                                             "matchs_sans_date.db"]
+        assert bdd.connexion.execute("SELECT COUNT(*) FROM main.matchs").fetchone()[0] == 2
+
+        # L'historique complet reste lisible, y compris depuis une connexion de lecture
+        assert bdd.matchs() == tous_matchs
+        assert len(bdd.resultats_matchs_depuis(0)) == 5
+        assert len("".join(export.exporter_matchs_jsonl(bdd)).splitlines()) == 6
+
+        # Un nouvel archivage ne déplace pas le match le plus récent et les nouveaux identifiants restent uniques
+        assert archiver_matchs(bdd, time.time(), dossier_archives_test) == {"2024": 1}
+        assert bdd.ajouter_match(dict(tous_matchs[0], date=None)) == 7
+        assert [match["id"] for match in bdd.matchs()] == [7, 6, 5, 4, 3, 2, 1]
+
+        bdd.fermer()
+        bdd = BDD(fichier_bdd_test)
+        assert len(bdd.matchs()) == 2
+        assert bdd.attacher_archives(dossier_archives_test) == 4
+        assert len(bdd.matchs()) == 7
+
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+        shutil.rmtree(dossier_archives_test)
+
+    def test_nombre_archives_borne(self):
+        import shutil
+        from bdd import BDD
+        fichier_bdd_test = "test/test_archivage_borne.db"
+        dossier_archives_test = "test/test_archivage_borne_archives"
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        shutil.rmtree(dossier_archives_test, ignore_errors=True)
+        bdd = BDD(fichier_bdd_test)
+
+        # Un match par an de 2010 à 2020 : 11 périodes, plus que le nombre d'archives attachables
+        bdd.ajouter_personnages([{"nom": "A", "url_image": "", "acteur": None, "score": 1400},
+                                 {"nom": "B", "url_image": "", "acteur": None, "score": 1400}])
+        for annee in range(2010, 2022):
+            bdd.ajouter_match({"id_gagnant": 1, "id_perdant": 2, "ancien_score_gagnant": 1400,
+                               "ancien_score_perdant": 1400, "nouveau_score_gagnant": 1416,
+                               "nouveau_score_perdant": 1384,
+                               "date": time.mktime((annee, 6, 1, 0, 0, 0, 0, 0, -1))})
+        tous_matchs = bdd.matchs()
+
+        assert len(archiver_matchs(bdd, time.time(), dossier_archives_test)) == 11
+        fichiers_archives = sorted(os.listdir(dossier_archives_test))
+        assert len(fichiers_archives) == nb_archives_max
+        assert fichiers_archives[0] == "matchs_2010_a_2012.db"
+        assert bdd.matchs() == tous_matchs
+
+        # Des archives en trop (ici vides) sont refusées avec une erreur explicite, puis fusionnées
+        for annee in (2000, 2001):
+            chemin_archive = os.path.join(dossier_archives_test, "matchs_%d.db" % annee)
+            shutil.copyfile(os.path.join(dossier_archives_test, "matchs_2013.db"), chemin_archive)
+            with sqlite3.connect(chemin_archive) as connexion:
+                connexion.execute("DELETE FROM matchs")
+            connexion.close()
+        try:
+            bdd.attacher_archives(dossier_archives_test)
+            assert False
+        except ValueError as erreur:
+            assert "11" in str(erreur)
+        assert fusionner_archives(dossier_archives_test) == os.path.join(dossier_archives_test,
+                                                                         "matchs_2000_a_2012.db")
+        assert fusionner_archives(dossier_archives_test) is None
+        assert bdd.attacher_archives(dossier_archives_test) == nb_archives_max
+        assert bdd.matchs() == tous_matchs
+
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+        shutil.rmtree(dossier_archives_test)
+
+    def test_archiver_pendant_application(self):
+        import shutil
+        from bdd import BDD
+        fichier_bdd_test = "test/test_archivage_application.db"
+        dossier_archives_test = "test/test_archivage_application_archives"
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        shutil.rmtree(dossier_archives_test, ignore_errors=True)
+        bdd = BDD(fichier_bdd_test)
+        bdd.ajouter_personnages([{"nom": "A", "url_image": "", "acteur": None, "score": 1400},
+                                 {"nom": "B", "url_image": "", "acteur": None, "score": 1400}])
+        for annee in range(2010, 2022):
+            bdd.ajouter_match({"id_gagnant": 1, "id_perdant": 2, "ancien_score_gagnant": 1400,
+                               "ancien_score_perdant": 1400, "nouveau_score_gagnant": 1416,
+                               "nouveau_score_perdant": 1384,
+                               "date": time.mktime((annee, 6, 1, 0, 0, 0, 0, 0, -1))})
+        tous_matchs = bdd.matchs()
+
+        # L'application, ouverte avant l'archivage, voit les nouvelles archives puis leur fusion
+        bdd_application = BDD(fichier_bdd_test)
+        assert bdd_application.attacher_archives(dossier_archives_test) == 0
+        archiver_matchs(bdd, time.mktime((2015, 1, 1, 0, 0, 0, 0, 0, -1)), dossier_archives_test)
+        assert len(bdd_application.matchs()) == 7
+        assert bdd_application.rafraichir_archives(intervalle=0)
+        assert not bdd_application.rafraichir_archives(intervalle=0)
+        assert bdd_application.matchs() == tous_matchs
+        archiver_matchs(bdd, time.time(), dossier_archives_test)
+        assert bdd_application.rafraichir_archives(intervalle=0)
+        assert len(os.listdir(dossier_archives_test)) == nb_archives_max
+        assert bdd_application.matchs() == tous_matchs
+        connexion, _ = bdd_application.ouvrir_connexion_lecture()
+        assert connexion.execute("SELECT COUNT(*) FROM matchs_complets").fetchone()[0] == len(tous_matchs)
+        connexion.close()
+
+        bdd_application.fermer()
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+        shutil.rmtree(dossier_archives_test)
+
+
+if __name__ == "__main__":
+    import argparse
+    from bdd import BDD
+
+    analyseur = argparse.ArgumentParser(description="Archive les matchs anciens dans des fichiers SQLite par période.")
+    analyseur.add_argument("fichier_bdd", help="fichier de base de données SQLite 3")
+    analyseur.add_argument("dossier_archives", help="dossier des fichiers d'archive")
+    analyseur.add_argument("--jours", type=float, default=90, help="âge en jours au-delà duquel un match est archivé")
+    analyseur.add_argument("--format-periode", default="%Y",
+                           help="période couverte par chaque fichier d'archive, au sens de strftime (%%Y par défaut)")
+    analyseur.add_argument("--compacter", action="store_true",
+                           help="reconstruit la base principale pour réduire la taille de son fichier")
+    analyseur.add_argument("--fusionner", action="store_true",
+                           help="fusionne seulement les archives en trop pour qu'elles puissent toutes être attachées, "
+                                "sans rien archiver")
+    arguments = analyseur.parse_args()
+
+    if arguments.fusionner:
+        chemin_fusion = fusionner_archives(arguments.dossier_archives)
+        print("Archives fusionnées dans %s" % chemin_fusion if chemin_fusion else "Aucune archive à fusionner")
+        raise SystemExit()
+
+    bdd = BDD(arguments.fichier_bdd)
+    resultat = archiver_matchs(bdd, time.time() - arguments.jours * 24 * 3600, arguments.dossier_archives,
+                               arguments.format_periode, compacter=arguments.compacter)
+    for periode, nb_matchs in sorted(resultat.items()):
+        print("%s : %d matchs archivés" % (periode, nb_matchs))
+    bdd.fermer()
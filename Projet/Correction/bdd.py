@@ -1,4 +1,92 @@
+import glob
+import math
+import os
 import sqlite3
+import time
+import urllib.parse
+
+
+# Colonnes de la table des matchs, dans l'ordre (les archives de matchs ont exactement les mêmes colonnes)
+colonnes_matchs = ("id, id_gagnant, id_perdant, ancien_score_gagnant, ancien_score_perdant, nouveau_score_gagnant, "
+                   "nouveau_score_perdant, date")
+# Nombre maximum de fichiers d'archive attachés : SQLite attache au plus 10 bases à une connexion (limite par défaut
+# SQLITE_MAX_ATTACHED), dont une place reste libre pour l'archivage (voir `archivage.py`)
+nb_archives_max = 9
+
+
+class LigneCompacte(tuple):
+    """
+    Ligne de résultat compacte : un simple tuple (aucun dictionnaire n'est créé par ligne) dont les valeurs sont
+    accessibles par indice, par clé (ligne["nom"]) ou par attribut (ligne.nom). Les gabarits Jinja qui utilisent les
+    dictionnaires renvoyés par BDD fonctionnent donc aussi avec ces lignes.
+
+    Les classes filles définissent la liste de leurs champs dans l'attribut de classe `champs`.
+    """
+
+    __slots__ = ()
+    champs = ()
+    _indices_champs = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._indices_champs = {champ: indice for indice, champ in enumerate(cls.champs)}
+        for indice, champ in enumerate(cls.champs):
+            setattr(cls, champ, property(lambda ligne, indice=indice: tuple.__getitem__(ligne, indice)))
+
+    def __getitem__(self, cle):
+        if isinstance(cle, str):
+            return tuple.__getitem__(self, self._indices_champs[cle])
+        return tuple.__getitem__(self, cle)
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__,
+                           ", ".join("%s=%r" % (champ, valeur) for champ, valeur in zip(self.champs, self)))
+
+    def keys(self):
+        """
+        Renvoie le nom des champs de la ligne, dans l'ordre.
+
+        :return: tuple de chaînes de caractères
+        """
+
+        return self.champs
+
+    def get(self, cle, defaut=None):
+        """
+        Renvoie la valeur d'un champ, ou une valeur par défaut si le champ n'existe pas.
+
+        :param cle: nom du champ (str)
+        :param defaut: valeur renvoyée si le champ n'existe pas
+        :return: valeur du champ
+        """
+
+        indice = self._indices_champs.get(cle)
+        return defaut if indice is None else tuple.__getitem__(self, indice)
+
+    def en_dictionnaire(self):
+        """
+        Convertit la ligne en dictionnaire, identique à celui renvoyé par les méthodes non compactes de BDD.
+
+        :return: dictionnaire (clés : noms des champs)
+        """
+
+        return dict(zip(self.champs, self))
+
+
+class LignePersonnage(LigneCompacte):
+    __slots__ = ()
+    champs = ("id", "nom", "url_image", "acteur", "score")
+
+
+class LigneMatch(LigneCompacte):
+    __slots__ = ()
+    champs = ("id", "id_gagnant", "id_perdant", "ancien_score_gagnant", "ancien_score_perdant", "nouveau_score_gagnant",
+              "nouveau_score_perdant", "date", "nom_gagnant", "nom_perdant")
+
+
+class LigneMatchEnCours(LigneCompacte):
+    __slots__ = ()
+    champs = ("id", "id_personnage1", "id_personnage2")
 
 
 class BDD:
@@ -7,15 +95,34 @@ class BDD:
     liste de matchs, en cours ou terminés.
     """
 
-    def __init__(self, chemin_fichier_bdd):
+    def __init__(self, chemin_fichier_bdd, lecture_seule=False):
         """
         Crée le fichier de base de données au format SQLite 3 s'il n'existe pas déjà et crée les tables nécessaires si
         elles n'existent pas déjà.
 
         :param chemin_fichier_bdd: chemin du fichier de base de données, ou :memory: pour la créer en mémoire vive
-        """
-
+        :param lecture_seule: si vrai, ouvre une base de données existante en lecture seule, sans créer ni modifier les
+        tables (bool)
+        """
+
+        self.chemin_fichier_bdd = chemin_fichier_bdd
+        self.lecture_seule = lecture_seule
+        # Table (ou vue) à lire pour obtenir l'historique complet des matchs, archives comprises (voir
+        # attacher_archives)
+        self.table_matchs = "matchs"
+        self.dossier_archives = None
+        self.fichiers_archives = []
+        self._date_verification_archives = -math.inf
+        # Réplique en lecture seule (voir `sauvegarde.py`) utilisée par les longues lectures, ou None
+        self.chemin_replique = None
+        if lecture_seule:
+            self.connexion = self._connecter_lecture_seule()
+            return
         self.connexion = sqlite3.connect(chemin_fichier_bdd, check_same_thread=False)
+        if chemin_fichier_bdd != ":memory:":
+            # En mode WAL, une longue lecture sur une autre connexion (page de classement envoyée en flux, export) ne
+            # bloque pas les écritures, et inversement
+            self.connexion.execute("PRAGMA journal_mode = WAL")
         curseur = self.connexion.cursor()
         curseur.execute('''CREATE TABLE IF NOT EXISTS personnages (
                                id        INTEGER PRIMARY KEY,
@@ -32,6 +139,7 @@ class BDD:
                                ancien_score_perdant  REAL NOT NULL,
                                nouveau_score_gagnant REAL NOT NULL,
                                nouveau_score_perdant REAL NOT NULL,
+                               date                  REAL,
                                FOREIGN KEY (id_gagnant) 
                                    REFERENCES personnages(id),
                                FOREIGN KEY (id_perdant) 
@@ -46,6 +154,11 @@ class BDD:
                                FOREIGN KEY (id_personnage2) 
                                    REFERENCES personnages(id)
                            )''')
+        # Les bases créées avant l'ajout de l'horodatage des matchs n'ont pas la colonne date : on l'ajoute
+        noms_colonnes = [ligne[1] for ligne in curseur.execute("PRAGMA table_info(matchs)")]
+        if "date" not in noms_colonnes:
+            curseur.execute("ALTER TABLE matchs ADD COLUMN date REAL")
+        curseur.execute("CREATE INDEX IF NOT EXISTS index_matchs_date ON matchs (date)")
         self.connexion.commit()
 
     def ajouter_personnage(self, infos_personnage):
@@ -109,11 +222,12 @@ class BDD:
             "score":     tableau_infos_personnage[4]
         }
 
-    def personnage(self, id_personnage):
+    def personnage(self, id_personnage, compact=False):
         """
         Renvoie les informations d'un personnage en fonction de son ID.
 
         :param id_personnage: identifiant du personnage (int)
+        :param compact: si vrai, renvoie une ligne compacte (LignePersonnage) au lieu d'un dictionnaire (bool)
         :return: dictionnaire (clés : id (int), nom (str), url_image (str), acteur (str), score (float)) si le
         personnage existe, sinon None
         """
@@ -126,22 +240,46 @@ class BDD:
         tableau_infos_personnage = curseur.fetchone()
         if tableau_infos_personnage is None:
             return None
+        if compact:
+            return LignePersonnage(tableau_infos_personnage)
         return self._dictionnaire_infos_personnage(tableau_infos_personnage)
 
-    def personnages(self):
+    def _curseur_personnages(self):
         """
-        Renvoie les informations de tous les personnages triés par ordre décroissant de score.
+        Exécute la requête de lecture de tous les personnages triés par ordre décroissant de score.
 
-        :return: liste de dictionnaires (clés : id (int), nom (str), url_image (str), acteur (str), score (float))
+        :return: curseur SQLite dont chaque ligne est un tuple (id, nom, url_image, acteur, score)
         """
 
         curseur = self.connexion.cursor()
         curseur.execute('''SELECT id, nom, url_image, acteur, score
                            FROM personnages
                            ORDER BY score DESC''')
-        tableaux_infos_personnages = curseur.fetchall()
+        return curseur
+
+    def personnages(self, compact=False):
+        """
+        Renvoie les informations de tous les personnages triés par ordre décroissant de score.
+
+        :param compact: si vrai, renvoie des lignes compactes (LignePersonnage) au lieu de dictionnaires (bool)
+        :return: liste de dictionnaires (clés : id (int), nom (str), url_image (str), acteur (str), score (float))
+        """
+
+        tableaux_infos_personnages = self._curseur_personnages().fetchall()
+        if compact:
+            return list(map(LignePersonnage, tableaux_infos_personnages))
         return list(map(self._dictionnaire_infos_personnage, tableaux_infos_personnages))
 
+    def parcourir_personnages(self):
+        """
+        Parcourt les personnages triés par ordre décroissant de score sans les charger tous en mémoire.
+
+        :return: générateur de lignes compactes (LignePersonnage, champs : id, nom, url_image, acteur, score)
+        """
+
+        for tableau_infos_personnage in self._curseur_personnages():
+            yield LignePersonnage(tableau_infos_personnage)
+
     def changer_score_personnage(self, id_personnage, nouveau_score):
         """
         Change le score d'un personnage en fonction de son ID.
@@ -164,15 +302,19 @@ class BDD:
 
         :param infos_match: dictionnaire contenant les informations du match (clés : id_gagnant (int), id_perdant (int),
         ancien_score_gagnant (float), ancien_score_perdant (float), nouveau_score_gagnant (float),
-        nouveau_score_perdant (float))
+        nouveau_score_perdant (float), date (float, optionnelle : horodatage UNIX du match, l'heure actuelle par
+        défaut))
         :return: identifiant du match ajouté (int)
         """
 
+        if "date" not in infos_match:
+            infos_match = dict(infos_match, date=time.time())
+
         curseur = self.connexion.cursor()
         curseur.execute('''INSERT INTO matchs (id_gagnant, id_perdant, ancien_score_gagnant, ancien_score_perdant,
-                                                    nouveau_score_gagnant, nouveau_score_perdant)
+                                                    nouveau_score_gagnant, nouveau_score_perdant, date)
                            VALUES (:id_gagnant, :id_perdant, :ancien_score_gagnant, :ancien_score_perdant,
-                                   :nouveau_score_gagnant, :nouveau_score_perdant)''', infos_match)
+                                   :nouveau_score_gagnant, :nouveau_score_perdant, :date)''', infos_match)
         nouvel_id = curseur.lastrowid
         self.connexion.commit()
         return nouvel_id
@@ -184,13 +326,13 @@ class BDD:
 
         :param tableau_infos_match: tableau contenant les informations d'un match : [id (int), id_gagnant (int),
         id_perdant (int), ancien_score_gagnant (float), ancien_score_perdant (float), nouveau_score_gagnant (float),
-        nouveau_score_perdant (float), nom_gagnant (str), nom_perdant (str)]
+        nouveau_score_perdant (float), date (float ou None), nom_gagnant (str), nom_perdant (str)]
         :return: dictionnaire (clés : id (int), id_gagnant (int), id_perdant (int), ancien_score_gagnant (float),
-        ancien_score_perdant (float), nouveau_score_gagnant (float), nouveau_score_perdant (float), nom_gagnant (str),
-        nom_perdant (str))
+        ancien_score_perdant (float), nouveau_score_gagnant (float), nouveau_score_perdant (float),
+        date (float ou None), nom_gagnant (str), nom_perdant (str))
         """
 
-        assert len(tableau_infos_match) == 9
+        assert len(tableau_infos_match) == 10
         return {
             "id":                    tableau_infos_match[0],
             "id_gagnant":            tableau_infos_match[1],
@@ -199,32 +341,85 @@ class BDD:
             "ancien_score_perdant":  tableau_infos_match[4],
             "nouveau_score_gagnant": tableau_infos_match[5],
             "nouveau_score_perdant": tableau_infos_match[6],
-            "nom_gagnant":           tableau_infos_match[7],
-            "nom_perdant":           tableau_infos_match[8]
+            "date":                  tableau_infos_match[7],
+            "nom_gagnant":           tableau_infos_match[8],
+            "nom_perdant":           tableau_infos_match[9]
         }
 
-    def matchs(self):
+    def _curseur_matchs(self, connexion=None):
         """
-        Renvoie les informations de tous les matchs avec nom des personnages triés par ordre décroissant d'identifiants.
+        Exécute la requête de lecture de tous les matchs avec nom des personnages triés par ordre décroissant
+        d'identifiants.
 
-        :return: liste de dictionnaires (clés : id (int), id_gagnant (int), id_perdant (int),
-        ancien_score_gagnant (float), ancien_score_perdant (float), nouveau_score_gagnant (float),
-        nouveau_score_perdant (float), nom_gagnant (str), nom_perdant (str))
+        :param connexion: connexion SQLite à utiliser, ou None pour la connexion principale
+        :return: curseur SQLite dont chaque ligne est un tuple (id, id_gagnant, id_perdant, ancien_score_gagnant,
+        ancien_score_perdant, nouveau_score_gagnant, nouveau_score_perdant, date, nom_gagnant, nom_perdant)
         """
 
-        curseur = self.connexion.cursor()
+        curseur = (connexion or self.connexion).cursor()
         curseur.execute('''SELECT matchs.id, matchs.id_gagnant, matchs.id_perdant, matchs.ancien_score_gagnant,
                                   matchs.ancien_score_perdant, matchs.nouveau_score_gagnant,
-                                  matchs.nouveau_score_perdant, p1.nom as nom_gagnant, p2.nom as nom_perdant
-                           FROM matchs
+                                  matchs.nouveau_score_perdant, matchs.date, p1.nom as nom_gagnant,
+                                  p2.nom as nom_perdant
+                           FROM %s AS matchs
                            JOIN personnages as p1
                            ON p1.id = matchs.id_gagnant
                            JOIN personnages as p2
                            ON p2.id = matchs.id_perdant
-                           ORDER BY matchs.id DESC''')
-        tableaux_infos_matchs = curseur.fetchall()
+                           ORDER BY matchs.id DESC''' % self.table_matchs)
+        return curseur
+
+    def matchs(self, compact=False):
+        """
+        Renvoie les informations de tous les matchs avec nom des personnages triés par ordre décroissant d'identifiants.
+
+        :param compact: si vrai, renvoie des lignes compactes (LigneMatch) au lieu de dictionnaires (bool)
+        :return: liste de dictionnaires (clés : id (int), id_gagnant (int), id_perdant (int),
+        ancien_score_gagnant (float), ancien_score_perdant (float), nouveau_score_gagnant (float),
+        nouveau_score_perdant (float), date (float ou None), nom_gagnant (str), nom_perdant (str))
+        """
+
+        tableaux_infos_matchs = self._curseur_matchs().fetchall()
+        if compact:
+            return list(map(LigneMatch, tableaux_infos_matchs))
         return list(map(self._dictionnaire_infos_match, tableaux_infos_matchs))
 
+    def parcourir_matchs(self, connexion_dediee=False):
+        """
+        Parcourt les matchs avec nom des personnages triés par ordre décroissant d'identifiants sans les charger tous en
+        mémoire.
+
+        :param connexion_dediee: si vrai, la lecture se fait sur une connexion de lecture ouverte pour l'occasion (voir
+        ouvrir_connexion_lecture) et fermée à la fin du parcours, ce qui ne bloque pas la connexion principale pendant
+        un long parcours (par exemple l'envoi d'une page en flux) (bool)
+        :return: générateur de lignes compactes (LigneMatch, mêmes champs que les dictionnaires renvoyés par matchs)
+        """
+
+        connexion, a_fermer = self.ouvrir_connexion_lecture() if connexion_dediee else (None, False)
+        try:
+            for tableau_infos_match in self._curseur_matchs(connexion):
+                yield LigneMatch(tableau_infos_match)
+        finally:
+            if a_fermer:
+                connexion.close()
+
+    def resultats_matchs_depuis(self, date_min):
+        """
+        Renvoie le résultat des matchs joués depuis une date donnée, triés par ordre chronologique. Les matchs sans date
+        (antérieurs à l'horodatage des matchs) ne sont pas renvoyés.
+
+        :param date_min: horodatage UNIX à partir duquel les matchs sont renvoyés (float)
+        :return: liste de 3-uplets (date (float), id_gagnant (int), id_perdant (int))
+        """
+
+        curseur = self.connexion.cursor()
+        curseur.execute('''SELECT date, id_gagnant, id_perdant
+                           FROM %s
+                           WHERE date >= ?
+                           ORDER BY date''' % self.table_matchs,
+                        (date_min,))
+        return curseur.fetchall()
+
     def ajouter_match_en_cours(self, infos_match_en_cours):
         """
         Ajoute un match en cours et renvoie son ID.
@@ -258,11 +453,12 @@ class BDD:
             "id_personnage2": tableau_infos_match_en_cours[2]
         }
 
-    def match_en_cours(self, id_match_en_cours):
+    def match_en_cours(self, id_match_en_cours, compact=False):
         """
         Renvoie les informations d'un match en cours en fonction de son ID.
 
         :param id_match_en_cours: identifiant du match en cours (int)
+        :param compact: si vrai, renvoie une ligne compacte (LigneMatchEnCours) au lieu d'un dictionnaire (bool)
         :return: dictionnaire (clés : id (int), id_personnage1 (int), id_personnage2 (int)) si le match en cours existe,
         sinon None
         """
@@ -275,6 +471,8 @@ class BDD:
         tableau_infos_match_en_cours = curseur.fetchone()
         if tableau_infos_match_en_cours is None:
             return None
+        if compact:
+            return LigneMatchEnCours(tableau_infos_match_en_cours)
         return self._dictionnaire_infos_match_en_cours(tableau_infos_match_en_cours)
 
     def supprimer_match_en_cours(self, id_match_en_cours):
@@ -291,6 +489,131 @@ class BDD:
                         (id_match_en_cours,))
         self.connexion.commit()
 
+    def _attacher_archives(self, connexion, uri=False):
+        """
+        Attache les fichiers d'archive des matchs à une connexion et y crée la vue temporaire matchs_complets qui réunit
+        les matchs de la base principale et ceux des archives.
+
+        :param connexion: connexion SQLite
+        :param uri: si vrai, les archives sont attachées en lecture seule (la connexion doit accepter les URI) (bool)
+        :return: None
+        """
+
+        requetes_vue = ["SELECT %s FROM main.matchs" % colonnes_matchs]
+        for numero, fichier_archive in enumerate(self.fichiers_archives):
+            if uri:
+                fichier_archive = "file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(fichier_archive))
+            connexion.execute("ATTACH DATABASE ? AS archive_%d" % numero, (fichier_archive,))
+            requetes_vue.append("SELECT %s FROM archive_%d.matchs" % (colonnes_matchs, numero))
+        connexion.execute("DROP VIEW IF EXISTS temp.matchs_complets")
+        connexion.execute("CREATE TEMP VIEW matchs_complets AS %s" % " UNION ALL ".join(requetes_vue))
+
+    def attacher_archives(self, dossier_archives):
+        """
+        Rend les matchs archivés dans un dossier (voir `archivage.py`) visibles par toutes les lectures de l'historique
+        complet des matchs (matchs, parcourir_matchs, resultats_matchs_depuis, exports...). Un nouvel appel remplace les
+        archives attachées précédemment. Le nombre de fichiers attachés étant limité (`nb_archives_max`), une erreur
+        ValueError est levée s'il y en a davantage : ils doivent d'abord être fusionnés (voir
+        archivage.fusionner_archives).
+
+        :param dossier_archives: dossier contenant les fichiers d'archive matchs_*.db (str)
+        :return: nombre de fichiers d'archive attachés (int)
+        """
+
+        self.dossier_archives = dossier_archives
+        fichiers_archives = sorted(glob.glob(os.path.join(glob.escape(dossier_archives), "matchs_*.db")))
+        if len(fichiers_archives) > nb_archives_max:
+            raise ValueError("Trop de fichiers d'archive dans %s (%d, %d au plus peuvent être attachés) : les "
+                             "fusionner (voir `python archivage.py --help`)" % (dossier_archives, len(fichiers_archives),
+                                                                               nb_archives_max))
+
+        self.connexion.commit()
+        for _, nom_base, _ in self.connexion.execute("PRAGMA database_list").fetchall():
+            if nom_base.startswith("archive_"):
+                self.connexion.execute("DETACH DATABASE %s" % nom_base)
+
+        self.fichiers_archives = fichiers_archives
+        if self.fichiers_archives:
+            self._attacher_archives(self.connexion, uri=self.lecture_seule)
+            self.table_matchs = "matchs_complets"
+        else:
+            self.connexion.execute("DROP VIEW IF EXISTS temp.matchs_complets")
+            self.table_matchs = "matchs"
+        return len(self.fichiers_archives)
+
+    def rafraichir_archives(self, intervalle=1.0):
+        """
+        Réattache les archives si les fichiers du dossier attaché par attacher_archives ont changé, par exemple quand un
+        archivage ou une fusion d'archives (voir `archivage.py`) a été fait par un autre processus pendant que celui-ci
+        tourne. En cas d'échec (archivage en cours, connexion occupée), les archives actuelles sont gardées et le
+        rafraîchissement sera retenté à l'appel suivant.
+
+        :param intervalle: durée minimum entre deux lectures du dossier, en secondes : les appels plus rapprochés ne
+        font rien (float)
+        :return: vrai si les archives ont été réattachées (bool)
+        """
+
+        if self.dossier_archives is None or time.monotonic() < self._date_verification_archives + intervalle:
+            return False
+        self._date_verification_archives = time.monotonic()
+        fichiers_archives = sorted(glob.glob(os.path.join(glob.escape(self.dossier_archives), "matchs_*.db")))
+        if fichiers_archives == self.fichiers_archives:
+            return False
+        try:
+            self.attacher_archives(self.dossier_archives)
+        except ValueError:
+            # Trop d'archives, le temps que l'archivage les fusionne : les archives actuelles restent attachées
+            return False
+        except sqlite3.OperationalError:
+            # Les archives ont pu être en partie détachées : l'appel suivant les réattachera toutes
+            self.fichiers_archives = None
+            return False
+        return True
+
+    def ouvrir_connexion_lecture(self):
+        """
+        Ouvre une nouvelle connexion en lecture seule à la base de données, utile pour les longues lectures (exports)
+        qui ne doivent pas monopoliser la connexion principale. Une base en mémoire vive ne pouvant pas être partagée
+        entre connexions, c'est alors la connexion principale qui est renvoyée. Si une réplique a été indiquée
+        (attribut chemin_replique) et qu'elle existe, c'est elle qui est lue : ses données peuvent dater de la dernière
+        sauvegarde, mais sa lecture ne concurrence jamais les écritures.
+
+        :return: 2-uplet (connexion SQLite, booléen vrai si la connexion a été ouverte par cet appel et doit donc être
+        fermée par l'appelant)
+        """
+
+        if self.chemin_fichier_bdd == ":memory:":
+            return self.connexion, False
+        if self.chemin_replique is not None and os.path.exists(self.chemin_replique):
+            connexion = self._connecter_lecture_seule(self.chemin_replique)
+        else:
+            connexion = self._connecter_lecture_seule()
+        if self.fichiers_archives:
+            self._attacher_archives(connexion, uri=True)
+        return connexion, True
+
+    def _connecter_lecture_seule(self, chemin_fichier=None):
+        """
+        Ouvre une connexion en lecture seule au fichier de base de données.
+
+        :param chemin_fichier: fichier à ouvrir, ou None pour le fichier de base de données (str)
+        :return: connexion SQLite
+        """
+
+        chemin_fichier = chemin_fichier or self.chemin_fichier_bdd
+        return sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(chemin_fichier)),
+                               uri=True, check_same_thread=False)
+
+    def version_donnees(self):
+        """
+        Renvoie un numéro qui change à chaque fois qu'une autre connexion (éventuellement dans un autre processus)
+        modifie la base de données. Les modifications faites par cette instance ne changent pas ce numéro.
+
+        :return: numéro de version des données (int)
+        """
+
+        return self.connexion.execute("PRAGMA data_version").fetchone()[0]
+
     def fermer(self):
         """
         Ferme la connexion au fichier de base de données, l'instance de classe ne peut ensuite plus être utilisée.
@@ -437,6 +760,45 @@ class TestBDD:
         bdd.fermer()
         os.remove(fichier_bdd_test)
 
+    def test_lignes_compactes(self):
+        import os
+        fichier_bdd_test = "test/test_lignes_compactes.db"
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        bdd = BDD(fichier_bdd_test)
+
+        bdd.ajouter_personnages([self.harry, self.hermione, self.ron])
+        bdd.ajouter_match({
+            "id_gagnant": 3,
+            "id_perdant": 2,
+            "ancien_score_gagnant": 1100,
+            "ancien_score_perdant":  1300,
+            "nouveau_score_gagnant": 1150,
+            "nouveau_score_perdant": 1250
+        })
+
+        personnages = bdd.personnages(compact=True)
+        assert [personnage.en_dictionnaire() for personnage in personnages] == bdd.personnages()
+        assert list(bdd.parcourir_personnages()) == personnages
+        hermione = personnages[0]
+        assert hermione["nom"] == hermione.nom == hermione[1] == "Hermione Granger"
+        assert hermione.get("inconnu") is None
+        assert bdd.personnage(2, compact=True) == hermione
+
+        match = next(bdd.parcourir_matchs())
+        assert match.en_dictionnaire() == bdd.matchs()[0]
+        assert match["nom_gagnant"] == match.nom_gagnant == "Ron Weasley"
+        assert bdd.matchs(compact=True) == [match]
+        assert list(bdd.parcourir_matchs(connexion_dediee=True)) == [match]
+
+        id_match_en_cours = bdd.ajouter_match_en_cours({"id_personnage1": 1, "id_personnage2": 3})
+        match_en_cours = bdd.match_en_cours(id_match_en_cours, compact=True)
+        assert match_en_cours.en_dictionnaire() == bdd.match_en_cours(id_match_en_cours)
+        assert match_en_cours.id_personnage2 == 3
+
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+
     def test_changer_score_personnage(self):
         import os
         fichier_bdd_test = "test/test_changer_score_personnage.db"
@@ -488,6 +850,7 @@ class TestBDD:
         assert matchs[0]["nom_gagnant"] == "Hermione Granger"
         assert matchs[0]["nom_perdant"] == "Harry Potter"
         matchs[0].pop("id")
+        matchs[0].pop("date", None)
         matchs[0].pop("nom_gagnant")
         matchs[0].pop("nom_perdant")
         assert matchs[0] == match2
@@ -496,6 +859,7 @@ class TestBDD:
         assert matchs[1]["nom_gagnant"] == "Ron Weasley"
         assert matchs[1]["nom_perdant"] == "Hermione Granger"
         matchs[1].pop("id")
+        matchs[1].pop("date", None)
         matchs[1].pop("nom_gagnant")
         matchs[1].pop("nom_perdant")
         assert matchs[1] == match1
@@ -503,6 +867,82 @@ class TestBDD:
         bdd.fermer()
         os.remove(fichier_bdd_test)
 
+    def test_date_match(self):
+        bdd = BDD(":memory:")
+        bdd.ajouter_personnages([self.harry, self.hermione])
+        date_avant = time.time()
+        bdd.ajouter_match({
+            "id_gagnant": 1,
+            "id_perdant": 2,
+            "ancien_score_gagnant": 1200,
+            "ancien_score_perdant": 1300,
+            "nouveau_score_gagnant": 1250,
+            "nouveau_score_perdant": 1250
+        })
+        assert date_avant <= bdd.matchs()[0]["date"] <= time.time()
+        bdd.fermer()
+
+    def test_resultats_matchs_depuis(self):
+        import os
+        fichier_bdd_test = "test/test_resultats_matchs_depuis.db"
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        bdd = BDD(fichier_bdd_test)
+
+        bdd.ajouter_personnages([self.harry, self.hermione, self.ron])
+        for date, id_gagnant, id_perdant in [(1000.0, 1, 2), (3000.0, 3, 1), (2000.0, 2, 3)]:
+            bdd.ajouter_match({
+                "id_gagnant": id_gagnant,
+                "id_perdant": id_perdant,
+                "ancien_score_gagnant": 1200,
+                "ancien_score_perdant": 1200,
+                "nouveau_score_gagnant": 1216,
+                "nouveau_score_perdant": 1184,
+                "date": date
+            })
+        assert bdd.resultats_matchs_depuis(1500.0) == [(2000.0, 2, 3), (3000.0, 3, 1)]
+        assert len(bdd.resultats_matchs_depuis(0.0)) == 3
+
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+
+    def test_lecture_seule(self):
+        import os
+        fichier_bdd_test = "test/test_lecture_seule.db"
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        bdd = BDD(fichier_bdd_test)
+        bdd.ajouter_personnages([self.harry, self.hermione])
+
+        bdd_lecture = BDD(fichier_bdd_test, lecture_seule=True)
+        assert bdd_lecture.nombre_personnages() == 2
+        version = bdd_lecture.version_donnees()
+        bdd.changer_score_personnage(1, 1250)
+        assert bdd_lecture.version_donnees() != version
+        assert bdd_lecture.personnage(1)["score"] == 1250
+
+        try:
+            bdd_lecture.changer_score_personnage(1, 800)
+            assert False, "une base en lecture seule ne doit pas pouvoir être modifiée"
+        except sqlite3.OperationalError:
+            pass
+
+        # Une longue lecture sur une connexion dédiée, interrompue entre deux lignes, ne bloque pas les écritures
+        for _ in range(10):
+            bdd.ajouter_match({"id_gagnant": 1, "id_perdant": 2, "ancien_score_gagnant": 1200,
+                               "ancien_score_perdant": 1200, "nouveau_score_gagnant": 1216,
+                               "nouveau_score_perdant": 1184})
+        bdd.connexion.execute("PRAGMA busy_timeout = 100")
+        parcours = bdd.parcourir_matchs(connexion_dediee=True)
+        next(parcours)
+        bdd.changer_score_personnage(2, 1300)
+        parcours.close()
+        assert bdd.personnage(2)["score"] == 1300
+
+        bdd_lecture.fermer()
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+
     def test_match_en_cours(self):
         if not self.avec_matchs_en_cours:
             return
@@ -0,0 +1,116 @@
+import threading
+
+
+class CachePersonnages:
+    """
+    Classe gardant en mémoire le classement des personnages pour éviter de relire la table des personnages à chaque
+    affichage. Le cache est invalidé après chaque vote et rechargé à la lecture suivante.
+    """
+
+    def __init__(self, bdd):
+        """
+        Initialise un cache vide, chargé à la première lecture.
+
+        :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+        """
+
+        self.bdd = bdd
+        # Numéro de version du contenu du cache, augmenté à chaque rechargement
+        self.version = 0
+        self._personnages = None
+        self._personnages_par_id = None
+        self._verrou = threading.Lock()
+
+    def _charger(self):
+        """
+        Recharge le cache s'il a été invalidé et renvoie son contenu. Le contenu renvoyé n'est jamais modifié : un
+        rechargement crée de nouvelles structures, ce qui permet de continuer à lire l'ancien contenu sans verrou.
+
+        :return: 3-uplet (liste des personnages triés par score décroissant, dictionnaire id -> personnage, version)
+        """
+
+        with self._verrou:
+            if self._personnages is None:
+                personnages = self.bdd.personnages(compact=True)
+                self._personnages_par_id = {personnage.id: personnage for personnage in personnages}
+                self._personnages = personnages
+                self.version += 1
+            return self._personnages, self._personnages_par_id, self.version
+
+    def personnages(self):
+        """
+        Renvoie les informations de tous les personnages triés par ordre décroissant de score.
+
+        :return: liste de lignes compactes (LignePersonnage du fichier `bdd.py`), à ne pas modifier
+        """
+
+        return self._charger()[0]
+
+    def personnages_et_version(self):
+        """
+        Renvoie les informations de tous les personnages triés par ordre décroissant de score, avec le numéro de version
+        correspondant du contenu du cache (pour associer à coup sûr un contenu calculé à partir du classement à sa
+        version).
+
+        :return: 2-uplet (liste de lignes compactes à ne pas modifier, version (int))
+        """
+
+        personnages, _, version = self._charger()
+        return personnages, version
+
+    def personnage(self, id_personnage):
+        """
+        Renvoie les informations d'un personnage en fonction de son ID.
+
+        :param id_personnage: identifiant du personnage (int)
+        :return: ligne compacte (LignePersonnage du fichier `bdd.py`) si le personnage existe, sinon None
+        """
+
+        return self._charger()[1].get(id_personnage)
+
+    def invalider(self):
+        """
+        Signale que les personnages ont changé dans la base de données : le cache sera rechargé à la lecture suivante.
+
+        :return: None
+        """
+
+        with self._verrou:
+            self._personnages = None
+            self._personnages_par_id = None
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestCachePersonnages:
+    def test_cache(self):
+        from bdd import BDD
+        bdd = BDD(":memory:")
+        bdd.ajouter_personnages([{"nom": "A", "url_image": "", "acteur": None, "score": 1400},
+                                 {"nom": "B", "url_image": "", "acteur": None, "score": 1500}])
+
+        cache = CachePersonnages(bdd)
+        assert [personnage.nom for personnage in cache.personnages()] == ["B", "A"]
+        assert cache.personnage(1).score == 1400
+        assert cache.personnage(3) is None
+        version = cache.version
+
+        # Sans invalidation, le cache ne voit pas les changements
+        bdd.changer_score_personnage(1, 1600)
+        assert cache.personnage(1).score == 1400
+        assert cache.version == version
+
+        cache.invalider()
+        assert [personnage.nom for personnage in cache.personnages()] == ["A", "B"]
+        assert cache.version == version + 1
+        assert cache.personnages_et_version() == (cache.personnages(), version + 1)
+
+        bdd.fermer()
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["cache_personnages.py"])
@@ -0,0 +1,215 @@
+import collections
+import threading
+import time
+
+
+class ClassementFenetre:
+    """
+    Classe calculant un classement des personnages sur une fenêtre de temps glissante (par exemple les dernières 24
+    heures) à partir du résultat des votes.
+
+    Les votes sont rangés dans des seaux de durée fixe. Quand un seau sort de la fenêtre, ses compteurs sont soustraits
+    des totaux : on n'a donc jamais besoin de relire la table des matchs après le chargement initial. La fenêtre
+    réellement couverte est précise à la durée d'un seau près.
+    """
+
+    def __init__(self, duree, duree_seau):
+        """
+        Initialise un classement vide sur une fenêtre glissante.
+
+        :param duree: durée de la fenêtre en secondes (float)
+        :param duree_seau: durée de chaque seau en secondes, doit diviser la durée de la fenêtre (float)
+        """
+
+        assert duree_seau > 0 and duree >= duree_seau
+        self.duree = duree
+        self.duree_seau = duree_seau
+        self.nb_seaux = int(round(duree / duree_seau))
+
+        # File des seaux encore dans la fenêtre, du plus ancien au plus récent : [indice_seau, {id: [victoires,
+        # défaites]}]
+        self._seaux = collections.deque()
+        # Totaux sur l'ensemble des seaux de la fenêtre : {id: [victoires, défaites]}
+        self._totaux = {}
+        self._indice_seau_actuel = None
+        self._verrou = threading.Lock()
+
+    def _indice_seau(self, date):
+        """
+        Calcule l'indice du seau auquel appartient une date.
+
+        :param date: horodatage UNIX (float)
+        :return: indice du seau (int)
+        """
+
+        return int(date // self.duree_seau)
+
+    def _expirer(self, indice_seau_actuel):
+        """
+        Fait avancer la fenêtre jusqu'au seau donné en retirant des totaux les seaux qui en sortent.
+
+        :param indice_seau_actuel: indice du seau le plus récent de la fenêtre (int)
+        :return: None
+        """
+
+        if self._indice_seau_actuel is None or indice_seau_actuel > self._indice_seau_actuel:
+            self._indice_seau_actuel = indice_seau_actuel
+        indice_min = self._indice_seau_actuel - self.nb_seaux + 1
+
+        while self._seaux and self._seaux[0][0] < indice_min:
+            _, compteurs_seau = self._seaux.popleft()
+            for id_personnage, (victoires, defaites) in compteurs_seau.items():
+                total = self._totaux[id_personnage]
+                total[0] -= victoires
+                total[1] -= defaites
+                if total[0] == 0 and total[1] == 0:
+                    del self._totaux[id_personnage]
+
+    def _compteurs_seau(self, indice_seau):
+        """
+        Renvoie les compteurs du seau d'indice donné, en le créant si besoin. Les votes arrivent presque toujours dans
+        le seau le plus récent, la recherche part donc de la fin de la file.
+
+        :param indice_seau: indice du seau, dans la fenêtre (int)
+        :return: dictionnaire des compteurs du seau ({id: [victoires, défaites]})
+        """
+
+        position = len(self._seaux)
+        while position > 0 and self._seaux[position - 1][0] > indice_seau:
+            position -= 1
+        if position > 0 and self._seaux[position - 1][0] == indice_seau:
+            return self._seaux[position - 1][1]
+        compteurs_seau = {}
+        self._seaux.insert(position, [indice_seau, compteurs_seau])
+        return compteurs_seau
+
+    def enregistrer_vote(self, id_gagnant, id_perdant, date=None):
+        """
+        Prend en compte le résultat d'un vote. Les votes déjà sortis de la fenêtre sont ignorés.
+
+        :param id_gagnant: identifiant du personnage gagnant (int)
+        :param id_perdant: identifiant du personnage perdant (int)
+        :param date: horodatage UNIX du vote (float, l'heure actuelle par défaut)
+        :return: None
+        """
+
+        if date is None:
+            date = time.time()
+        indice_seau = self._indice_seau(date)
+
+        with self._verrou:
+            self._expirer(indice_seau)
+            if indice_seau <= self._indice_seau_actuel - self.nb_seaux:
+                return
+            compteurs_seau = self._compteurs_seau(indice_seau)
+            for id_personnage, colonne in ((id_gagnant, 0), (id_perdant, 1)):
+                compteurs_seau.setdefault(id_personnage, [0, 0])[colonne] += 1
+                self._totaux.setdefault(id_personnage, [0, 0])[colonne] += 1
+
+    def charger(self, bdd, date=None):
+        """
+        Remplit la fenêtre à partir des matchs déjà enregistrés dans la base de données.
+
+        :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+        :param date: horodatage UNIX de la fin de la fenêtre (float, l'heure actuelle par défaut)
+        :return: None
+        """
+
+        if date is None:
+            date = time.time()
+        date_min = (self._indice_seau(date) - self.nb_seaux + 1) * self.duree_seau
+        for date_match, id_gagnant, id_perdant in bdd.resultats_matchs_depuis(date_min):
+            self.enregistrer_vote(id_gagnant, id_perdant, date_match)
+
+    def classement(self, date=None):
+        """
+        Renvoie le classement des personnages ayant participé à au moins un match dans la fenêtre, triés par ordre
+        décroissant de solde (victoires moins défaites) puis de nombre de victoires.
+
+        :param date: horodatage UNIX de la fin de la fenêtre (float, l'heure actuelle par défaut)
+        :return: liste de dictionnaires (clés : id (int), victoires (int), defaites (int))
+        """
+
+        if date is None:
+            date = time.time()
+
+        with self._verrou:
+            self._expirer(self._indice_seau(date))
+            lignes = [
+                {"id": id_personnage, "victoires": victoires, "defaites": defaites}
+                for id_personnage, (victoires, defaites) in self._totaux.items()
+            ]
+
+        lignes.sort(key=lambda ligne: (ligne["victoires"] - ligne["defaites"], ligne["victoires"]), reverse=True)
+        return lignes
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestClassementFenetre:
+    def test_classement(self):
+        fenetre = ClassementFenetre(100, 10)
+        fenetre.enregistrer_vote(1, 2, 1000)
+        fenetre.enregistrer_vote(1, 3, 1005)
+        fenetre.enregistrer_vote(3, 2, 1012)
+
+        lignes = fenetre.classement(1015)
+        assert [ligne["id"] for ligne in lignes] == [1, 3, 2]
+        assert lignes[0] == {"id": 1, "victoires": 2, "defaites": 0}
+        assert lignes[2] == {"id": 2, "victoires": 0, "defaites": 2}
+
+    def test_expiration(self):
+        fenetre = ClassementFenetre(100, 10)
+        fenetre.enregistrer_vote(1, 2, 1000)
+        fenetre.enregistrer_vote(2, 3, 1050)
+
+        # Le seau du premier vote (1000 à 1009) sort de la fenêtre à partir du seau 1100
+        assert len(fenetre.classement(1099)) == 3
+        assert fenetre.classement(1100) == [{"id": 2, "victoires": 1, "defaites": 0},
+                                            {"id": 3, "victoires": 0, "defaites": 1}]
+        assert fenetre.classement(1200) == []
+
+        # Un vote trop ancien pour la fenêtre est ignoré, un vote en retard mais dans la fenêtre est compté
+        fenetre.enregistrer_vote(1, 2, 1000)
+        assert fenetre.classement(1200) == []
+        fenetre.enregistrer_vote(3, 1, 1150)
+        fenetre.enregistrer_vote(3, 2, 1195)
+        assert fenetre.classement(1200)[0] == {"id": 3, "victoires": 2, "defaites": 0}
+
+    def test_charger(self):
+        import os
+        from bdd import BDD
+        fichier_bdd_test = "test/test_classement_fenetre_charger.db"
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        bdd = BDD(fichier_bdd_test)
+
+        for nom in ("A", "B", "C"):
+            bdd.ajouter_personnage({"nom": nom, "url_image": "", "acteur": None, "score": 1400})
+        for date, id_gagnant, id_perdant in [(500.0, 3, 1), (1000.0, 1, 2), (1050.0, 1, 3)]:
+            bdd.ajouter_match({
+                "id_gagnant": id_gagnant,
+                "id_perdant": id_perdant,
+                "ancien_score_gagnant": 1400,
+                "ancien_score_perdant": 1400,
+                "nouveau_score_gagnant": 1416,
+                "nouveau_score_perdant": 1384,
+                "date": date
+            })
+
+        fenetre = ClassementFenetre(100, 10)
+        fenetre.charger(bdd, 1060)
+        assert fenetre.classement(1060) == [{"id": 1, "victoires": 2, "defaites": 0},
+                                            {"id": 2, "victoires": 0, "defaites": 1},
+                                            {"id": 3, "victoires": 0, "defaites": 1}]
+
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["classement_fenetre.py"])
@@ -0,0 +1,246 @@
+import collections
+import gzip
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # Le format brotli est facultatif : sans le module, les réponses sont compressées au format gzip
+    brotli = None
+
+
+# Types MIME des réponses qui gagnent à être compressées
+types_compressibles = {"text/html", "text/css", "text/plain", "text/csv", "application/json", "application/javascript",
+                       "text/javascript", "application/x-ndjson", "image/svg+xml"}
+# Niveaux de compression par défaut, adaptés à une compression à chaque requête
+niveaux_defaut = {"gzip": 6, "br": 5}
+
+
+def encodages_disponibles():
+    """
+    Renvoie les formats de compression disponibles, par ordre de préférence.
+
+    :return: liste de noms de formats, tels qu'utilisés dans l'en-tête Content-Encoding (list de str)
+    """
+
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def choisir_encodage(accept_encodings):
+    """
+    Choisit le format de compression d'une réponse en fonction de l'en-tête Accept-Encoding de la requête.
+
+    :param accept_encodings: formats acceptés par le client (flask.request.accept_encodings)
+    :return: nom du format (str), ou None si le client n'accepte aucun format disponible
+    """
+
+    for encodage in encodages_disponibles():
+        if accept_encodings[encodage] > 0:
+            return encodage
+    return None
+
+
+def compresser(donnees, encodage, niveau=None):
+    """
+    Compresse des données en une fois.
+
+    :param donnees: données à compresser (bytes)
+    :param encodage: format de compression ("gzip" ou "br")
+    :param niveau: niveau de compression (int, de 1 à 9 pour gzip, de 0 à 11 pour brotli), ou None pour le niveau
+    par défaut
+    :return: données compressées (bytes)
+    """
+
+    niveau = niveaux_defaut[encodage] if niveau is None else niveau
+    if encodage == "br":
+        return brotli.compress(donnees, quality=niveau)
+    return gzip.compress(donnees, compresslevel=niveau, mtime=0)
+
+
+def compresser_flux(morceaux, encodage, niveau=None, jeu_caracteres="utf-8"):
+    """
+    Compresse une réponse envoyée en flux. Chaque morceau compressé est envoyé dès que le morceau d'origine est produit,
+    pour que le client puisse afficher le début de la page sans attendre la fin.
+
+    :param morceaux: itérable de chaînes de caractères ou de bytes ; il est fermé à la fin du parcours s'il a une
+    méthode close
+    :param encodage: format de compression ("gzip" ou "br")
+    :param niveau: niveau de compression, ou None pour le niveau par défaut
+    :param jeu_caracteres: encodage des chaînes de caractères (str)
+    :return: générateur de bytes
+    """
+
+    niveau = niveaux_defaut[encodage] if niveau is None else niveau
+    if encodage == "br":
+        compresseur = brotli.Compressor(quality=niveau)
+        compresser_morceau = lambda morceau: compresseur.process(morceau) + compresseur.flush()
+        terminer = compresseur.finish
+    else:
+        # wbits = 31 : format gzip (en-tête et somme de contrôle) plutôt que zlib
+        compresseur = zlib.compressobj(niveau, zlib.DEFLATED, 31)
+        compresser_morceau = lambda morceau: compresseur.compress(morceau) + compresseur.flush(zlib.Z_SYNC_FLUSH)
+        terminer = compresseur.flush
+
+    try:
+        for morceau in morceaux:
+            if isinstance(morceau, str):
+                morceau = morceau.encode(jeu_caracteres)
+            donnees = compresser_morceau(morceau)
+            if donnees:
+                yield donnees
+        yield terminer()
+    finally:
+        if hasattr(morceaux, "close"):
+            morceaux.close()
+
+
+class Compression:
+    """
+    Compression des réponses d'une application Flask, au format brotli si le module brotli est installé et que le
+    client l'accepte, au format gzip sinon. Seules les réponses d'un type compressible et assez grandes sont
+    compressées ; les réponses envoyées en flux sont compressées au fil de l'eau (sauf les flux d'événements, qui
+    doivent arriver sans délai).
+
+    Les réponses munies d'un ETag (par exemple celles de l'API du classement) ont le même contenu tant que leur ETag ne
+    change pas : leur version compressée est gardée en mémoire et resservie sans être recalculée.
+    """
+
+    def __init__(self, seuil=1024, niveau=None, taille_cache=256):
+        """
+        Prépare la compression.
+
+        :param seuil: taille minimale d'une réponse pour qu'elle soit compressée, en octets (int)
+        :param niveau: niveau de compression, ou None pour le niveau par défaut de chaque format
+        :param taille_cache: nombre maximal de réponses compressées gardées en mémoire (int)
+        """
+
+        self.seuil = seuil
+        self.niveau = niveau
+        self.taille_cache = taille_cache
+        self._cache = collections.OrderedDict()
+        self._verrou = threading.Lock()
+
+    def installer(self, app):
+        """
+        Installe la compression dans une application Flask : chaque réponse passe par `compresser_reponse`.
+
+        :param app: application Flask
+        :return: None
+        """
+
+        import flask
+        app.extensions["compression"] = self
+        app.after_request(lambda reponse: self.compresser_reponse(reponse, flask.request.accept_encodings))
+
+    def _compresser_avec_cache(self, donnees, encodage, etag):
+        """
+        Compresse des données, en réutilisant le résultat d'une compression précédente pour le même ETag.
+
+        :param donnees: données à compresser (bytes)
+        :param encodage: format de compression (str)
+        :param etag: ETag de la réponse (str), ou None si la réponse n'en a pas
+        :return: données compressées (bytes)
+        """
+
+        if etag is None:
+            return compresser(donnees, encodage, self.niveau)
+        cle = (etag, encodage)
+        with self._verrou:
+            if cle in self._cache:
+                self._cache.move_to_end(cle)
+                return self._cache[cle]
+        donnees_compressees = compresser(donnees, encodage, self.niveau)
+        with self._verrou:
+            self._cache[cle] = donnees_compressees
+            while len(self._cache) > self.taille_cache:
+                self._cache.popitem(last=False)
+        return donnees_compressees
+
+    def compresser_reponse(self, reponse, accept_encodings):
+        """
+        Compresse une réponse si c'est utile et que le client l'accepte.
+
+        :param reponse: réponse Flask
+        :param accept_encodings: formats acceptés par le client (flask.request.accept_encodings)
+        :return: la réponse, éventuellement modifiée
+        """
+
+        if (reponse.status_code != 200 or reponse.mimetype not in types_compressibles or reponse.direct_passthrough
+                or "Content-Encoding" in reponse.headers):
+            return reponse
+        reponse.vary.add("Accept-Encoding")
+        encodage = choisir_encodage(accept_encodings)
+        if encodage is None:
+            return reponse
+
+        if reponse.is_streamed:
+            reponse.response = compresser_flux(reponse.response, encodage, self.niveau)
+            reponse.headers.pop("Content-Length", None)
+        else:
+            donnees = reponse.get_data()
+            if len(donnees) < self.seuil:
+                return reponse
+            etag, faible = reponse.get_etag()
+            reponse.set_data(self._compresser_avec_cache(donnees, encodage, etag))
+            if etag is not None and not faible:
+                # Le contenu envoyé n'est plus identique octet par octet : l'ETag devient faible, ce qui n'empêche pas
+                # les requêtes conditionnelles (If-None-Match utilise la comparaison faible)
+                reponse.set_etag(etag, weak=True)
+        reponse.headers["Content-Encoding"] = encodage
+        return reponse
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestCompression:
+    def test_compresser_reponse(self):
+        import flask
+        app = flask.Flask(__name__)
+        Compression(seuil=100).installer(app)
+
+        contenu = "<p>Personnage</p>" * 100
+
+        @app.route("/page")
+        def page():
+            reponse = flask.Response(contenu)
+            reponse.set_etag("version1")
+            return reponse.make_conditional(flask.request)
+
+        @app.route("/petite")
+        def petite():
+            return "court"
+
+        @app.route("/flux")
+        def flux():
+            return flask.Response((contenu[i:i + 200] for i in range(0, len(contenu), 200)), mimetype="text/html")
+
+        client = app.test_client()
+        reponse = client.get("/page", headers={"Accept-Encoding": "gzip"})
+        assert reponse.headers["Content-Encoding"] == "gzip"
+        assert reponse.headers["ETag"] == 'W/"version1"'
+        assert "Accept-Encoding" in reponse.headers["Vary"]
+        assert len(reponse.data) < len(contenu) / 10
+        assert gzip.decompress(reponse.data).decode("utf-8") == contenu
+
+        # La version compressée est resservie depuis le cache
+        assert client.get("/page", headers={"Accept-Encoding": "gzip"}).data == reponse.data
+        assert len(app.extensions["compression"]._cache) == 1
+        # Requête conditionnelle avec l'ETag faible
+        assert client.get("/page", headers={"Accept-Encoding": "gzip",
+                                            "If-None-Match": 'W/"version1"'}).status_code == 304
+
+        assert "Content-Encoding" not in client.get("/page").headers
+        assert "Content-Encoding" not in client.get("/petite", headers={"Accept-Encoding": "gzip"}).headers
+
+        reponse = client.get("/flux", headers={"Accept-Encoding": "gzip"})
+        assert reponse.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(reponse.data).decode("utf-8") == contenu
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["compression.py"])
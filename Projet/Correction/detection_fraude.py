@@ -0,0 +1,351 @@
+import math
+import threading
+import time
+from array import array
+
+from evolution_bdd import appliquer_resultat_match
+
+
+class EsquisseGlissante:
+    """
+    Esquisse count-min sur une fenêtre de temps glissante : estime, en mémoire fixe, le nombre d'occurrences de chaque
+    clé pendant la dernière fenêtre, quel que soit le nombre de clés différentes. L'estimation n'est jamais inférieure
+    au vrai nombre ; elle peut le dépasser quand des clés partagent les mêmes compteurs, d'autant moins que l'esquisse
+    est large.
+
+    La fenêtre est découpée en seaux qui ont chacun leur propre esquisse ; une esquisse totale, somme des seaux, permet
+    de répondre en ne lisant qu'un compteur par ligne. Quand un seau sort de la fenêtre, il est retiré du total puis
+    remis à zéro.
+    """
+
+    def __init__(self, duree_fenetre, nb_seaux=6, largeur=4096, profondeur=4):
+        """
+        Crée une esquisse vide.
+
+        :param duree_fenetre: durée de la fenêtre, en secondes (float)
+        :param nb_seaux: nombre de seaux découpant la fenêtre (int)
+        :param largeur: nombre de compteurs par ligne (int)
+        :param profondeur: nombre de lignes, c'est-à-dire de fonctions de hachage (int)
+        """
+
+        self.duree_seau = duree_fenetre / nb_seaux
+        self.nb_seaux = nb_seaux
+        self.largeur = largeur
+        self.profondeur = profondeur
+        self._zeros = array("I", bytes(4 * largeur * profondeur))
+        self._seaux = [array("I", self._zeros) for _ in range(nb_seaux)]
+        self._total = array("I", self._zeros)
+        # Numéro (date divisée par la durée d'un seau) du seau courant
+        self._numero_seau = None
+
+    def _avancer(self, date):
+        """
+        Fait sortir de la fenêtre les seaux trop anciens pour la date donnée. Une date antérieure au seau courant est
+        comptée dans le seau courant.
+
+        :param date: horodatage UNIX (float)
+        :return: seau courant (array)
+        """
+
+        numero = int(date // self.duree_seau)
+        if self._numero_seau is None:
+            self._numero_seau = numero
+        elif numero > self._numero_seau:
+            total = self._total
+            for numero_sortant in range(self._numero_seau + 1, min(numero, self._numero_seau + self.nb_seaux) + 1):
+                seau = self._seaux[numero_sortant % self.nb_seaux]
+                if any(seau):
+                    for indice, valeur in enumerate(seau):
+                        if valeur:
+                            total[indice] -= valeur
+                    seau[:] = self._zeros
+            self._numero_seau = numero
+        return self._seaux[self._numero_seau % self.nb_seaux]
+
+    def _indices(self, cle):
+        """
+        Calcule la position de la clé dans chaque ligne (double hachage à partir d'un seul appel à `hash`).
+
+        :param cle: clé hachable
+        :return: liste des indices dans le tableau de compteurs, un par ligne (int)
+        """
+
+        valeur_hachage = hash(cle)
+        h1 = valeur_hachage & 0xFFFFFFFF
+        h2 = (valeur_hachage >> 32) | 1
+        largeur = self.largeur
+        return [ligne * largeur + (h1 + ligne * h2) % largeur for ligne in range(self.profondeur)]
+
+    def ajouter(self, cle, date):
+        """
+        Compte une occurrence de la clé.
+
+        :param cle: clé hachable (par exemple adresse du client ou identifiant de personnage)
+        :param date: horodatage UNIX de l'occurrence (float)
+        :return: estimation du nombre d'occurrences de la clé dans la fenêtre, celle-ci comprise (int)
+        """
+
+        seau = self._avancer(date)
+        total = self._total
+        estimation = None
+        for indice in self._indices(cle):
+            seau[indice] += 1
+            total[indice] += 1
+            if estimation is None or total[indice] < estimation:
+                estimation = total[indice]
+        return estimation
+
+    def estimer(self, cle, date):
+        """
+        Estime le nombre d'occurrences de la clé dans la fenêtre, sans la compter.
+
+        :param cle: clé hachable
+        :param date: horodatage UNIX (float)
+        :return: estimation du nombre d'occurrences (int)
+        """
+
+        self._avancer(date)
+        return min(self._total[indice] for indice in self._indices(cle))
+
+
+class DetecteurFraude:
+    """
+    Détection en continu des votes automatisés : un robot qui envoie des votes en rafale ou qui fait gagner toujours le
+    même personnage fausse le classement ELO. Le détecteur compte, sur une fenêtre glissante, les votes de chaque client
+    et les victoires de chaque personnage avec des esquisses count-min (mémoire fixe, quelques microsecondes par vote).
+    Un vote suspect n'est pas pris en compte dans les scores : il est enregistré dans la table `votes_quarantaine`, où
+    il peut être examiné.
+
+    Un personnage apparaît dans environ 2 / nb_personnages des matchs tirés au hasard : même s'il les gagne tous
+    honnêtement, il ne peut pas gagner une plus grande part des votes. Seul un robot qui ne vote que sur les matchs de
+    son favori dépasse nettement cette part. Les votes mis en quarantaine ne sont pas comptés dans les victoires, pour
+    qu'un personnage ne reste pas bloqué après une rafale. La limite par client compte les votes d'une même adresse IP :
+    elle doit être relevée si de nombreux utilisateurs partagent la même adresse (salle de classe derrière un NAT).
+    """
+
+    def __init__(self, bdd, duree_fenetre=60, nb_votes_max_client=30, facteur_part_personnage=1.5,
+                 nb_votes_min_personnage=200, nb_personnages=None):
+        """
+        Crée la table de quarantaine si elle n'existe pas déjà.
+
+        :param bdd: objet base de données ouvert en écriture (type BDD du fichier `bdd.py`)
+        :param duree_fenetre: durée de la fenêtre glissante, en secondes (float)
+        :param nb_votes_max_client: nombre maximum de votes d'un client pendant la fenêtre (int)
+        :param facteur_part_personnage: nombre de fois la part maximale des victoires d'un personnage honnête
+        (2 / nb_personnages) au-delà duquel ses victoires sont suspectes (float)
+        :param nb_votes_min_personnage: nombre de votes dans la fenêtre à partir duquel la part des victoires de chaque
+        personnage est surveillée (int)
+        :param nb_personnages: nombre de personnages tirés dans les matchs (int), ou None pour celui de la base
+        """
+
+        self.bdd = bdd
+        self.nb_votes_max_client = nb_votes_max_client
+        nb_personnages = nb_personnages or bdd.nombre_personnages()
+        self.part_max_personnage = facteur_part_personnage * 2 / max(2, nb_personnages)
+        self.nb_votes_min_personnage = nb_votes_min_personnage
+        self._votes_clients = EsquisseGlissante(duree_fenetre)
+        # Peu de personnages : une esquisse étroite suffit
+        self._victoires_personnages = EsquisseGlissante(duree_fenetre, largeur=1024)
+        # Nombre exact de votes par seau, pour la part des victoires
+        self._votes_seaux = [0] * self._victoires_personnages.nb_seaux
+        self._numero_seau = None
+        self._verrou = threading.Lock()
+
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''CREATE TABLE IF NOT EXISTS votes_quarantaine (
+                               id         INTEGER PRIMARY KEY,
+                               id_gagnant INTEGER NOT NULL,
+                               id_perdant INTEGER NOT NULL,
+                               client     TEXT,
+                               motif      TEXT NOT NULL,
+                               date       REAL NOT NULL
+                           )''')
+        self.bdd.connexion.commit()
+
+    def _compter_vote(self, date, nb=1):
+        """
+        Compte un vote dans le nombre exact de votes de la fenêtre.
+
+        :param date: horodatage UNIX du vote (float)
+        :param nb: nombre de votes à compter (int, 0 pour seulement faire avancer la fenêtre)
+        :return: nombre de votes dans la fenêtre, celui-ci compris (int)
+        """
+
+        numero = int(date // self._victoires_personnages.duree_seau)
+        nb_seaux = len(self._votes_seaux)
+        if self._numero_seau is None:
+            self._numero_seau = numero
+        elif numero > self._numero_seau:
+            for numero_sortant in range(self._numero_seau + 1, min(numero, self._numero_seau + nb_seaux) + 1):
+                self._votes_seaux[numero_sortant % nb_seaux] = 0
+            self._numero_seau = numero
+        self._votes_seaux[self._numero_seau % nb_seaux] += nb
+        return sum(self._votes_seaux)
+
+    def examiner(self, client, id_gagnant, date):
+        """
+        Compte un vote et indique s'il est suspect.
+
+        :param client: identifiant du client (par exemple son adresse IP, str), ou None s'il est inconnu
+        :param id_gagnant: identifiant du personnage choisi (int)
+        :param date: horodatage UNIX du vote (float)
+        :return: motif de la mise en quarantaine (str), ou None si le vote n'est pas suspect
+        """
+
+        with self._verrou:
+            nb_votes_client = self._votes_clients.ajouter(client, date) if client is not None else 0
+            if nb_votes_client > self.nb_votes_max_client:
+                return "client"
+            # Les victoires et les votes ne sont comptés que si le vote est accepté
+            nb_votes = self._compter_vote(date, 0) + 1
+            nb_victoires = self._victoires_personnages.estimer(id_gagnant, date) + 1
+            # Marge de quatre écarts types : un personnage honnête ne la dépasse presque jamais par hasard
+            nb_victoires_max = self.part_max_personnage * nb_votes
+            nb_victoires_max += 4 * math.sqrt(nb_victoires_max)
+            if nb_votes >= self.nb_votes_min_personnage and nb_victoires > nb_victoires_max:
+                return "personnage"
+            self._compter_vote(date)
+            self._victoires_personnages.ajouter(id_gagnant, date)
+        return None
+
+    def appliquer_resultat_match(self, id_match_en_cours, choix, client=None):
+        """
+        Équivalent de `evolution_bdd.appliquer_resultat_match` qui met les votes suspects en quarantaine au lieu de les
+        prendre en compte. Le match en cours d'un vote mis en quarantaine est supprimé comme pour un vote normal.
+
+        :param id_match_en_cours: identifiant du match en cours (int)
+        :param choix: choix fait par l'utilisateur (int, 1 ou 2)
+        :param client: identifiant du client (str ou None)
+        :return: dictionnaire du match ajouté, ou None si le vote est incorrect ou mis en quarantaine
+        """
+
+        match_en_cours = self.bdd.match_en_cours(id_match_en_cours)
+        if match_en_cours is None or choix not in (1, 2):
+            return appliquer_resultat_match(self.bdd, id_match_en_cours, choix)
+        id_gagnant = match_en_cours["id_personnage1"] if choix == 1 else match_en_cours["id_personnage2"]
+        id_perdant = match_en_cours["id_personnage2"] if choix == 1 else match_en_cours["id_personnage1"]
+
+        date = time.time()
+        motif = self.examiner(client, id_gagnant, date)
+        if motif is None:
+            return appliquer_resultat_match(self.bdd, id_match_en_cours, choix)
+
+        self.bdd.connexion.execute('''INSERT INTO votes_quarantaine (id_gagnant, id_perdant, client, motif, date)
+                                      VALUES (?, ?, ?, ?, ?)''',
+                                   (id_gagnant, id_perdant, client, motif, date))
+        self.bdd.supprimer_match_en_cours(id_match_en_cours)
+        return None
+
+    def votes_quarantaine(self, limite=100):
+        """
+        Renvoie les derniers votes mis en quarantaine.
+
+        :param limite: nombre maximum de votes renvoyés (int)
+        :return: liste de dictionnaires (clés : id, id_gagnant, id_perdant, client, motif, date), du plus récent au plus
+        ancien
+        """
+
+        curseur = self.bdd.connexion.execute('''SELECT id, id_gagnant, id_perdant, client, motif, date
+                                                FROM votes_quarantaine
+                                                ORDER BY id DESC
+                                                LIMIT ?''', (limite,))
+        colonnes = [description[0] for description in curseur.description]
+        return [dict(zip(colonnes, ligne)) for ligne in curseur]
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestDetectionFraude:
+    def test_esquisse_glissante(self):
+        esquisse = EsquisseGlissante(60, nb_seaux=6, largeur=256, profondeur=4)
+        for numero in range(1000):
+            esquisse.ajouter("client %d" % (numero % 100), 1000 + numero * 0.01)
+        for _ in range(50):
+            esquisse.ajouter("robot", 1010)
+        # L'estimation n'est jamais inférieure au vrai nombre
+        assert esquisse.estimer("robot", 1010) >= 50
+        assert all(esquisse.estimer("client %d" % numero, 1010) >= 10 for numero in range(100))
+        assert esquisse.estimer("robot", 1010) < 100
+
+        # Les votes sortent de la fenêtre
+        assert esquisse.estimer("robot", 1075) == 0
+        assert esquisse.ajouter("robot", 1075) == 1
+        assert esquisse.estimer("client 1", 2000) == 0
+
+    def test_quarantaine(self):
+        from bdd import BDD
+        bdd = BDD(":memory:")
+        bdd.ajouter_personnages([{"nom": "Personnage %d" % numero, "url_image": "", "acteur": None, "score": 1400}
+                                 for numero in range(100)])
+        detecteur = DetecteurFraude(bdd, nb_votes_max_client=10, nb_votes_min_personnage=50)
+
+        def voter(client, id_gagnant, id_perdant):
+            id_match_en_cours = bdd.ajouter_match_en_cours({"id_personnage1": id_gagnant,
+                                                            "id_personnage2": id_perdant})
+            return detecteur.appliquer_resultat_match(id_match_en_cours, 1, client)
+
+        # Les votes en rafale d'un même client sont mis en quarantaine au-delà de la limite
+        resultats = [voter("10.0.0.1", 1 + numero % 50, 51 + numero % 50) for numero in range(15)]
+        assert all(infos_match is not None for infos_match in resultats[:10])
+        assert resultats[10:] == [None] * 5
+        assert len(bdd.matchs()) == 10
+        assert [vote["motif"] for vote in detecteur.votes_quarantaine()] == ["client"] * 5
+        assert bdd.connexion.execute("SELECT COUNT(*) FROM matchs_en_cours").fetchone()[0] == 0
+
+        # Un personnage qui gagne une trop grande part des votes, même venant de clients différents
+        resultats = [voter("10.0.1.%d" % numero, 100, 1 + numero % 99) for numero in range(60)]
+        assert resultats[-1] is None
+        assert detecteur.votes_quarantaine(1)[0]["motif"] == "personnage"
+        score_avant = bdd.personnage(100)["score"]
+        voter("10.0.2.1", 100, 1)
+        assert bdd.personnage(100)["score"] == score_avant
+
+        # Un vote sur un match en cours inconnu reste ignoré
+        assert detecteur.appliquer_resultat_match(123456, 1, "10.0.0.2") is None
+        bdd.fermer()
+
+    def test_votes_honnetes(self):
+        import random
+        from bdd import BDD
+        bdd = BDD(":memory:")
+        # Comme la base réelle : 23 personnages, de forces très différentes, chacun dans environ 8,7 % des matchs
+        nb_personnages = 23
+        detecteur = DetecteurFraude(bdd, nb_personnages=nb_personnages)
+        generateur = random.Random(8)
+        forces = [generateur.gauss(0, 300) for _ in range(nb_personnages + 1)]
+        forces[1] = 1000
+        nb_suspects = 0
+        for numero in range(3000):
+            id_personnage1, id_personnage2 = generateur.sample(range(1, nb_personnages + 1), 2)
+            probabilite1 = 1 / (1 + 10 ** ((forces[id_personnage2] - forces[id_personnage1]) / 400))
+            id_gagnant = id_personnage1 if generateur.random() < probabilite1 else id_personnage2
+            # Cinq votes par seconde, chacun d'un client différent
+            if detecteur.examiner("10.%d.%d.1" % (numero // 256, numero % 256), id_gagnant, 1000 + numero / 5):
+                nb_suspects += 1
+        assert nb_suspects == 0
+
+        # Un robot qui ne vote que pour les matchs de son favori, depuis de nombreuses adresses, est repéré
+        motifs = [detecteur.examiner("10.200.%d.1" % numero, 2, 1600 + numero / 50) for numero in range(200)]
+        assert motifs.count("personnage") > 100
+        bdd.fermer()
+
+    def test_surcout(self):
+        from bdd import BDD
+        bdd = BDD(":memory:")
+        detecteur = DetecteurFraude(bdd)
+        date = time.time()
+        debut = time.perf_counter()
+        for numero in range(20000):
+            detecteur.examiner("192.168.%d.%d" % (numero // 256 % 256, numero % 256), numero % 400, date)
+        duree_par_vote = (time.perf_counter() - debut) / 20000
+        # Quelques microsecondes par vote (marge large pour les machines lentes)
+        assert duree_par_vote < 100e-6
+        bdd.fermer()
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["detection_fraude.py"])
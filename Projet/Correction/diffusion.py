@@ -0,0 +1,202 @@
+import json
+import queue
+import threading
+
+
+class Diffuseur:
+    """
+    Classe diffusant des événements aux clients abonnés à un flux "server-sent events" (voir
+    https://developer.mozilla.org/fr/docs/Web/API/Server-sent_events). Chaque événement est mis en forme une seule fois
+    puis placé dans la file de chaque abonné.
+    """
+
+    def __init__(self, taille_file=100):
+        """
+        Initialise un diffuseur sans abonné.
+
+        :param taille_file: nombre maximum d'événements en attente pour un abonné ; un abonné trop lent qui atteint
+        cette limite est désabonné et son flux se termine (int)
+        """
+
+        self.taille_file = taille_file
+        self._abonnes = set()
+        self._verrou = threading.Lock()
+
+    def nb_abonnes(self):
+        """
+        Renvoie le nombre d'abonnés actuels.
+
+        :return: nombre d'abonnés (int)
+        """
+
+        return len(self._abonnes)
+
+    def abonner(self):
+        """
+        Abonne un nouveau client.
+
+        :return: file des événements destinés à ce client (queue.Queue), à passer à `flux`
+        """
+
+        file_abonne = queue.Queue(self.taille_file)
+        with self._verrou:
+            self._abonnes.add(file_abonne)
+        return file_abonne
+
+    def desabonner(self, file_abonne):
+        """
+        Désabonne un client.
+
+        :param file_abonne: file renvoyée par `abonner`
+        :return: None
+        """
+
+        with self._verrou:
+            self._abonnes.discard(file_abonne)
+
+    def publier(self, type_evenement, donnees):
+        """
+        Envoie un événement à tous les abonnés.
+
+        :param type_evenement: type de l'événement, utilisé côté client par addEventListener (str)
+        :param donnees: données de l'événement, sérialisables en JSON
+        :return: None
+        """
+
+        message = "event: %s\ndata: %s\n\n" % (type_evenement, json.dumps(donnees, ensure_ascii=False,
+                                                                         separators=(",", ":")))
+        with self._verrou:
+            abonnes = list(self._abonnes)
+        for file_abonne in abonnes:
+            try:
+                file_abonne.put_nowait(message)
+            except queue.Full:
+                self.desabonner(file_abonne)
+
+    def flux(self, file_abonne, rappel_periodique=None, periode=1.0, periode_maintien=15.0):
+        """
+        Produit le flux d'un abonné, à renvoyer comme corps d'une réponse de type text/event-stream. Le flux se termine
+        quand le client est désabonné ; quand le client se déconnecte, le serveur web ferme le générateur, ce qui le
+        désabonne.
+
+        :param file_abonne: file renvoyée par `abonner`
+        :param rappel_periodique: fonction appelée régulièrement pendant l'attente des événements (par exemple pour
+        vérifier si un autre processus a enregistré des votes), ou None
+        :param periode: intervalle entre deux appels de la fonction de rappel, en secondes (float)
+        :param periode_maintien: intervalle maximal sans envoi de données, au-delà duquel un commentaire est envoyé
+        pour maintenir la connexion ouverte, en secondes (float)
+        :return: générateur de chaînes de caractères
+        """
+
+        try:
+            yield "retry: 3000\n\n"
+            attente = 0.0
+            while file_abonne in self._abonnes or not file_abonne.empty():
+                try:
+                    yield file_abonne.get(timeout=periode)
+                    attente = 0.0
+                except queue.Empty:
+                    attente += periode
+                    if rappel_periodique is not None:
+                        rappel_periodique()
+                    if attente >= periode_maintien:
+                        yield ": maintien\n\n"
+                        attente = 0.0
+        finally:
+            self.desabonner(file_abonne)
+
+
+def calculer_delta(ancien_classement, nouveau_classement, matchs):
+    """
+    Calcule les changements du classement causés par un ou plusieurs matchs : score et rang des personnages dont le
+    score ou le rang a changé, et ligne de chaque nouveau match.
+
+    :param ancien_classement: personnages triés par score décroissant avant les matchs (itérable de dictionnaires ou de
+    lignes compactes, clés : id, nom, score)
+    :param nouveau_classement: personnages triés par score décroissant après les matchs (idem)
+    :param matchs: matchs joués (itérable de dictionnaires, clés : id, id_gagnant, id_perdant, ancien_score_gagnant,
+    ancien_score_perdant, nouveau_score_gagnant, nouveau_score_perdant)
+    :return: dictionnaire (clés : personnages (liste de dictionnaires, clés : id, rang, ancien_rang, score),
+    matchs (liste de dictionnaires, clés : id, id_gagnant, id_perdant, nom_gagnant, nom_perdant, ancien_score_gagnant,
+    ancien_score_perdant, nouveau_score_gagnant, nouveau_score_perdant))
+    """
+
+    anciens_rangs = {personnage["id"]: (rang, personnage["score"])
+                     for rang, personnage in enumerate(ancien_classement, 1)}
+    noms = {}
+    personnages = []
+    for rang, personnage in enumerate(nouveau_classement, 1):
+        noms[personnage["id"]] = personnage["nom"]
+        ancien_rang, ancien_score = anciens_rangs.get(personnage["id"], (None, None))
+        if ancien_rang != rang or ancien_score != personnage["score"]:
+            personnages.append({"id": personnage["id"], "rang": rang, "ancien_rang": ancien_rang,
+                                "score": personnage["score"]})
+
+    lignes_matchs = []
+    for match in matchs:
+        lignes_matchs.append({
+            "id":                    match["id"],
+            "id_gagnant":            match["id_gagnant"],
+            "id_perdant":            match["id_perdant"],
+            "nom_gagnant":           noms.get(match["id_gagnant"]),
+            "nom_perdant":           noms.get(match["id_perdant"]),
+            "ancien_score_gagnant":  match["ancien_score_gagnant"],
+            "ancien_score_perdant":  match["ancien_score_perdant"],
+            "nouveau_score_gagnant": match["nouveau_score_gagnant"],
+            "nouveau_score_perdant": match["nouveau_score_perdant"]
+        })
+    return {"personnages": personnages, "matchs": lignes_matchs}
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestDiffusion:
+    def test_diffuseur(self):
+        diffuseur = Diffuseur(taille_file=2)
+        file1 = diffuseur.abonner()
+        file2 = diffuseur.abonner()
+        assert diffuseur.nb_abonnes() == 2
+
+        diffuseur.publier("match", {"id": 1})
+        message = file1.get_nowait()
+        assert message == 'event: match\ndata: {"id":1}\n\n'
+        # Le message n'est mis en forme qu'une seule fois
+        assert file2.get_nowait() is message
+
+        # Un abonné dont la file est pleine est désabonné
+        for numero in range(3):
+            diffuseur.publier("match", {"id": numero})
+            file1.get_nowait()
+        assert diffuseur.nb_abonnes() == 1
+
+        # Le flux d'un abonné désabonné se termine après avoir envoyé les événements en attente
+        flux = list(diffuseur.flux(file2, periode=0.01))
+        assert flux == ["retry: 3000\n\n", 'event: match\ndata: {"id":0}\n\n', 'event: match\ndata: {"id":1}\n\n']
+
+        file3 = diffuseur.abonner()
+        flux = diffuseur.flux(file3, periode=0.01)
+        next(flux)
+        flux.close()
+        assert diffuseur.nb_abonnes() == 1
+
+    def test_calculer_delta(self):
+        ancien_classement = [{"id": 1, "nom": "A", "score": 1500}, {"id": 2, "nom": "B", "score": 1450},
+                             {"id": 3, "nom": "C", "score": 1400}, {"id": 4, "nom": "D", "score": 1300}]
+        nouveau_classement = [{"id": 1, "nom": "A", "score": 1500}, {"id": 3, "nom": "C", "score": 1460},
+                              {"id": 2, "nom": "B", "score": 1450}, {"id": 4, "nom": "D", "score": 1240}]
+        match = {"id": 7, "id_gagnant": 3, "id_perdant": 4, "ancien_score_gagnant": 1400,
+                 "ancien_score_perdant": 1300, "nouveau_score_gagnant": 1460, "nouveau_score_perdant": 1240}
+
+        delta = calculer_delta(ancien_classement, nouveau_classement, [match])
+        assert delta["personnages"] == [{"id": 3, "rang": 2, "ancien_rang": 3, "score": 1460},
+                                        {"id": 2, "rang": 3, "ancien_rang": 2, "score": 1450},
+                                        {"id": 4, "rang": 4, "ancien_rang": 4, "score": 1240}]
+        assert delta["matchs"] == [dict(match, nom_gagnant="C", nom_perdant="D")]
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["diffusion.py"])
@@ -0,0 +1,398 @@
+import ipaddress
+import os
+import socket
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from evolution_bdd import appliquer_resultat_match, creer_nouveau_match_en_cours
+
+
+def _verifier_securite(adresse, cle_authentification):
+    """
+    Vérifie qu'un canal avec le processus écrivain ne peut pas être ouvert par n'importe qui : les messages échangés
+    sont des objets sérialisés par pickle, dont la lecture peut exécuter du code. Une clé d'authentification est donc
+    obligatoire, et une socket TCP ne peut écouter que sur l'interface locale.
+
+    :param adresse: chemin de la socket Unix (str) ou couple (hôte, port)
+    :param cle_authentification: clé partagée (bytes ou None)
+    :return: None
+    """
+
+    if not cle_authentification:
+        raise ValueError("Clé d'authentification du processus écrivain obligatoire (variable d'environnement "
+                         "CLE_ECRIVAIN_VOTES)")
+    if not isinstance(adresse, str):
+        if not ipaddress.ip_address(socket.gethostbyname(adresse[0])).is_loopback:
+            raise ValueError("Le processus écrivain n'écoute que sur l'interface locale, pas sur %r" % (adresse[0],))
+
+
+class ServeurEcrivain:
+    """
+    Processus unique chargé de toutes les écritures dans la base de données quand l'application web tourne dans
+    plusieurs processus. Les processus web lui envoient les votes et les demandes de nouveaux matchs par un canal local
+    (socket Unix) et lisent la base de données avec leur propre connexion en lecture seule : les écritures restent
+    sérialisées dans un seul processus, sans contention sur le verrou d'écriture de SQLite, tandis que les lectures
+    profitent de tous les cœurs.
+    """
+
+    def __init__(self, bdd, adresse, cle_authentification=None, apres_match=None, detecteur_fraude=None,
+                 graphe=None):
+        """
+        Prépare le serveur. La base de données est passée en mode WAL pour que les lecteurs des autres processus ne
+        bloquent jamais l'écrivain.
+
+        :param bdd: objet base de données ouvert en écriture (type BDD du fichier `bdd.py`)
+        :param adresse: chemin de la socket Unix (str), accessible au seul propriétaire du processus, ou couple (hôte,
+        port) pour une socket TCP sur l'interface locale
+        :param cle_authentification: clé partagée avec les clients, obligatoire (bytes)
+        :param apres_match: fonction appelée avec le dictionnaire du match après chaque vote enregistré, dans le
+        processus écrivain (par exemple pour le rattrapage de l'historique des scores), ou None
+        :param detecteur_fraude: détecteur des votes automatisés (type DetecteurFraude du fichier
+        `detection_fraude.py`), ou None pour prendre en compte tous les votes
+        :param graphe: graphe des relations pour les matchs en mode rival (type GrapheRelations du fichier
+        `graphe_personnages.py`), ou None pour des matchs aléatoires
+        """
+
+        _verifier_securite(adresse, cle_authentification)
+        self.bdd = bdd
+        self.adresse = adresse
+        self.cle_authentification = cle_authentification
+        self.apres_match = apres_match
+        self.detecteur_fraude = detecteur_fraude
+        self.graphe = graphe
+        # Verrou des écritures, à partager avec les autres tâches qui écrivent dans la base (tirage des instantanés)
+        self.verrou = threading.Lock()
+        self._ecouteur = None
+        self._arrete = threading.Event()
+        if bdd.chemin_fichier_bdd != ":memory:":
+            bdd.connexion.execute("PRAGMA journal_mode = WAL")
+
+    def _traiter(self, requete):
+        """
+        Exécute une requête d'un client. Les requêtes sont exécutées une par une, quel que soit le nombre de clients.
+
+        :param requete: tuple ("voter", id_match_en_cours, choix, client) ou ("nouveau_match",)
+        :return: valeur de retour de appliquer_resultat_match ou de creer_nouveau_match_en_cours
+        """
+
+        with self.verrou:
+            # Archives créées ou fusionnées par `archivage.py` pendant que l'écrivain tourne
+            self.bdd.rafraichir_archives()
+            if requete[0] == "voter":
+                if self.detecteur_fraude is not None:
+                    infos_match = self.detecteur_fraude.appliquer_resultat_match(requete[1], requete[2], requete[3])
+                else:
+                    infos_match = appliquer_resultat_match(self.bdd, requete[1], requete[2])
+                if infos_match is not None and self.apres_match is not None:
+                    self.apres_match(infos_match)
+                return infos_match
+            if requete[0] == "nouveau_match":
+                return creer_nouveau_match_en_cours(self.bdd, self.graphe)
+        raise ValueError("Requête inconnue : %r" % (requete,))
+
+    def _servir_client(self, connexion):
+        """
+        Répond aux requêtes d'un client jusqu'à ce qu'il se déconnecte.
+
+        :param connexion: connexion avec le client (multiprocessing.connection.Connection)
+        :return: None
+        """
+
+        with connexion:
+            while True:
+                try:
+                    requete = connexion.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reponse = ("ok", self._traiter(requete))
+                except Exception as erreur:
+                    reponse = ("erreur", repr(erreur))
+                connexion.send(reponse)
+
+    def servir(self):
+        """
+        Attend les connexions des clients et les sert, chacune dans son propre fil d'exécution, jusqu'à l'appel de
+        `arreter`.
+
+        :return: None
+        """
+
+        if isinstance(self.adresse, str):
+            if os.path.exists(self.adresse):
+                os.remove(self.adresse)
+            # La socket est créée directement avec les droits 0600 : aucun autre utilisateur ne peut s'y connecter
+            ancien_masque = os.umask(0o177)
+            try:
+                self._ecouteur = Listener(self.adresse, authkey=self.cle_authentification)
+            finally:
+                os.umask(ancien_masque)
+            os.chmod(self.adresse, 0o600)
+        else:
+            self._ecouteur = Listener(self.adresse, authkey=self.cle_authentification)
+        try:
+            while not self._arrete.is_set():
+                try:
+                    connexion = self._ecouteur.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    # Écouteur fermé par arreter, ou client qui n'a pas pu s'authentifier
+                    continue
+                threading.Thread(target=self._servir_client, args=(connexion,), daemon=True).start()
+        finally:
+            self._ecouteur.close()
+
+    def arreter(self):
+        """
+        Arrête d'accepter de nouveaux clients.
+
+        :return: None
+        """
+
+        self._arrete.set()
+        if self._ecouteur is not None:
+            self._ecouteur.close()
+
+
+class ClientEcrivain:
+    """
+    Client du processus écrivain, utilisé par les processus web. Une instance peut être partagée entre plusieurs fils
+    d'exécution.
+    """
+
+    def __init__(self, adresse, cle_authentification=None, delai_connexion=30):
+        """
+        Prépare le client, sans se connecter.
+
+        :param adresse: adresse du serveur (voir ServeurEcrivain)
+        :param cle_authentification: clé partagée avec le serveur, obligatoire (bytes)
+        :param delai_connexion: durée maximale d'attente du serveur lors de la connexion, en secondes (float)
+        """
+
+        _verifier_securite(adresse, cle_authentification)
+        self.adresse = adresse
+        self.cle_authentification = cle_authentification
+        self.delai_connexion = delai_connexion
+        self._connexion = None
+        self._verrou = threading.Lock()
+
+    def _connecter(self):
+        """
+        Ouvre une connexion avec le serveur en réessayant tant qu'il n'est pas démarré.
+
+        :return: connexion avec le serveur (multiprocessing.connection.Connection)
+        """
+
+        limite = time.monotonic() + self.delai_connexion
+        while True:
+            try:
+                return Client(self.adresse, authkey=self.cle_authentification)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > limite:
+                    raise
+                time.sleep(0.1)
+
+    def connecter(self):
+        """
+        Se connecte au serveur si ce n'est pas déjà fait.
+
+        :return: None
+        """
+
+        with self._verrou:
+            if self._connexion is None:
+                self._connexion = self._connecter()
+
+    def _envoyer(self, *requete):
+        """
+        Envoie une requête au serveur et attend sa réponse. En cas de coupure de la connexion, une nouvelle connexion
+        est ouverte et la requête est envoyée une seconde fois (un vote déjà pris en compte est alors ignoré par le
+        serveur, son match en cours ayant été supprimé).
+
+        :param requete: requête (voir ServeurEcrivain._traiter)
+        :return: réponse du serveur
+        """
+
+        with self._verrou:
+            for tentative in range(2):
+                if self._connexion is None:
+                    self._connexion = self._connecter()
+                try:
+                    self._connexion.send(requete)
+                    statut, resultat = self._connexion.recv()
+                    break
+                except (EOFError, OSError):
+                    self._connexion = None
+                    if tentative == 1:
+                        raise
+        if statut == "erreur":
+            raise RuntimeError("Erreur du processus écrivain : %s" % resultat)
+        return resultat
+
+    def appliquer_resultat_match(self, id_match_en_cours, choix, client=None):
+        """
+        Équivalent de `evolution_bdd.appliquer_resultat_match`, exécuté par le processus écrivain.
+
+        :param id_match_en_cours: identifiant du match en cours (int)
+        :param choix: choix fait par l'utilisateur (int, 1 ou 2)
+        :param client: identifiant du client qui a voté, pour la détection des votes automatisés (str ou None)
+        :return: dictionnaire du match ajouté, ou None si le résultat du match est incorrect ou mis en quarantaine
+        """
+
+        return self._envoyer("voter", id_match_en_cours, choix, client)
+
+    def creer_nouveau_match_en_cours(self):
+        """
+        Équivalent de `evolution_bdd.creer_nouveau_match_en_cours`, exécuté par le processus écrivain.
+
+        :return: 3-uplet (id_nouveau_match_en_cours, personnage1, personnage2)
+        """
+
+        return self._envoyer("nouveau_match")
+
+    def fermer(self):
+        """
+        Ferme la connexion avec le serveur.
+
+        :return: None
+        """
+
+        with self._verrou:
+            if self._connexion is not None:
+                self._connexion.close()
+                self._connexion = None
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestEcrivainVotes:
+    def test_votes_concurrents(self):
+        from bdd import BDD
+        fichier_bdd_test = "test/test_ecrivain_votes.db"
+        adresse_test = "test/test_ecrivain_votes.sock"
+        for fichier in (fichier_bdd_test, fichier_bdd_test + "-wal", fichier_bdd_test + "-shm"):
+            if os.path.exists(fichier):
+                os.remove(fichier)
+        bdd = BDD(fichier_bdd_test)
+        bdd.ajouter_personnages([{"nom": "Personnage %d" % numero, "url_image": "", "acteur": None, "score": 1400}
+                                 for numero in range(5)])
+
+        matchs_apres_vote = []
+        serveur = ServeurEcrivain(bdd, adresse_test, b"cle de test", apres_match=matchs_apres_vote.append)
+        fil_serveur = threading.Thread(target=serveur.servir, daemon=True)
+        fil_serveur.start()
+
+        def voter(nb_votes):
+            client = ClientEcrivain(adresse_test, b"cle de test", delai_connexion=5)
+            for _ in range(nb_votes):
+                id_match_en_cours, personnage1, _ = client.creer_nouveau_match_en_cours()
+                infos_match = client.appliquer_resultat_match(id_match_en_cours, 1)
+                assert infos_match["id_gagnant"] == personnage1["id"]
+            # Un second vote sur le même match est ignoré
+            assert client.appliquer_resultat_match(id_match_en_cours, 2) is None
+            client.fermer()
+
+        fils_clients = [threading.Thread(target=voter, args=(20,)) for _ in range(4)]
+        for fil in fils_clients:
+            fil.start()
+        for fil in fils_clients:
+            fil.join()
+
+        # Lecture depuis une connexion en lecture seule, comme dans un processus web
+        bdd_lecture = BDD(fichier_bdd_test, lecture_seule=True)
+        assert len(bdd_lecture.matchs()) == 80
+        assert len(matchs_apres_vote) == 80
+        # Les écritures étant sérialisées, le système ELO ne crée ni ne détruit de points
+        assert round(sum(personnage["score"] for personnage in bdd_lecture.personnages()), 6) == 5 * 1400
+
+        serveur.arreter()
+        bdd_lecture.fermer()
+        bdd.fermer()
+        for fichier in (fichier_bdd_test, fichier_bdd_test + "-wal", fichier_bdd_test + "-shm", adresse_test):
+            if os.path.exists(fichier):
+                os.remove(fichier)
+
+    def test_securite(self):
+        import pytest
+        import stat
+        from bdd import BDD
+        adresse_test = "test/test_ecrivain_votes_securite.sock"
+        bdd = BDD(":memory:")
+        # Sans clé, ou sur une interface réseau, le serveur et le client refusent de démarrer
+        for adresse, cle in ((adresse_test, None), (adresse_test, b""), (("0.0.0.0", 6000), b"cle"),
+                             (("192.0.2.1", 6000), b"cle")):
+            with pytest.raises(ValueError):
+                ServeurEcrivain(bdd, adresse, cle)
+            with pytest.raises(ValueError):
+                ClientEcrivain(adresse, cle)
+        ServeurEcrivain(bdd, ("127.0.0.1", 6000), b"cle")
+
+        # La socket Unix n'est accessible qu'au propriétaire
+        serveur = ServeurEcrivain(bdd, adresse_test, b"cle de test")
+        threading.Thread(target=serveur.servir, daemon=True).start()
+        client = ClientEcrivain(adresse_test, b"cle de test", delai_connexion=5)
+        client.connecter()
+        assert stat.S_IMODE(os.stat(adresse_test).st_mode) == 0o600
+        client.fermer()
+        serveur.arreter()
+        bdd.fermer()
+        if os.path.exists(adresse_test):
+            os.remove(adresse_test)
+
+
+if __name__ == "__main__":
+    import argparse
+    from bdd import BDD
+    from historique_scores import HistoriqueScores
+    from initialisation_bdd import remplir_bdd
+    from intervalles_confiance import IntervallesConfiance
+    from app import (score_initial, nb_apparences_min, duree_seau_historique, dossier_archives, dossier_sauvegardes,
+                     intervalle_sauvegardes, nb_sauvegardes, replique_lecture, detection_fraude, dossier_journaux,
+                     nom_noeud, intervalle_tirage_classement, mode_matchs, dossier_graphe)
+    from detection_fraude import DetecteurFraude
+    from graphe_personnages import GrapheRelations
+    from journal_votes import JournalVotes, TirageInstantanes
+    from metadonnees import MetadonneesPersonnages
+    from sauvegarde import ServiceSauvegarde
+
+    analyseur = argparse.ArgumentParser(description="Processus écrivain unique des votes, pour un déploiement de "
+                                                    "l'application web sur plusieurs processus.")
+    analyseur.add_argument("--bdd", default="bdd.db", help="fichier de base de données SQLite 3")
+    analyseur.add_argument("--adresse", default="ecrivain_votes.sock", help="chemin de la socket Unix d'écoute")
+    arguments = analyseur.parse_args()
+    cle = os.environ.get("CLE_ECRIVAIN_VOTES")
+    if not cle:
+        analyseur.error("la variable d'environnement CLE_ECRIVAIN_VOTES (clé partagée avec les processus web) est "
+                        "obligatoire")
+
+    bdd = BDD(arguments.bdd)
+    bdd.attacher_archives(dossier_archives)
+    remplir_bdd(bdd, score_initial, nb_apparences_min)
+    # Tables des métadonnées et des intervalles de confiance, lues par les processus web
+    MetadonneesPersonnages(bdd)
+    IntervallesConfiance(bdd)
+    historique_scores = HistoriqueScores(bdd, "temps", duree_seau_historique)
+    historique_scores.rattraper()
+    if dossier_sauvegardes is not None:
+        # L'écrivain étant le seul à modifier la base de données, c'est lui qui la sauvegarde
+        ServiceSauvegarde(arguments.bdd, dossier_sauvegardes, nb_sauvegardes,
+                          chemin_replique=replique_lecture).demarrer(intervalle_sauvegardes)
+
+    # Avec un classement global à plusieurs machines, l'écrivain tient le journal des votes de la machine
+    journal_votes = JournalVotes(dossier_journaux, nom_noeud) if dossier_journaux is not None else None
+
+    def apres_match(infos_match):
+        historique_scores.rattraper()
+        if journal_votes is not None:
+            journal_votes.ajouter(infos_match["id_gagnant"], infos_match["id_perdant"], infos_match["date"])
+
+    serveur = ServeurEcrivain(bdd, arguments.adresse, cle.encode("utf-8"), apres_match=apres_match,
+                              detecteur_fraude=DetecteurFraude(bdd) if detection_fraude else None,
+                              graphe=GrapheRelations.charger(bdd, dossier_graphe) if mode_matchs == "rival" else None)
+    if journal_votes is not None:
+        TirageInstantanes(bdd, dossier_journaux, verrou=serveur.verrou).demarrer(intervalle_tirage_classement)
+    print("Écrivain des votes en écoute sur %s" % arguments.adresse)
+    serveur.servir()
@@ -1,3 +1,5 @@
+import time
+
 from elo import CalculateurElo
 
 
@@ -12,11 +14,16 @@ def appliquer_resultat_match(bdd, id_match_en_cours, choix):
     :param bdd: objet base de données (type BDD du fichier `bdd.py`)
     :param id_match_en_cours: identifiant du match en cours (int)
     :param choix: choix fait par l'utilisateur (int, 1 ou 2)
-    :return: None
+    :return: dictionnaire contenant les informations du match ajouté (clés : celles de BDD.ajouter_match ainsi que
+    id (int)), ou None si le résultat du match est incorrect
     """
 
     # On récupère toutes les infos
     match_en_cours = bdd.match_en_cours(id_match_en_cours)
+    # Le match en cours n'existe plus s'il a déjà reçu un vote (par exemple si la page de vote est rechargée)
+    if match_en_cours is None:
+        print("Match en cours inconnu ou déjà joué !")
+        return None
     id_gagnant = match_en_cours["id_personnage1"] if choix == 1 else match_en_cours["id_personnage2"]
     id_perdant = match_en_cours["id_personnage1"] if choix == 2 else match_en_cours["id_personnage2"]
     gagnant = bdd.personnage(id_gagnant)
@@ -25,7 +32,7 @@ def appliquer_resultat_match(bdd, id_match_en_cours, choix):
     # Si le perdant ou le gagnant n'a pas pu être trouvé avec son ID, il y a une erreur
     if gagnant is None or perdant is None:
         print("Résultat de match incorrect !")
-        return
+        return None
 
     # On garde en mémoire l'ancien score des personnages et on calcule leur nouveau score
     ancien_score_gagnant = gagnant["score"]
@@ -40,14 +47,16 @@ def appliquer_resultat_match(bdd, id_match_en_cours, choix):
     bdd.changer_score_personnage(id_gagnant, nouveau_score_gagnant)
     bdd.changer_score_personnage(id_perdant, nouveau_score_perdant)
 
-    bdd.ajouter_match({
+    infos_match = {
         "id_gagnant":            id_gagnant,
         "id_perdant":            id_perdant,
         "ancien_score_gagnant":  ancien_score_gagnant,
         "ancien_score_perdant":  ancien_score_perdant,
         "nouveau_score_gagnant": nouveau_score_gagnant,
-        "nouveau_score_perdant": nouveau_score_perdant
-    })
+        "nouveau_score_perdant": nouveau_score_perdant,
+        "date":                  time.time()
+    }
+    infos_match["id"] = bdd.ajouter_match(infos_match)
 
     bdd.supprimer_match_en_cours(id_match_en_cours)
 
@@ -62,25 +71,33 @@ def appliquer_resultat_match(bdd, id_match_en_cours, choix):
            ancien_score_perdant,
            nouveau_score_perdant))
 
+    return infos_match
+
 
-def creer_nouveau_match_en_cours(bdd):
+def creer_nouveau_match_en_cours(bdd, graphe=None):
     """
     Crée un nouveau match en cours entre deux personnages aléatoires et renvoie les informations du nouveau match en
     cours.
 
     :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param graphe: graphe des relations (type GrapheRelations du fichier `graphe_personnages.py`) pour opposer le
+    premier personnage à l'un de ses proches (mode « rival »), ou None pour un second personnage aléatoire
     :return: 3-uplet (id_nouveau_match_en_cours : int, personnage1 : dictionnaire (valeur de retour de BDD.personnage),
     personnage2 : dictionnaire (valeur de retour de BDD.personnage))
     """
 
-    from random import randint
+    import random
 
     nb_personnages = bdd.nombre_personnages()
 
-    id_personnage1 = randint(1, nb_personnages)
-    id_personnage2 = randint(1, nb_personnages-1)
-    if id_personnage2 == id_personnage1:
-        id_personnage2 = nb_personnages
+    id_personnage1 = random.randint(1, nb_personnages)
+    # Mode rival : le voisin est tiré en proportion des mentions, en O(degré) ; un personnage sans relation connue
+    # affronte un personnage aléatoire
+    id_personnage2 = graphe.tirer_voisin(id_personnage1, random) if graphe is not None else None
+    if id_personnage2 is None or not 1 <= id_personnage2 <= nb_personnages:
+        id_personnage2 = random.randint(1, nb_personnages-1)
+        if id_personnage2 == id_personnage1:
+            id_personnage2 = nb_personnages
 
     personnage1 = bdd.personnage(id_personnage1)
     personnage2 = bdd.personnage(id_personnage2)
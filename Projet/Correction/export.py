@@ -0,0 +1,228 @@
+import csv
+import io
+import json
+import zlib
+
+
+# Colonnes des exports de matchs, dans l'ordre
+colonnes_export_matchs = ("id", "id_gagnant", "id_perdant", "ancien_score_gagnant", "ancien_score_perdant",
+                          "nouveau_score_gagnant", "nouveau_score_perdant", "date", "nom_gagnant", "nom_perdant")
+# Colonnes de l'export du classement, dans l'ordre
+colonnes_export_classement = ("rang", "id", "nom", "acteur", "url_image", "score")
+
+
+def _parcourir_lots(bdd, requete, parametres, taille_lot):
+    """
+    Exécute une requête sur une connexion de lecture dédiée et renvoie les lignes par lots. La connexion est fermée
+    quand le parcours se termine ou est interrompu (client déconnecté). La base étant en mode WAL (voir BDD), la
+    transaction de lecture, ouverte pendant tout l'export, ne bloque pas les votes : l'export contient les données
+    telles qu'elles étaient à son début.
+
+    :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param requete: requête SQL (str)
+    :param parametres: paramètres de la requête (tuple)
+    :param taille_lot: nombre de lignes par lot (int)
+    :return: générateur de listes de tuples
+    """
+
+    connexion, connexion_dediee = bdd.ouvrir_connexion_lecture()
+    try:
+        curseur = connexion.cursor()
+        curseur.execute(requete, parametres)
+        lot = curseur.fetchmany(taille_lot)
+        while lot:
+            yield lot
+            lot = curseur.fetchmany(taille_lot)
+    finally:
+        if connexion_dediee:
+            connexion.close()
+
+
+def _lots_matchs(bdd, id_min, id_max, taille_lot):
+    """
+    Parcourt les matchs par ordre croissant d'identifiant, éventuellement restreints à un intervalle d'identifiants
+    (ce qui permet de ne récupérer que les nouveaux matchs depuis un export précédent).
+
+    :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param id_min: identifiant minimum inclus (int ou None)
+    :param id_max: identifiant maximum inclus (int ou None)
+    :param taille_lot: nombre de matchs par lot (int)
+    :return: générateur de listes de tuples (colonnes : `colonnes_export_matchs`)
+    """
+
+    return _parcourir_lots(bdd,
+                           '''SELECT matchs.id, matchs.id_gagnant, matchs.id_perdant, matchs.ancien_score_gagnant,
+                                     matchs.ancien_score_perdant, matchs.nouveau_score_gagnant,
+                                     matchs.nouveau_score_perdant, matchs.date, p1.nom, p2.nom
+                              FROM %s AS matchs
+                              JOIN personnages as p1
+                              ON p1.id = matchs.id_gagnant
+                              JOIN personnages as p2
+                              ON p2.id = matchs.id_perdant
+                              WHERE matchs.id >= ? AND matchs.id <= ?
+                              ORDER BY matchs.id''' % bdd.table_matchs,
+                           (id_min if id_min is not None else 0, id_max if id_max is not None else 2 ** 63 - 1),
+                           taille_lot)
+
+
+def exporter_matchs_csv(bdd, id_min=None, id_max=None, taille_lot=1000):
+    """
+    Exporte les matchs au format CSV (avec ligne d'en-tête), morceau par morceau.
+
+    :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param id_min: identifiant minimum inclus (int ou None)
+    :param id_max: identifiant maximum inclus (int ou None)
+    :param taille_lot: nombre de matchs par morceau (int)
+    :return: générateur de chaînes de caractères
+    """
+
+    tampon = io.StringIO()
+    ecrivain = csv.writer(tampon)
+    ecrivain.writerow(colonnes_export_matchs)
+    for lot in _lots_matchs(bdd, id_min, id_max, taille_lot):
+        ecrivain.writerows(lot)
+        yield tampon.getvalue()
+        tampon.seek(0)
+        tampon.truncate()
+    if tampon.tell():
+        yield tampon.getvalue()
+
+
+def exporter_matchs_jsonl(bdd, id_min=None, id_max=None, taille_lot=1000):
+    """
+    Exporte les matchs au format JSON lines (un objet JSON par ligne), morceau par morceau.
+
+    :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param id_min: identifiant minimum inclus (int ou None)
+    :param id_max: identifiant maximum inclus (int ou None)
+    :param taille_lot: nombre de matchs par morceau (int)
+    :return: générateur de chaînes de caractères
+    """
+
+    for lot in _lots_matchs(bdd, id_min, id_max, taille_lot):
+        yield "".join(json.dumps(dict(zip(colonnes_export_matchs, ligne)), ensure_ascii=False) + "\n"
+                      for ligne in lot)
+
+
+def exporter_classement_json(bdd, taille_lot=1000):
+    """
+    Exporte le classement de tous les personnages sous forme d'un tableau JSON d'objets, morceau par morceau.
+
+    :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param taille_lot: nombre de personnages par morceau (int)
+    :return: générateur de chaînes de caractères
+    """
+
+    yield "["
+    rang = 0
+    for lot in _parcourir_lots(bdd,
+                               '''SELECT id, nom, acteur, url_image, score
+                                  FROM personnages
+                                  ORDER BY score DESC''',
+                               (),
+                               taille_lot):
+        morceaux = []
+        for ligne in lot:
+            rang += 1
+            morceaux.append(("," if rang > 1 else "") + "\n" +
+                            json.dumps(dict(zip(colonnes_export_classement, (rang,) + ligne)), ensure_ascii=False))
+        yield "".join(morceaux)
+    yield "\n]\n"
+
+
+def compresser_gzip(morceaux, niveau=6):
+    """
+    Compresse au format gzip un flux de morceaux de texte, au fur et à mesure.
+
+    :param morceaux: itérable de chaînes de caractères
+    :param niveau: niveau de compression, de 1 (rapide) à 9 (compact) (int)
+    :return: générateur d'octets (bytes)
+    """
+
+    compresseur = zlib.compressobj(niveau, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for morceau in morceaux:
+        donnees = compresseur.compress(morceau.encode("utf-8"))
+        if donnees:
+            yield donnees
+    yield compresseur.flush()
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestExport:
+    @staticmethod
+    def _bdd_test(nom):
+        import os
+        from bdd import BDD
+        fichier_bdd_test = "test/%s.db" % nom
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        bdd = BDD(fichier_bdd_test)
+        bdd.ajouter_personnages([
+            {"nom": "Arya, la \"petite\"", "url_image": "a.jpg", "acteur": "Maisie Williams", "score": 1400},
+            {"nom": "Bran", "url_image": "b.jpg", "acteur": None, "score": 1500}
+        ])
+        for numero in range(5):
+            bdd.ajouter_match({
+                "id_gagnant": 1 + numero % 2,
+                "id_perdant": 2 - numero % 2,
+                "ancien_score_gagnant": 1400,
+                "ancien_score_perdant": 1400,
+                "nouveau_score_gagnant": 1416,
+                "nouveau_score_perdant": 1384,
+                "date": 1000.0 + numero
+            })
+        return bdd, fichier_bdd_test
+
+    def test_exporter_matchs(self):
+        import os
+        bdd, fichier_bdd_test = self._bdd_test("test_export_matchs")
+
+        lignes_csv = list(csv.reader(io.StringIO("".join(exporter_matchs_csv(bdd, taille_lot=2)))))
+        assert lignes_csv[0] == list(colonnes_export_matchs)
+        assert [ligne[0] for ligne in lignes_csv[1:]] == ["1", "2", "3", "4", "5"]
+        assert lignes_csv[1][8] == "Arya, la \"petite\""
+
+        lignes_json = "".join(exporter_matchs_jsonl(bdd, id_min=2, id_max=4, taille_lot=2)).splitlines()
+        matchs_json = [json.loads(ligne) for ligne in lignes_json]
+        assert [match["id"] for match in matchs_json] == [2, 3, 4]
+        assert matchs_json[0]["nom_gagnant"] == "Bran"
+        assert matchs_json[0]["date"] == 1001.0
+
+        assert "".join(exporter_matchs_csv(bdd, id_min=10)) == ",".join(colonnes_export_matchs) + "\r\n"
+
+        # Un vote écrit pendant un export n'est pas bloqué, et l'export garde les données de son début
+        bdd.connexion.execute("PRAGMA busy_timeout = 100")
+        export = exporter_matchs_csv(bdd, taille_lot=1)
+        morceaux = [next(export), next(export)]
+        bdd.ajouter_match({"id_gagnant": 1, "id_perdant": 2, "ancien_score_gagnant": 1400,
+                           "ancien_score_perdant": 1400, "nouveau_score_gagnant": 1416, "nouveau_score_perdant": 1384})
+        morceaux.extend(export)
+        assert len(list(csv.reader(io.StringIO("".join(morceaux))))) == 1 + 5
+        assert len(bdd.matchs()) == 6
+
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+
+    def test_exporter_classement_et_compresser(self):
+        import os
+        import gzip
+        bdd, fichier_bdd_test = self._bdd_test("test_export_classement")
+
+        classement = json.loads("".join(exporter_classement_json(bdd, taille_lot=1)))
+        assert [(personnage["rang"], personnage["nom"]) for personnage in classement] == [(1, "Bran"),
+                                                                                          (2, "Arya, la \"petite\"")]
+
+        donnees = b"".join(compresser_gzip(exporter_classement_json(bdd)))
+        assert json.loads(gzip.decompress(donnees)) == classement
+
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["export.py"])
@@ -0,0 +1,209 @@
+import glob
+import hashlib
+import os
+
+import numpy
+
+from metadonnees import MetadonneesPersonnages
+
+
+class GrapheRelations:
+    """
+    Graphe des relations entre personnages au format CSR (compressed sparse row) : les voisins du personnage d'id i
+    sont indices[indptr[i]:indptr[i + 1]], avec leur nombre de mentions dans poids aux mêmes positions. Accéder aux
+    voisins d'un personnage ne coûte qu'une tranche de tableau, sans jointure SQL.
+
+    Le graphe est non orienté : le poids d'une arête est la somme des mentions dans les deux sens. Il est enregistré
+    dans des fichiers .npy relus par projection en mémoire (mmap) : tous les processus web partagent les mêmes pages
+    et le démarrage ne dépend pas de la taille du graphe.
+    """
+
+    def __init__(self, indptr, indices, poids):
+        """
+        Crée un graphe à partir de ses tableaux CSR.
+
+        :param indptr: début des voisins de chaque personnage, indicé par l'id du personnage, plus la fin du dernier
+        (numpy.ndarray d'int64, de taille id maximum + 2)
+        :param indices: identifiants des voisins (numpy.ndarray d'int32)
+        :param poids: nombre de mentions de chaque arête (numpy.ndarray de float32)
+        """
+
+        self.indptr = indptr
+        self.indices = indices
+        self.poids = poids
+
+    @classmethod
+    def construire(cls, relations, id_max=0):
+        """
+        Construit le graphe à partir d'une liste de relations orientées (les doublons sont additionnés).
+
+        :param relations: liste de 3-uplets (id_personnage, id_relation, mentions)
+        :param id_max: identifiant de personnage maximum, pour que le graphe couvre aussi les personnages sans relation
+        (int)
+        :return: graphe (type GrapheRelations)
+        """
+
+        tableau = numpy.array(relations, dtype=numpy.int64).reshape(-1, 3)
+        # Symétrisation : chaque relation est ajoutée dans les deux sens
+        sources = numpy.concatenate((tableau[:, 0], tableau[:, 1]))
+        destinations = numpy.concatenate((tableau[:, 1], tableau[:, 0]))
+        mentions = numpy.concatenate((tableau[:, 2], tableau[:, 2])).astype(numpy.float32)
+
+        ordre = numpy.lexsort((destinations, sources))
+        sources, destinations, mentions = sources[ordre], destinations[ordre], mentions[ordre]
+        # Fusion des arêtes en double (relation citée dans les deux sens)
+        debuts = numpy.flatnonzero(numpy.r_[True, (sources[1:] != sources[:-1]) |
+                                            (destinations[1:] != destinations[:-1])]) if len(sources) else \
+            numpy.zeros(0, dtype=numpy.int64)
+        sources = sources[debuts]
+        indices = destinations[debuts].astype(numpy.int32)
+        poids = numpy.add.reduceat(mentions, debuts) if len(debuts) else numpy.zeros(0, dtype=numpy.float32)
+
+        nb_sommets = max(id_max, int(sources.max()) if len(sources) else 0) + 1
+        indptr = numpy.zeros(nb_sommets + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(sources, minlength=nb_sommets), out=indptr[1:])
+        return cls(indptr, indices, poids.astype(numpy.float32))
+
+    @staticmethod
+    def _chemins(dossier, signature):
+        """
+        Renvoie les chemins des fichiers du graphe construit à partir de relations de signature donnée.
+
+        :param dossier: dossier des fichiers du graphe (str)
+        :param signature: signature des relations (voir MetadonneesPersonnages.signature_relations)
+        :return: dictionnaire nom du tableau -> chemin (str)
+        """
+
+        empreinte = hashlib.sha1(repr(signature).encode("utf-8")).hexdigest()[:12]
+        return {nom: os.path.join(dossier, "relations-%s-%s.npy" % (empreinte, nom))
+                for nom in ("indptr", "indices", "poids")}
+
+    def enregistrer(self, chemins):
+        """
+        Enregistre les tableaux du graphe, chacun sous un nom temporaire puis renommé.
+
+        :param chemins: dictionnaire nom du tableau -> chemin (voir _chemins)
+        :return: None
+        """
+
+        for nom, chemin in chemins.items():
+            chemin_temporaire = "%s.%d.tmp" % (chemin, os.getpid())
+            with open(chemin_temporaire, "wb") as fichier:
+                numpy.save(fichier, getattr(self, nom))
+            os.replace(chemin_temporaire, chemin)
+
+    @classmethod
+    def charger(cls, bdd, dossier):
+        """
+        Charge le graphe des relations de la base de données par projection en mémoire, en le construisant et en
+        l'enregistrant d'abord si les fichiers n'existent pas pour le contenu actuel de la table des relations. Les
+        fichiers des graphes précédents sont alors supprimés (un processus qui les projette déjà en mémoire continue de
+        les lire).
+
+        :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+        :param dossier: dossier des fichiers du graphe, créé si besoin (str)
+        :return: graphe (type GrapheRelations)
+        """
+
+        metadonnees = MetadonneesPersonnages(bdd)
+        id_max = bdd.connexion.execute("SELECT COALESCE(MAX(id), 0) FROM personnages").fetchone()[0]
+        chemins = cls._chemins(dossier, metadonnees.signature_relations() + (id_max,))
+        if not all(os.path.exists(chemin) for chemin in chemins.values()):
+            os.makedirs(dossier, exist_ok=True)
+            cls.construire(metadonnees.relations(), id_max).enregistrer(chemins)
+            for chemin in glob.glob(os.path.join(glob.escape(dossier), "relations-*.npy")):
+                if chemin not in chemins.values():
+                    os.remove(chemin)
+        return cls(*[numpy.load(chemins[nom], mmap_mode="r") for nom in ("indptr", "indices", "poids")])
+
+    def voisins(self, id_personnage):
+        """
+        Renvoie les voisins d'un personnage.
+
+        :param id_personnage: identifiant du personnage (int)
+        :return: 2-uplet (identifiants des voisins, nombres de mentions) (tableaux numpy, à ne pas modifier)
+        """
+
+        if not 0 <= id_personnage < len(self.indptr) - 1:
+            return self.indices[:0], self.poids[:0]
+        debut, fin = self.indptr[id_personnage], self.indptr[id_personnage + 1]
+        return self.indices[debut:fin], self.poids[debut:fin]
+
+    def tirer_voisin(self, id_personnage, generateur):
+        """
+        Tire un voisin d'un personnage, avec une probabilité proportionnelle au nombre de mentions, en O(degré).
+
+        :param id_personnage: identifiant du personnage (int)
+        :param generateur: générateur de nombres aléatoires (random.Random ou module random)
+        :return: identifiant du voisin (int), ou None si le personnage n'a aucune relation
+        """
+
+        indices, poids = self.voisins(id_personnage)
+        if len(indices) == 0:
+            return None
+        cumul = numpy.cumsum(poids)
+        position = int(numpy.searchsorted(cumul, generateur.random() * cumul[-1], side="right"))
+        return int(indices[min(position, len(indices) - 1)])
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestGraphePersonnages:
+    def test_construire(self):
+        import random
+        graphe = GrapheRelations.construire([(1, 2, 5), (2, 1, 3), (1, 3, 1), (4, 1, 2)], id_max=5)
+        assert list(graphe.indptr) == [0, 0, 3, 4, 5, 6, 6]
+        assert list(graphe.voisins(1)[0]) == [2, 3, 4]
+        assert list(graphe.voisins(1)[1]) == [8, 1, 2]
+        assert list(graphe.voisins(3)[0]) == [1]
+        assert len(graphe.voisins(5)[0]) == 0
+        assert len(graphe.voisins(100)[0]) == 0
+
+        # Les voisins sont tirés en proportion de leurs mentions
+        generateur = random.Random(1)
+        tirages = [graphe.tirer_voisin(1, generateur) for _ in range(11000)]
+        assert set(tirages) == {2, 3, 4}
+        assert 7000 < tirages.count(2) < 9000
+        assert graphe.tirer_voisin(5, generateur) is None
+        assert len(GrapheRelations.construire([]).indices) == 0
+
+    def test_charger(self):
+        import json
+        import shutil
+        from bdd import BDD
+        from initialisation_bdd import simplifier_infos_personnages
+        dossier_test = "test/test_graphe_personnages"
+        shutil.rmtree(dossier_test, ignore_errors=True)
+
+        with open("../API_backup/characters_backup.json", encoding="utf-8") as fichier:
+            infos_personnages = simplifier_infos_personnages(json.load(fichier), 60)
+        bdd = BDD(":memory:")
+        bdd.ajouter_personnages([dict(infos, score=1400) for infos in infos_personnages])
+        MetadonneesPersonnages(bdd).enregistrer(infos_personnages)
+
+        graphe = GrapheRelations.charger(bdd, dossier_test)
+        assert isinstance(graphe.indices, numpy.memmap)
+        assert len(os.listdir(dossier_test)) == 3
+        id_jon = bdd.connexion.execute("SELECT id FROM personnages WHERE nom = 'Jon Snow'").fetchone()[0]
+        id_sam = bdd.connexion.execute("SELECT id FROM personnages WHERE nom = 'Samwell Tarly'").fetchone()[0]
+        assert id_sam in graphe.voisins(id_jon)[0]
+        assert id_jon in graphe.voisins(id_sam)[0]
+
+        # Relu sans être reconstruit, puis reconstruit quand les relations changent : les anciens fichiers sont
+        # supprimés, mais le graphe déjà projeté en mémoire reste lisible
+        assert list(GrapheRelations.charger(bdd, dossier_test).indptr) == list(graphe.indptr)
+        MetadonneesPersonnages(bdd).enregistrer([dict(infos_personnages[0], relations=[])])
+        GrapheRelations.charger(bdd, dossier_test)
+        assert len(os.listdir(dossier_test)) == 3
+        assert id_sam in graphe.voisins(id_jon)[0]
+
+        bdd.fermer()
+        shutil.rmtree(dossier_test)
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["graphe_personnages.py"])
@@ -0,0 +1,299 @@
+import threading
+
+
+class HistoriqueScores:
+    """
+    Classe stockant l'évolution du score de chaque personnage sous une forme compacte : les matchs sont regroupés dans
+    des seaux de taille fixe (en durée ou en nombre de matchs) qui ne conservent que le score minimum, le score maximum
+    et le dernier score atteint. Tracer une année d'historique ne demande ainsi de lire que quelques centaines de
+    lignes, quel que soit le nombre de matchs joués.
+
+    Les seaux sont stockés dans la même base de données que les matchs et sont alimentés uniquement à partir de la
+    table des matchs, ce qui permet de reprendre un historique existant et de rester cohérent après un redémarrage.
+    """
+
+    def __init__(self, bdd, type_seau="temps", taille_seau=3600):
+        """
+        Crée les tables nécessaires au stockage de l'historique si elles n'existent pas déjà. Avec une base de données
+        ouverte en lecture seule, les tables doivent déjà avoir été créées par un autre processus, qui se charge aussi
+        du rattrapage.
+
+        :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+        :param type_seau: "temps" pour des seaux de durée fixe (les matchs sans date sont alors ignorés) ou "matchs"
+        pour des seaux contenant un nombre fixe de matchs consécutifs (str)
+        :param taille_seau: durée d'un seau en secondes ou nombre de matchs par seau selon le type de seau (int)
+        """
+
+        assert type_seau in ("temps", "matchs")
+        assert taille_seau > 0
+        self.bdd = bdd
+        self.type_seau = type_seau
+        self.taille_seau = taille_seau
+        self._verrou = threading.Lock()
+
+        if bdd.lecture_seule:
+            return
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''CREATE TABLE IF NOT EXISTS historique_scores (
+                               type_seau      TEXT NOT NULL,
+                               taille_seau    INTEGER NOT NULL,
+                               id_personnage  INTEGER NOT NULL,
+                               debut_seau     INTEGER NOT NULL,
+                               score_min      REAL NOT NULL,
+                               score_max      REAL NOT NULL,
+                               score_dernier  REAL NOT NULL,
+                               nb_matchs      INTEGER NOT NULL,
+                               PRIMARY KEY (type_seau, taille_seau, id_personnage, debut_seau)
+                           ) WITHOUT ROWID''')
+        curseur.execute('''CREATE TABLE IF NOT EXISTS historique_scores_etat (
+                               type_seau        TEXT NOT NULL,
+                               taille_seau      INTEGER NOT NULL,
+                               dernier_id_match INTEGER NOT NULL,
+                               PRIMARY KEY (type_seau, taille_seau)
+                           )''')
+        curseur.execute('''INSERT OR IGNORE INTO historique_scores_etat (type_seau, taille_seau, dernier_id_match)
+                           VALUES (?, ?, 0)''',
+                        (self.type_seau, self.taille_seau))
+        self.bdd.connexion.commit()
+
+    def _debut_seau(self, id_match, date):
+        """
+        Calcule le début du seau dans lequel est rangé un match.
+
+        :param id_match: identifiant du match (int)
+        :param date: horodatage UNIX du match (float ou None)
+        :return: début du seau (int), ou None si le match ne peut pas être rangé (match sans date)
+        """
+
+        if self.type_seau == "matchs":
+            return id_match // self.taille_seau * self.taille_seau
+        if date is None:
+            return None
+        return int(date // self.taille_seau) * self.taille_seau
+
+    def dernier_id_match(self):
+        """
+        Renvoie l'identifiant du dernier match pris en compte dans l'historique.
+
+        :return: identifiant du match (int), 0 si aucun match n'a encore été pris en compte
+        """
+
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''SELECT dernier_id_match
+                           FROM historique_scores_etat
+                           WHERE type_seau = ? AND taille_seau = ?''',
+                        (self.type_seau, self.taille_seau))
+        return curseur.fetchone()[0]
+
+    def rattraper(self, taille_lot=10000):
+        """
+        Ajoute à l'historique tous les matchs qui n'y ont pas encore été pris en compte. Les matchs sont lus par lots
+        dans l'ordre des identifiants et chaque lot est agrégé en mémoire puis enregistré dans sa propre transaction :
+        la mémoire utilisée ne dépend pas du nombre total de matchs et un rattrapage interrompu reprend là où il s'était
+        arrêté.
+
+        :param taille_lot: nombre de matchs lus et enregistrés à la fois (int)
+        :return: nombre de matchs pris en compte (int)
+        """
+
+        with self._verrou:
+            dernier_id_match = self.dernier_id_match()
+            curseur_lecture = self.bdd.connexion.cursor()
+            curseur_lecture.execute('''SELECT id, id_gagnant, id_perdant, ancien_score_gagnant, ancien_score_perdant,
+                                              nouveau_score_gagnant, nouveau_score_perdant, date
+                                       FROM %s
+                                       WHERE id > ?
+                                       ORDER BY id''' % self.bdd.table_matchs,
+                                    (dernier_id_match,))
+            nb_matchs = 0
+            lot = curseur_lecture.fetchmany(taille_lot)
+            while lot:
+                # Agrégation du lot : (id_personnage, debut_seau) -> [score_min, score_max, score_dernier, nb_matchs]
+                seaux = {}
+                for (id_match, id_gagnant, id_perdant, ancien_score_gagnant, ancien_score_perdant,
+                     nouveau_score_gagnant, nouveau_score_perdant, date) in lot:
+                    debut_seau = self._debut_seau(id_match, date)
+                    if debut_seau is None:
+                        continue
+                    for id_personnage, ancien_score, nouveau_score in ((id_gagnant, ancien_score_gagnant,
+                                                                        nouveau_score_gagnant),
+                                                                       (id_perdant, ancien_score_perdant,
+                                                                        nouveau_score_perdant)):
+                        seau = seaux.get((id_personnage, debut_seau))
+                        if seau is None:
+                            seaux[(id_personnage, debut_seau)] = [min(ancien_score, nouveau_score),
+                                                                  max(ancien_score, nouveau_score),
+                                                                  nouveau_score, 1]
+                        else:
+                            seau[0] = min(seau[0], ancien_score, nouveau_score)
+                            seau[1] = max(seau[1], ancien_score, nouveau_score)
+                            seau[2] = nouveau_score
+                            seau[3] += 1
+
+                curseur_ecriture = self.bdd.connexion.cursor()
+                curseur_ecriture.executemany('''INSERT INTO historique_scores (type_seau, taille_seau, id_personnage,
+                                                                               debut_seau, score_min, score_max,
+                                                                               score_dernier, nb_matchs)
+                                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                                ON CONFLICT (type_seau, taille_seau, id_personnage, debut_seau)
+                                                DO UPDATE SET score_min = min(score_min, excluded.score_min),
+                                                              score_max = max(score_max, excluded.score_max),
+                                                              score_dernier = excluded.score_dernier,
+                                                              nb_matchs = nb_matchs + excluded.nb_matchs''',
+                                             [(self.type_seau, self.taille_seau, id_personnage, debut_seau) +
+                                              tuple(seau)
+                                              for (id_personnage, debut_seau), seau in seaux.items()])
+                curseur_ecriture.execute('''UPDATE historique_scores_etat
+                                            SET dernier_id_match = ?
+                                            WHERE type_seau = ? AND taille_seau = ?''',
+                                         (lot[-1][0], self.type_seau, self.taille_seau))
+                self.bdd.connexion.commit()
+
+                nb_matchs += len(lot)
+                lot = curseur_lecture.fetchmany(taille_lot)
+
+            return nb_matchs
+
+    def revenir_avant(self, id_match):
+        """
+        Supprime de l'historique les seaux qui contiennent le match donné ou des matchs suivants, pour qu'ils soient
+        recalculés par le prochain rattrapage (par exemple après la réécriture des scores de ces matchs, voir
+        `annulation_votes.py`). Pour des seaux de durée fixe, les dates des matchs sont supposées croissantes avec leurs
+        identifiants.
+
+        :param id_match: identifiant du premier match modifié (int)
+        :return: None
+        """
+
+        with self._verrou:
+            curseur = self.bdd.connexion.cursor()
+            if self.type_seau == "matchs":
+                debut_seau = self._debut_seau(id_match, None)
+                dernier_id_match = debut_seau - 1
+            else:
+                curseur.execute("SELECT MIN(date) FROM %s WHERE id >= ?" % self.bdd.table_matchs, (id_match,))
+                date = curseur.fetchone()[0]
+                if date is None:
+                    return
+                debut_seau = self._debut_seau(id_match, date)
+                curseur.execute("SELECT MIN(id) FROM %s WHERE date >= ?" % self.bdd.table_matchs, (debut_seau,))
+                dernier_id_match = min(curseur.fetchone()[0], id_match) - 1
+            curseur.execute('''DELETE FROM historique_scores
+                               WHERE type_seau = ? AND taille_seau = ? AND debut_seau >= ?''',
+                            (self.type_seau, self.taille_seau, debut_seau))
+            curseur.execute('''UPDATE historique_scores_etat
+                               SET dernier_id_match = min(dernier_id_match, ?)
+                               WHERE type_seau = ? AND taille_seau = ?''',
+                            (dernier_id_match, self.type_seau, self.taille_seau))
+            self.bdd.connexion.commit()
+
+    def points(self, id_personnage, nb_points_max=500):
+        """
+        Renvoie l'historique du score d'un personnage, par ordre chronologique. Si l'historique contient plus de seaux
+        que le nombre de points demandé, les seaux consécutifs sont fusionnés.
+
+        :param id_personnage: identifiant du personnage (int)
+        :param nb_points_max: nombre maximum de points renvoyés (int)
+        :return: liste de dictionnaires (clés : debut (int), score_min (float), score_max (float),
+        score_dernier (float), nb_matchs (int))
+        """
+
+        assert nb_points_max > 0
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''SELECT debut_seau, score_min, score_max, score_dernier, nb_matchs
+                           FROM historique_scores
+                           WHERE type_seau = ? AND taille_seau = ? AND id_personnage = ?
+                           ORDER BY debut_seau''',
+                        (self.type_seau, self.taille_seau, id_personnage))
+        seaux = curseur.fetchall()
+
+        nb_seaux_par_point = max(1, -(-len(seaux) // nb_points_max))
+        points = []
+        for debut in range(0, len(seaux), nb_seaux_par_point):
+            groupe = seaux[debut:debut + nb_seaux_par_point]
+            points.append({
+                "debut":         groupe[0][0],
+                "score_min":     min(seau[1] for seau in groupe),
+                "score_max":     max(seau[2] for seau in groupe),
+                "score_dernier": groupe[-1][3],
+                "nb_matchs":     sum(seau[4] for seau in groupe)
+            })
+        return points
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestHistoriqueScores:
+    matchs = [
+        # (id_gagnant, id_perdant, ancien_score_gagnant, ancien_score_perdant, nouveau_score_gagnant,
+        #  nouveau_score_perdant, date)
+        (1, 2, 1400, 1400, 1416, 1384, 100.0),
+        (2, 1, 1384, 1416, 1402, 1398, 150.0),
+        (1, 2, 1398, 1402, 1414, 1386, 250.0),
+        (1, 2, 1414, 1386, 1428, 1372, 1000.0)
+    ]
+
+    @staticmethod
+    def _bdd_test(nom):
+        import os
+        from bdd import BDD
+        fichier_bdd_test = "test/%s.db" % nom
+        if os.path.exists(fichier_bdd_test):
+            os.remove(fichier_bdd_test)
+        bdd = BDD(fichier_bdd_test)
+        for nom_personnage in ("A", "B"):
+            bdd.ajouter_personnage({"nom": nom_personnage, "url_image": "", "acteur": None, "score": 1400})
+        return bdd, fichier_bdd_test
+
+    def _ajouter_matchs(self, bdd, matchs):
+        for match in matchs:
+            bdd.ajouter_match(dict(zip(("id_gagnant", "id_perdant", "ancien_score_gagnant", "ancien_score_perdant",
+                                        "nouveau_score_gagnant", "nouveau_score_perdant", "date"), match)))
+
+    def test_seaux_temps(self):
+        import os
+        bdd, fichier_bdd_test = self._bdd_test("test_historique_seaux_temps")
+        self._ajouter_matchs(bdd, self.matchs)
+
+        historique = HistoriqueScores(bdd, "temps", 200)
+        assert historique.rattraper(taille_lot=3) == 4
+        assert historique.rattraper() == 0
+        assert historique.points(1) == [
+            {"debut": 0, "score_min": 1398, "score_max": 1416, "score_dernier": 1398, "nb_matchs": 2},
+            {"debut": 200, "score_min": 1398, "score_max": 1414, "score_dernier": 1414, "nb_matchs": 1},
+            {"debut": 1000, "score_min": 1414, "score_max": 1428, "score_dernier": 1428, "nb_matchs": 1}
+        ]
+
+        # Le rattrapage incrémental donne le même résultat qu'un rattrapage complet
+        self._ajouter_matchs(bdd, [(2, 1, 1372, 1428, 1392, 1408, 1100.0)])
+        assert historique.rattraper() == 1
+        assert historique.points(2)[-1] == {"debut": 1000, "score_min": 1372, "score_max": 1392,
+                                            "score_dernier": 1392, "nb_matchs": 2}
+
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+
+    def test_seaux_matchs_et_sous_echantillonnage(self):
+        import os
+        bdd, fichier_bdd_test = self._bdd_test("test_historique_seaux_matchs")
+        self._ajouter_matchs(bdd, self.matchs)
+
+        historique = HistoriqueScores(bdd, "matchs", 1)
+        historique.rattraper()
+        assert len(historique.points(1)) == 4
+        assert historique.points(1, nb_points_max=2) == [
+            {"debut": 1, "score_min": 1398, "score_max": 1416, "score_dernier": 1398, "nb_matchs": 2},
+            {"debut": 3, "score_min": 1398, "score_max": 1428, "score_dernier": 1428, "nb_matchs": 2}
+        ]
+        assert historique.points(3) == []
+
+        bdd.fermer()
+        os.remove(fichier_bdd_test)
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["historique_scores.py"])
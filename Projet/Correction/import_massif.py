@@ -0,0 +1,290 @@
+import csv
+import json
+import time
+
+
+# Colonnes acceptées pour chaque table et fonction de conversion des valeurs lues (les fichiers CSV ne contiennent que
+# des chaînes de caractères)
+colonnes_tables = {
+    "personnages": {
+        "id":        int,
+        "nom":       str,
+        "url_image": str,
+        "acteur":    str,
+        "score":     float
+    },
+    "matchs": {
+        "id":                    int,
+        "id_gagnant":            int,
+        "id_perdant":            int,
+        "ancien_score_gagnant":  float,
+        "ancien_score_perdant":  float,
+        "nouveau_score_gagnant": float,
+        "nouveau_score_perdant": float,
+        "date":                  float
+    }
+}
+
+# Réglages de SQLite utilisés pendant l'import : l'écriture n'est plus synchronisée avec le disque et le journal est
+# gardé en mémoire. Une coupure de courant pendant l'import peut alors corrompre la base, ces réglages ne doivent donc
+# jamais rester actifs en dehors d'un import.
+pragmas_import = {
+    "synchronous":  "OFF",
+    "journal_mode": "MEMORY",
+    "temp_store":   "MEMORY",
+    "cache_size":   "-262144"
+}
+
+
+def lire_lignes(chemin_fichier, format_fichier=None):
+    """
+    Lit un fichier CSV (avec une ligne d'en-tête) ou JSON lines (un objet JSON par ligne) au fur et à mesure, sans le
+    charger entièrement en mémoire.
+
+    :param chemin_fichier: chemin du fichier à lire (str)
+    :param format_fichier: "csv" ou "jsonl", déduit de l'extension du fichier par défaut (str)
+    :return: générateur de dictionnaires (clés : noms des colonnes)
+    """
+
+    if format_fichier is None:
+        format_fichier = "csv" if chemin_fichier.lower().endswith(".csv") else "jsonl"
+    assert format_fichier in ("csv", "jsonl")
+
+    with open(chemin_fichier, newline="", encoding="utf-8") as fichier:
+        if format_fichier == "csv":
+            yield from csv.DictReader(fichier)
+        else:
+            for ligne in fichier:
+                if ligne.strip():
+                    yield json.loads(ligne)
+
+
+def _lots(lignes, colonnes, conversions, taille_lot):
+    """
+    Regroupe des lignes en lots de tuples prêts à être insérés.
+
+    :param lignes: itérable de dictionnaires
+    :param colonnes: noms des colonnes à extraire, dans l'ordre (liste de str)
+    :param conversions: fonction de conversion de chaque colonne (liste de fonctions)
+    :param taille_lot: nombre de lignes par lot (int)
+    :return: générateur de listes de tuples
+    """
+
+    lot = []
+    for ligne in lignes:
+        valeurs = []
+        for colonne, conversion in zip(colonnes, conversions):
+            valeur = ligne.get(colonne)
+            valeurs.append(None if valeur is None or valeur == "" else conversion(valeur))
+        lot.append(tuple(valeurs))
+        if len(lot) == taille_lot:
+            yield lot
+            lot = []
+    if lot:
+        yield lot
+
+
+def importer(bdd, table, lignes, taille_lot=50000, afficher_progression=True):
+    """
+    Importe un grand nombre de lignes dans la table des personnages ou des matchs.
+
+    Pendant l'import, les réglages de sécurité de SQLite sont relâchés (voir `pragmas_import`), les index secondaires
+    de la table sont supprimés puis reconstruits à la fin, et les lignes sont insérées par lots, chaque lot dans sa
+    propre transaction. Les réglages et les index d'origine sont toujours rétablis, même si l'import échoue.
+
+    Les colonnes présentes dans la première ligne déterminent les colonnes importées, les colonnes inconnues sont
+    ignorées.
+
+    :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param table: "personnages" ou "matchs" (str)
+    :param lignes: itérable de dictionnaires (par exemple la valeur de retour de `lire_lignes`)
+    :param taille_lot: nombre de lignes insérées par transaction (int)
+    :param afficher_progression: si vrai, affiche le nombre de lignes importées et le débit après chaque lot (bool)
+    :return: nombre de lignes importées (int)
+    """
+
+    assert table in colonnes_tables
+    lignes = iter(lignes)
+    premiere_ligne = next(lignes, None)
+    if premiere_ligne is None:
+        return 0
+    colonnes = [colonne for colonne in colonnes_tables[table] if colonne in premiere_ligne]
+    conversions = [colonnes_tables[table][colonne] for colonne in colonnes]
+    requete = "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(colonnes), ", ".join("?" * len(colonnes)))
+
+    connexion = bdd.connexion
+    connexion.commit()
+    curseur = connexion.cursor()
+
+    # Sauvegarde des réglages et des index à rétablir à la fin de l'import
+    pragmas_origine = {}
+    for pragma in pragmas_import:
+        pragmas_origine[pragma] = curseur.execute("PRAGMA %s" % pragma).fetchone()[0]
+    curseur.execute('''SELECT name, sql
+                       FROM sqlite_master
+                       WHERE type = "index" AND tbl_name = ? AND sql IS NOT NULL''',
+                    (table,))
+    index_table = curseur.fetchall()
+
+    nb_lignes = 0
+    debut = time.perf_counter()
+    try:
+        for pragma, valeur in pragmas_import.items():
+            # Une base en mode WAL garde son journal : en sortir demanderait un accès exclusif à la base
+            if pragma == "journal_mode" and pragmas_origine[pragma].lower() == "wal":
+                continue
+            curseur.execute("PRAGMA %s = %s" % (pragma, valeur))
+        for nom_index, _ in index_table:
+            curseur.execute("DROP INDEX %s" % nom_index)
+        connexion.commit()
+
+        for lot in _lots(_chainer(premiere_ligne, lignes), colonnes, conversions, taille_lot):
+            curseur.executemany(requete, lot)
+            connexion.commit()
+            nb_lignes += len(lot)
+            if afficher_progression:
+                duree = time.perf_counter() - debut
+                print("%s : %d lignes importées (%d lignes/s)" % (table, nb_lignes, nb_lignes / max(duree, 1e-9)))
+    finally:
+        connexion.rollback()
+        for _, sql_index in index_table:
+            curseur.execute(sql_index)
+        connexion.commit()
+        for pragma, valeur in pragmas_origine.items():
+            curseur.execute("PRAGMA %s = %s" % (pragma, valeur))
+
+    if afficher_progression:
+        duree = time.perf_counter() - debut
+        print("%s : import terminé, %d lignes en %.1f s (%d lignes/s, index compris)" %
+              (table, nb_lignes, duree, nb_lignes / max(duree, 1e-9)))
+    return nb_lignes
+
+
+def _chainer(premiere_ligne, lignes):
+    """
+    Remet la première ligne, déjà lue, devant les lignes restantes.
+
+    :param premiere_ligne: première ligne
+    :param lignes: itérateur des lignes suivantes
+    :return: générateur de toutes les lignes
+    """
+
+    yield premiere_ligne
+    yield from lignes
+
+
+def recalculer_scores(bdd, taille_lot=50000):
+    """
+    Donne à chaque personnage le score qu'il avait à l'issue de son dernier match. Utile après l'import de matchs
+    historiques, dont les scores ne sont pas reportés automatiquement sur les personnages. Les matchs sont parcourus
+    une seule fois, par ordre d'identifiant, sans être chargés entièrement en mémoire.
+
+    :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+    :param taille_lot: nombre de matchs lus à la fois (int)
+    :return: nombre de personnages dont le score a été mis à jour (int)
+    """
+
+    derniers_scores = {}
+    curseur = bdd.connexion.cursor()
+    curseur.execute('''SELECT id_gagnant, id_perdant, nouveau_score_gagnant, nouveau_score_perdant
+                       FROM %s
+                       ORDER BY id''' % bdd.table_matchs)
+    lot = curseur.fetchmany(taille_lot)
+    while lot:
+        for id_gagnant, id_perdant, nouveau_score_gagnant, nouveau_score_perdant in lot:
+            derniers_scores[id_gagnant] = nouveau_score_gagnant
+            derniers_scores[id_perdant] = nouveau_score_perdant
+        lot = curseur.fetchmany(taille_lot)
+
+    curseur.executemany('''UPDATE personnages
+                           SET score = ?
+                           WHERE id = ?''',
+                        [(score, id_personnage) for id_personnage, score in derniers_scores.items()])
+    bdd.connexion.commit()
+    return len(derniers_scores)
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestImportMassif:
+    def test_importer(self):
+        import os
+        from bdd import BDD
+        fichier_bdd_test = "test/test_import_massif.db"
+        fichier_personnages = "test/test_import_massif_personnages.csv"
+        fichier_matchs = "test/test_import_massif_matchs.jsonl"
+        for fichier in (fichier_bdd_test, fichier_personnages, fichier_matchs):
+            if os.path.exists(fichier):
+                os.remove(fichier)
+
+        with open(fichier_personnages, "w", newline="", encoding="utf-8") as fichier:
+            ecrivain = csv.writer(fichier)
+            ecrivain.writerow(["nom", "url_image", "acteur", "score", "colonne_inconnue"])
+            for numero in range(10):
+                ecrivain.writerow(["Personnage %d" % numero, "%d.jpg" % numero, "" if numero % 2 else "Acteur",
+                                   1400, "ignorée"])
+        with open(fichier_matchs, "w", encoding="utf-8") as fichier:
+            for numero in range(25):
+                fichier.write(json.dumps({
+                    "id_gagnant": numero % 10 + 1,
+                    "id_perdant": (numero + 1) % 10 + 1,
+                    "ancien_score_gagnant": 1400 + numero,
+                    "ancien_score_perdant": 1400 - numero,
+                    "nouveau_score_gagnant": 1401 + numero,
+                    "nouveau_score_perdant": 1399 - numero,
+                    "date": 1000.0 + numero
+                }) + "\n")
+
+        bdd = BDD(fichier_bdd_test)
+        curseur = bdd.connexion.cursor()
+        synchronous = curseur.execute("PRAGMA synchronous").fetchone()[0]
+        journal_mode = curseur.execute("PRAGMA journal_mode").fetchone()[0]
+
+        assert importer(bdd, "personnages", lire_lignes(fichier_personnages), taille_lot=3,
+                        afficher_progression=False) == 10
+        assert importer(bdd, "matchs", lire_lignes(fichier_matchs), taille_lot=7, afficher_progression=False) == 25
+        assert importer(bdd, "matchs", [], afficher_progression=False) == 0
+
+        assert bdd.nombre_personnages() == 10
+        assert bdd.personnage(2) == {"id": 2, "nom": "Personnage 1", "url_image": "1.jpg", "acteur": None,
+                                     "score": 1400}
+        assert len(bdd.matchs()) == 25
+        assert bdd.resultats_matchs_depuis(1024.0) == [(1024.0, 5, 6)]
+
+        # Les réglages et les index sont rétablis
+        assert curseur.execute("PRAGMA synchronous").fetchone()[0] == synchronous
+        assert curseur.execute("PRAGMA journal_mode").fetchone()[0] == journal_mode
+        curseur.execute('''SELECT name FROM sqlite_master WHERE type = "index" AND name = "index_matchs_date"''')
+        assert curseur.fetchone() is not None
+
+        assert recalculer_scores(bdd) == 10
+        assert bdd.personnage(5)["score"] == 1401 + 24
+
+        bdd.fermer()
+        for fichier in (fichier_bdd_test, fichier_personnages, fichier_matchs):
+            os.remove(fichier)
+
+
+if __name__ == "__main__":
+    import argparse
+    from bdd import BDD
+
+    analyseur = argparse.ArgumentParser(description="Import massif de personnages ou de matchs depuis un fichier CSV "
+                                                    "ou JSON lines.")
+    analyseur.add_argument("fichier_bdd", help="fichier de base de données SQLite 3")
+    analyseur.add_argument("table", choices=sorted(colonnes_tables), help="table dans laquelle importer les lignes")
+    analyseur.add_argument("fichier", help="fichier CSV (avec en-tête) ou JSON lines à importer")
+    analyseur.add_argument("--format", choices=("csv", "jsonl"), default=None,
+                           help="format du fichier (déduit de l'extension par défaut)")
+    analyseur.add_argument("--taille-lot", type=int, default=50000, help="nombre de lignes par transaction")
+    analyseur.add_argument("--recalculer-scores", action="store_true",
+                           help="après l'import, donne à chaque personnage le score de son dernier match")
+    arguments = analyseur.parse_args()
+
+    bdd = BDD(arguments.fichier_bdd)
+    importer(bdd, arguments.table, lire_lignes(arguments.fichier, arguments.format), arguments.taille_lot)
+    if arguments.recalculer_scores:
+        print("%d scores de personnages mis à jour" % recalculer_scores(bdd))
+    bdd.fermer()
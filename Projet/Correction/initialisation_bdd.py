@@ -1,35 +1,58 @@
 import urllib.request
 import json
 
+from metadonnees import MetadonneesPersonnages
 
-def recuperer_infos_personnages(nb_apparitions_min):
+
+def simplifier_infos_personnages(liste_personnages, nb_apparitions_min):
     """
-    Récupère les informations des personnages de la série en utilisant une API.
+    Simplifie la liste des personnages renvoyée par l'API : on ne garde que les personnages qui sont apparus un certain
+    nombre de fois, avec leur nom, leur acteur, une URL d'image et leurs métadonnées (voir `metadonnees.py`).
 
+    :param liste_personnages: liste des personnages au format de l'API (liste de dictionnaires)
     :param nb_apparitions_min: nombre d'apparition minimum pour qu'un personnage soit inclus dans la liste
-    :return: liste d'informations sur les personnages (dictionnaire, clés : nom (str), acteur (str), url_image (str))
+    :return: liste d'informations sur les personnages (dictionnaire, clés : nom (str), acteur (str), url_image (str),
+    maison (str ou None), cultures (liste de str), allegeances (liste de str), genre (str ou None), vivant (bool ou
+    None), nb_apparitions (int), relations (liste de 2-uplets (nom du personnage lié (str), nombre de mentions (int))))
     """
 
-    # Appelle l'API "api.got.show" pour obtenir la liste des personnages
-    api_url = "https://api.got.show/api/show/characters"
-    # api_url = "http://localhost/characters_backup.json"
-    liste_personnages = json.loads(urllib.request.urlopen(api_url).read())
-
-    # On simplifie la liste : on ne garde que les personnages qui sont
-    # apparus un certain nombre de fois, et on garde uniquement leur nom,
-    # leur acteur et une URL d'image
+    # On ne garde que les personnages qui sont apparus un certain nombre de fois
     ma_liste = []
     for personnage in liste_personnages:
         if len(personnage["appearances"]) >= nb_apparitions_min:
             ma_liste.append({
-                "nom":       personnage["name"],
-                "acteur":    personnage["actor"],
-                "url_image": personnage["image"]
+                "nom":            personnage["name"],
+                "acteur":         personnage.get("actor"),
+                "url_image":      personnage.get("image", ""),
+                "maison":         personnage.get("house"),
+                "cultures":       personnage.get("culture") or [],
+                "allegeances":    personnage.get("allegiances") or [],
+                "genre":          personnage.get("gender"),
+                "vivant":         personnage.get("alive"),
+                "nb_apparitions": len(personnage["appearances"]),
+                "relations":      [(relation["name"], relation.get("mentions", 1))
+                                   for relation in personnage.get("related", [])]
             })
 
     return ma_liste
 
 
+def recuperer_infos_personnages(nb_apparitions_min):
+    """
+    Récupère les informations des personnages de la série en utilisant une API.
+
+    :param nb_apparitions_min: nombre d'apparition minimum pour qu'un personnage soit inclus dans la liste
+    :return: liste d'informations sur les personnages (voir simplifier_infos_personnages)
+    """
+
+    # Appelle l'API "api.got.show" pour obtenir la liste des personnages
+    api_url = "https://api.got.show/api/show/characters"
+    # api_url = "http://localhost/characters_backup.json"
+    liste_personnages = json.loads(urllib.request.urlopen(api_url).read())
+
+    return simplifier_infos_personnages(liste_personnages, nb_apparitions_min)
+
+
 def remplir_bdd(bdd, score_initial, nb_apparitions_min):
     """
     Récupère les infos des personnages et les ajoute à la base de données si cette dernière est vide.
@@ -47,6 +70,7 @@ def remplir_bdd(bdd, score_initial, nb_apparitions_min):
             infos_perso["score"] = score_initial
 
         bdd.ajouter_personnages(infos_personnages)
+        MetadonneesPersonnages(bdd).enregistrer(infos_personnages)
 
         # On affiche dans la console du serveur le nombre de personnages ajoutés
         print("%d personnages ajoutés !" % len(infos_personnages))
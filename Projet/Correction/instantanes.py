@@ -0,0 +1,260 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+
+from bdd import BDD
+
+
+class Instantanes:
+    """
+    Jeux de données de test construits une seule fois puis clonés pour chaque test. Chaque jeu de données est décrit
+    par une fonction qui remplit une base vide ; au premier clonage, elle est exécutée sur une base en mémoire vive qui
+    sert ensuite de modèle. Un clone est une copie page par page du modèle (API de sauvegarde de SQLite, ou copie de
+    fichier), bien plus rapide que de refaire les insertions ligne par ligne.
+
+    Si un dossier est indiqué, les modèles y sont aussi enregistrés : les autres processus (tests lancés en parallèle,
+    lancements suivants) les relisent au lieu de les reconstruire. Chaque clone est indépendant, aucun état n'est
+    partagé entre les tests.
+    """
+
+    def __init__(self, dossier=None):
+        """
+        Initialise une collection de jeux de données vide.
+
+        :param dossier: dossier où enregistrer les modèles sur disque (str), ou None pour les garder en mémoire vive
+        seulement
+        """
+
+        self.dossier = dossier
+        # Nom -> (fonction de construction, version)
+        self._definitions = {}
+        # Nom -> connexion SQLite en mémoire vive contenant le modèle
+        self._modeles = {}
+        self._verrou = threading.Lock()
+        # Nombre de modèles construits par ce processus (les autres ayant été relus sur disque)
+        self.nb_constructions = 0
+        # Schéma d'une base vide, lu au premier enregistrement sur disque (voir _schema)
+        self._schema_bdd = None
+
+    def definir(self, nom, construire, version="1"):
+        """
+        Déclare un jeu de données.
+
+        :param nom: nom du jeu de données (str)
+        :param construire: fonction qui remplit un objet BDD vide passé en paramètre
+        :param version: version du jeu de données (str), à changer quand la fonction de construction change pour que
+        les modèles enregistrés sur disque soient reconstruits
+        :return: None
+        """
+
+        self._definitions[nom] = (construire, version)
+
+    def _schema(self):
+        """
+        Renvoie le schéma d'une base de données vide tout juste créée par BDD, pour que les modèles enregistrés avec un
+        ancien schéma (table ou colonne ajoutée à `bdd.py`) ne soient pas relus.
+
+        :return: instructions SQL de création des tables et des index, dans l'ordre de leur nom (str)
+        """
+
+        if self._schema_bdd is None:
+            bdd = BDD(":memory:")
+            lignes = bdd.connexion.execute('''SELECT sql
+                                              FROM sqlite_master
+                                              WHERE sql IS NOT NULL
+                                              ORDER BY name''')
+            self._schema_bdd = "\n".join(ligne[0] for ligne in lignes)
+            bdd.fermer()
+        return self._schema_bdd
+
+    def _chemin_modele(self, nom):
+        """
+        Renvoie le chemin du fichier où est enregistré le modèle d'un jeu de données. Le nom du fichier dépend de la
+        version du jeu de données et du schéma de la base de données.
+
+        :param nom: nom du jeu de données (str)
+        :return: chemin (str), ou None s'il n'y a pas de dossier d'enregistrement
+        """
+
+        if self.dossier is None:
+            return None
+        version = self._definitions[nom][1]
+        empreinte = hashlib.sha1(("%s\n%s" % (version, self._schema())).encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.dossier, "%s-%s.db" % (nom, empreinte))
+
+    def _modele(self, nom):
+        """
+        Renvoie le modèle d'un jeu de données, en le relisant sur disque ou en le construisant s'il n'est pas encore en
+        mémoire. Un modèle construit est enregistré sous un nom temporaire puis renommé : un autre processus ne peut
+        lire qu'un modèle complet, et si deux processus le construisent en même temps, l'un remplace simplement l'autre.
+
+        :param nom: nom du jeu de données (str)
+        :return: connexion SQLite en mémoire vive
+        """
+
+        with self._verrou:
+            if nom in self._modeles:
+                return self._modeles[nom]
+
+            modele = sqlite3.connect(":memory:", check_same_thread=False)
+            chemin_modele = self._chemin_modele(nom)
+            if chemin_modele is not None and os.path.exists(chemin_modele):
+                with sqlite3.connect(chemin_modele) as source:
+                    source.backup(modele)
+            else:
+                bdd = BDD(":memory:")
+                self._definitions[nom][0](bdd)
+                bdd.connexion.commit()
+                bdd.connexion.backup(modele)
+                bdd.fermer()
+                self.nb_constructions += 1
+                if chemin_modele is not None:
+                    os.makedirs(self.dossier, exist_ok=True)
+                    chemin_temporaire = "%s.%d.%d.tmp" % (chemin_modele, os.getpid(), threading.get_ident())
+                    destination = sqlite3.connect(chemin_temporaire)
+                    modele.backup(destination)
+                    destination.close()
+                    os.replace(chemin_temporaire, chemin_modele)
+
+            self._modeles[nom] = modele
+            return modele
+
+    def cloner(self, nom, chemin_fichier_bdd=":memory:"):
+        """
+        Crée une base de données contenant une copie d'un jeu de données.
+
+        :param nom: nom du jeu de données (str)
+        :param chemin_fichier_bdd: chemin du fichier de la copie (remplacé s'il existe), ou :memory: pour une copie en
+        mémoire vive (str)
+        :return: objet base de données (type BDD du fichier `bdd.py`)
+        """
+
+        modele = self._modele(nom)
+        if chemin_fichier_bdd == ":memory:":
+            bdd = BDD(":memory:")
+            with self._verrou:
+                modele.backup(bdd.connexion)
+            return bdd
+
+        for fichier in (chemin_fichier_bdd, chemin_fichier_bdd + "-wal", chemin_fichier_bdd + "-shm"):
+            if os.path.exists(fichier):
+                os.remove(fichier)
+        chemin_modele = self._chemin_modele(nom)
+        if chemin_modele is not None and os.path.exists(chemin_modele):
+            # Copie directe du fichier modèle, sans passer par SQLite
+            shutil.copyfile(chemin_modele, chemin_fichier_bdd)
+            return BDD(chemin_fichier_bdd)
+        bdd = BDD(chemin_fichier_bdd)
+        with self._verrou:
+            modele.backup(bdd.connexion)
+        return bdd
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+def _construire_exemple(bdd):
+    """
+    Jeu de données d'exemple : 1000 personnages et 5000 matchs.
+
+    :param bdd: objet base de données vide (type BDD du fichier `bdd.py`)
+    :return: None
+    """
+
+    bdd.ajouter_personnages([{"nom": "Personnage %d" % numero, "url_image": "", "acteur": None, "score": 1400}
+                             for numero in range(1000)])
+    bdd.connexion.executemany('''INSERT INTO matchs (id_gagnant, id_perdant, ancien_score_gagnant,
+                                                     ancien_score_perdant, nouveau_score_gagnant,
+                                                     nouveau_score_perdant, date)
+                                 VALUES (?, ?, 1400, 1400, 1416, 1384, ?)''',
+                              [(1 + numero % 1000, 1 + (numero + 1) % 1000, float(numero))
+                               for numero in range(5000)])
+
+
+def _cloner_dans_processus(arguments):
+    """
+    Clone le jeu de données d'exemple dans un fichier depuis un autre processus, le modifie et renvoie son contenu.
+
+    :param arguments: 2-uplet (dossier des modèles, chemin du clone)
+    :return: 3-uplet (nombre de modèles construits, nombre de personnages, nombre de matchs)
+    """
+
+    dossier, chemin_clone = arguments
+    instantanes = Instantanes(dossier)
+    instantanes.definir("exemple", _construire_exemple)
+    bdd = instantanes.cloner("exemple", chemin_clone)
+    bdd.ajouter_personnage({"nom": "Ajouté", "url_image": "", "acteur": None, "score": 1400})
+    resultat = (instantanes.nb_constructions, bdd.nombre_personnages(), len(bdd.matchs()))
+    bdd.fermer()
+    os.remove(chemin_clone)
+    return resultat
+
+
+class TestInstantanes:
+    def test_cloner_en_memoire(self):
+        instantanes = Instantanes()
+        instantanes.definir("exemple", _construire_exemple)
+
+        bdd1 = instantanes.cloner("exemple")
+        bdd2 = instantanes.cloner("exemple")
+        assert instantanes.nb_constructions == 1
+        assert bdd1.nombre_personnages() == 1000
+        assert len(bdd1.matchs()) == 5000
+
+        # Les clones sont indépendants
+        bdd1.changer_score_personnage(1, 2000)
+        bdd1.ajouter_personnage({"nom": "Ajouté", "url_image": "", "acteur": None, "score": 1400})
+        assert bdd2.personnage(1)["score"] == 1400
+        assert bdd2.nombre_personnages() == 1000
+        assert instantanes.cloner("exemple").nombre_personnages() == 1000
+
+        bdd1.fermer()
+        bdd2.fermer()
+
+    def test_modeles_sur_disque(self):
+        import multiprocessing
+        dossier_test = "test/test_instantanes"
+        shutil.rmtree(dossier_test, ignore_errors=True)
+
+        instantanes = Instantanes(dossier_test)
+        instantanes.definir("exemple", _construire_exemple)
+        bdd = instantanes.cloner("exemple", "test/test_instantanes_clone.db")
+        assert instantanes.nb_constructions == 1
+        assert len(os.listdir(dossier_test)) == 1
+        assert len(bdd.matchs()) == 5000
+        bdd.fermer()
+        os.remove("test/test_instantanes_clone.db")
+
+        # Des processus lancés en parallèle relisent le modèle enregistré au lieu de le reconstruire, et chacun
+        # travaille sur son propre clone
+        with multiprocessing.Pool(2) as processus:
+            resultats = processus.map(_cloner_dans_processus,
+                                      [(dossier_test, "test/test_instantanes_clone_%d.db" % numero)
+                                       for numero in range(4)])
+        assert resultats == [(0, 1001, 5000)] * 4
+
+        # Une nouvelle version du jeu de données est reconstruite
+        instantanes = Instantanes(dossier_test)
+        instantanes.definir("exemple", _construire_exemple, version="2")
+        instantanes.cloner("exemple").fermer()
+        assert instantanes.nb_constructions == 1
+        assert len(os.listdir(dossier_test)) == 2
+
+        # Un changement du schéma de la base de données (ici simulé) fait aussi reconstruire le modèle
+        instantanes = Instantanes(dossier_test)
+        instantanes.definir("exemple", _construire_exemple, version="2")
+        instantanes._schema_bdd = instantanes._schema() + "\nCREATE TABLE nouvelle_table (id INTEGER)"
+        instantanes.cloner("exemple").fermer()
+        assert instantanes.nb_constructions == 1
+        assert len(os.listdir(dossier_test)) == 3
+
+        shutil.rmtree(dossier_test)
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["instantanes.py"])
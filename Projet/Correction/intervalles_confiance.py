@@ -0,0 +1,418 @@
+import concurrent.futures
+import os
+import sqlite3
+
+import numpy
+
+from evolution_bdd import calculateur_elo
+
+
+# Données des processus de calcul, fixées une fois par processus (voir `_initialiser_processus`)
+_donnees_processus = None
+
+
+def rejouer_vectorise(gagnants, perdants, scores_initiaux, tirages, k):
+    """
+    Rejoue simultanément plusieurs rééchantillonnages de l'historique des matchs avec le système Elo (mêmes formules
+    que `elo.CalculateurElo`). La boucle porte sur les matchs, chaque étape mettant à jour tous les rééchantillonnages
+    d'un coup : le coût Python ne dépend pas du nombre de rééchantillonnages.
+
+    :param gagnants: identifiants des gagnants des matchs, dans l'ordre chronologique (numpy.ndarray d'int32)
+    :param perdants: identifiants des perdants des matchs (numpy.ndarray d'int32)
+    :param scores_initiaux: score de départ de chaque personnage, indicé par son id (numpy.ndarray de float64)
+    :param tirages: matchs joués par chaque rééchantillonnage : ligne i = numéros des matchs joués à l'étape i, une
+    colonne par rééchantillonnage (numpy.ndarray d'int32 de forme (nombre d'étapes, nombre de rééchantillonnages))
+    :param k: coefficient K du système Elo (float)
+    :return: scores finaux, une ligne par rééchantillonnage (numpy.ndarray de float64)
+    """
+
+    scores = numpy.tile(scores_initiaux, (tirages.shape[1], 1))
+    lignes = numpy.arange(tirages.shape[1])
+    for numeros_matchs in tirages:
+        ids_gagnants = gagnants[numeros_matchs]
+        ids_perdants = perdants[numeros_matchs]
+        scores_gagnants = scores[lignes, ids_gagnants]
+        scores_perdants = scores[lignes, ids_perdants]
+        # Le perdant perd exactement ce que gagne le gagnant, son résultat attendu étant le complément à 1
+        variations = k * (1 - 1 / (1 + 10 ** ((scores_perdants - scores_gagnants) / 400)))
+        scores[lignes, ids_gagnants] = scores_gagnants + variations
+        scores[lignes, ids_perdants] = scores_perdants - variations
+    return scores
+
+
+def _initialiser_processus(gagnants, perdants, scores_initiaux, k):
+    """
+    Prépare un processus de calcul : les matchs ne lui sont transmis qu'une fois, et sa priorité est abaissée pour ne
+    pas ralentir l'application qui tourne à côté.
+
+    :param gagnants: identifiants des gagnants des matchs (numpy.ndarray d'int32)
+    :param perdants: identifiants des perdants des matchs (numpy.ndarray d'int32)
+    :param scores_initiaux: score de départ de chaque personnage, indicé par son id (numpy.ndarray de float64)
+    :param k: coefficient K du système Elo (float)
+    :return: None
+    """
+
+    global _donnees_processus
+    _donnees_processus = (gagnants, perdants, scores_initiaux, k)
+    if hasattr(os, "nice"):
+        os.nice(10)
+
+
+def _calculer_repliques(graine, nb_repliques):
+    """
+    Calcule des répliques bootstrap dans un processus de calcul : chaque réplique tire autant de matchs que
+    l'historique en contient, avec remise, les rejoue dans l'ordre chronologique et garde les scores finaux.
+
+    :param graine: graine des tirages, qui rend le calcul reproductible (int ou liste d'int)
+    :param nb_repliques: nombre de répliques (int)
+    :return: scores finaux, une ligne par réplique (numpy.ndarray de float32)
+    """
+
+    gagnants, perdants, scores_initiaux, k = _donnees_processus
+    generateur = numpy.random.default_rng(graine)
+    tirages = generateur.integers(0, len(gagnants), size=(len(gagnants), nb_repliques), dtype=numpy.int32)
+    tirages.sort(axis=0)
+    return rejouer_vectorise(gagnants, perdants, scores_initiaux, tirages, k).astype(numpy.float32)
+
+
+class IntervallesConfiance:
+    """
+    Intervalles de confiance du score et du rang de chaque personnage, estimés par bootstrap : l'historique des matchs
+    est rééchantillonné de nombreuses fois et rejoué, et les intervalles sont les quantiles des scores et des rangs
+    obtenus. Deux personnages dont les intervalles de rang se chevauchent ne sont pas vraiment départagés par les votes.
+
+    Le calcul est réparti sur plusieurs processus et écrit ses résultats au fur et à mesure : chaque lot de répliques
+    est enregistré dès qu'il est terminé, avec les intervalles recalculés sur toutes les répliques déjà obtenues. Un
+    calcul interrompu reprend là où il s'était arrêté tant qu'aucun match n'a été joué entre-temps.
+    """
+
+    def __init__(self, bdd, niveau=0.95):
+        """
+        Crée les tables des répliques et des intervalles si elles n'existent pas déjà (sauf pour une base ouverte en
+        lecture seule).
+
+        :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+        :param niveau: niveau de confiance des intervalles (float, entre 0 et 1)
+        """
+
+        self.bdd = bdd
+        self.niveau = niveau
+        # Intervalles déjà lus : (version des données, intervalles)
+        self._cache = None
+        if bdd.lecture_seule:
+            return
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''CREATE TABLE IF NOT EXISTS repliques_bootstrap (
+                               id_dernier_match INTEGER NOT NULL,
+                               numero           INTEGER NOT NULL,
+                               scores           BLOB NOT NULL,
+                               PRIMARY KEY (id_dernier_match, numero)
+                           ) WITHOUT ROWID''')
+        curseur.execute('''CREATE TABLE IF NOT EXISTS intervalles_confiance (
+                               id_personnage    INTEGER PRIMARY KEY,
+                               score_bas        REAL NOT NULL,
+                               score_haut       REAL NOT NULL,
+                               rang_bas         INTEGER NOT NULL,
+                               rang_haut        INTEGER NOT NULL,
+                               nb_repliques     INTEGER NOT NULL,
+                               id_dernier_match INTEGER NOT NULL,
+                               FOREIGN KEY (id_personnage)
+                                   REFERENCES personnages(id)
+                           )''')
+        self.bdd.connexion.commit()
+
+    def _lire_matchs(self, taille_lot=100000):
+        """
+        Lit tout l'historique des matchs, archives comprises, dans des tableaux compacts. La lecture se fait en une
+        seule requête sur une connexion dédiée (ou la réplique de lecture) : elle voit un état cohérent de la base sans
+        bloquer les votes.
+
+        :param taille_lot: nombre de matchs lus à la fois (int)
+        :return: 5-uplet (identifiants des personnages, gagnants, perdants : numpy.ndarray d'int32, scores initiaux
+        indicés par id : numpy.ndarray de float64, identifiant du dernier match : int)
+        """
+
+        connexion, a_fermer = self.bdd.ouvrir_connexion_lecture()
+        try:
+            personnages = connexion.execute("SELECT id, score FROM personnages ORDER BY id").fetchall()
+            ids_personnages = numpy.array([id_personnage for id_personnage, _ in personnages], dtype=numpy.int32)
+            scores_initiaux = numpy.zeros(max([id_personnage for id_personnage, _ in personnages], default=0) + 1)
+            for id_personnage, score in personnages:
+                scores_initiaux[id_personnage] = score
+            deja_vus = numpy.zeros(len(scores_initiaux), dtype=bool)
+
+            lots_gagnants, lots_perdants = [], []
+            id_dernier_match = 0
+            curseur = connexion.execute('''SELECT id, id_gagnant, id_perdant, ancien_score_gagnant, ancien_score_perdant
+                                           FROM %s
+                                           ORDER BY id''' % self.bdd.table_matchs)
+            while True:
+                lot = curseur.fetchmany(taille_lot)
+                if not lot:
+                    break
+                tableau = numpy.array(lot, dtype=numpy.float64)
+                id_dernier_match = int(tableau[-1, 0])
+                lots_gagnants.append(tableau[:, 1].astype(numpy.int32))
+                lots_perdants.append(tableau[:, 2].astype(numpy.int32))
+                # Le score initial d'un personnage est son score avant son premier match
+                ids = tableau[:, 1:3].astype(numpy.int64).ravel()
+                anciens_scores = tableau[:, 3:5].ravel()
+                ids_uniques, premieres_positions = numpy.unique(ids, return_index=True)
+                nouveaux = ~deja_vus[ids_uniques]
+                scores_initiaux[ids_uniques[nouveaux]] = anciens_scores[premieres_positions[nouveaux]]
+                deja_vus[ids_uniques] = True
+        finally:
+            if a_fermer:
+                connexion.close()
+        vide = numpy.zeros(0, dtype=numpy.int32)
+        return (ids_personnages, numpy.concatenate(lots_gagnants) if lots_gagnants else vide,
+                numpy.concatenate(lots_perdants) if lots_perdants else vide, scores_initiaux, id_dernier_match)
+
+    def _enregistrer_intervalles(self, ids_personnages, repliques, id_dernier_match):
+        """
+        Calcule les intervalles de score et de rang à partir des répliques obtenues et remplace ceux de la table.
+
+        :param ids_personnages: identifiants des personnages (numpy.ndarray)
+        :param repliques: scores des répliques, une ligne par réplique et une colonne par personnage de ids_personnages
+        (numpy.ndarray)
+        :param id_dernier_match: identifiant du dernier match de l'historique rééchantillonné (int)
+        :return: None
+        """
+
+        # Rang de chaque personnage dans chaque réplique (1 pour le meilleur score)
+        ordres = numpy.argsort(-repliques, axis=1, kind="stable")
+        rangs = numpy.empty_like(ordres)
+        numpy.put_along_axis(rangs, ordres, numpy.arange(1, repliques.shape[1] + 1), axis=1)
+        quantiles = [(1 - self.niveau) / 2, (1 + self.niveau) / 2]
+        scores_bas, scores_haut = numpy.quantile(repliques, quantiles, axis=0)
+        rangs_bas, rangs_haut = numpy.quantile(rangs, quantiles, axis=0, method="inverted_cdf")
+
+        with self.bdd.connexion:
+            self.bdd.connexion.execute("DELETE FROM intervalles_confiance")
+            self.bdd.connexion.executemany("INSERT INTO intervalles_confiance VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                           zip(ids_personnages.tolist(), scores_bas.tolist(), scores_haut.tolist(),
+                                               rangs_bas.astype(int).tolist(), rangs_haut.astype(int).tolist(),
+                                               [len(repliques)] * len(ids_personnages),
+                                               [id_dernier_match] * len(ids_personnages)))
+        self._cache = None
+
+    def calculer(self, nb_repliques=200, nb_processus=None, memoire_max=256 * 2 ** 20, apres_lot=None):
+        """
+        Calcule les intervalles de confiance sur l'historique actuel des matchs. Les répliques sont calculées par lots
+        dans un groupe de processus ; le nombre de processus et la taille des lots sont choisis pour que la mémoire
+        utilisée par l'ensemble des processus reste sous memoire_max (une erreur ValueError est levée si même un seul
+        processus ne tient pas). Les répliques déjà enregistrées pour le même historique sont réutilisées.
+
+        :param nb_repliques: nombre total de répliques voulu (int)
+        :param nb_processus: nombre maximum de processus de calcul (int), ou None pour le nombre de cœurs
+        :param memoire_max: mémoire maximale des données des processus de calcul (historique des matchs, tirages et
+        scores), en octets (int)
+        :param apres_lot: fonction appelée avec le nombre de répliques obtenues après chaque lot enregistré, ou None
+        :return: dictionnaire (clés : nb_matchs, nb_repliques (total), nb_repliques_calculees (par cet appel),
+        nb_processus, repliques_par_lot)
+        """
+
+        ids_personnages, gagnants, perdants, scores_initiaux, id_dernier_match = self._lire_matchs()
+
+        # Les répliques d'un historique plus ancien ne servent plus, ni celles calculées avant l'ajout de personnages
+        # (sans nouveau match), qui n'ont pas un score par personnage
+        with self.bdd.connexion:
+            self.bdd.connexion.execute('''DELETE FROM repliques_bootstrap
+                                          WHERE id_dernier_match != ? OR length(scores) != ?''',
+                                       (id_dernier_match, len(scores_initiaux) * numpy.dtype(numpy.float32).itemsize))
+        repliques = [numpy.frombuffer(scores, dtype=numpy.float32)
+                     for scores, in self.bdd.connexion.execute('''SELECT scores
+                                                                  FROM repliques_bootstrap
+                                                                  WHERE id_dernier_match = ?
+                                                                  ORDER BY numero''', (id_dernier_match,))]
+        repliques = [scores[ids_personnages] for scores in repliques[:nb_repliques]]
+        statistiques = {"nb_matchs": len(gagnants), "nb_repliques": len(repliques), "nb_repliques_calculees": 0,
+                        "nb_processus": 0, "repliques_par_lot": 0}
+        if len(gagnants) == 0 or len(repliques) >= nb_repliques:
+            if repliques:
+                self._enregistrer_intervalles(ids_personnages, numpy.array(repliques), id_dernier_match)
+            return statistiques
+
+        nb_processus = nb_processus or os.cpu_count() or 1
+        # Mémoire de chaque processus : l'historique des matchs et les scores initiaux (transmis une fois par
+        # processus), plus pour chaque réplique d'un lot une colonne de tirages, une ligne de scores et sa copie en
+        # float32 renvoyée (deux fois, avec sa sérialisation)
+        memoire_processus = gagnants.nbytes + perdants.nbytes + scores_initiaux.nbytes
+        memoire_replique = 4 * len(gagnants) + 16 * len(scores_initiaux)
+        if memoire_processus + memoire_replique > memoire_max:
+            raise ValueError("Mémoire insuffisante : %d octets au moins pour un processus de calcul, %d autorisés" %
+                             (memoire_processus + memoire_replique, memoire_max))
+        # Moins de processus si chacun ne peut pas calculer au moins une réplique à la fois
+        nb_processus = min(nb_processus, memoire_max // (memoire_processus + memoire_replique))
+        # Au moins un lot par processus, et pas plus de 64 répliques par lot : au-delà, la vectorisation ne gagne plus
+        repliques_par_lot = max(1, min(64, -(-(nb_repliques - len(repliques)) // nb_processus),
+                                       (memoire_max // nb_processus - memoire_processus) // memoire_replique))
+        statistiques["nb_processus"] = nb_processus
+        statistiques["repliques_par_lot"] = repliques_par_lot
+        lots = []
+        for premier_numero in range(len(repliques), nb_repliques, repliques_par_lot):
+            lots.append((premier_numero, min(repliques_par_lot, nb_repliques - premier_numero)))
+
+        with concurrent.futures.ProcessPoolExecutor(
+                nb_processus, initializer=_initialiser_processus,
+                initargs=(gagnants, perdants, scores_initiaux, calculateur_elo.k)) as executeur:
+            # Graine dérivée du dernier match et du numéro de la première réplique : un calcul repris donne les mêmes
+            # répliques que s'il n'avait pas été interrompu
+            futurs = {executeur.submit(_calculer_repliques, [id_dernier_match, premier_numero], nb): premier_numero
+                      for premier_numero, nb in lots}
+            for futur in concurrent.futures.as_completed(futurs):
+                scores_lot = futur.result()
+                premier_numero = futurs[futur]
+                with self.bdd.connexion:
+                    self.bdd.connexion.executemany("INSERT OR REPLACE INTO repliques_bootstrap VALUES (?, ?, ?)",
+                                                   [(id_dernier_match, premier_numero + decalage, scores.tobytes())
+                                                    for decalage, scores in enumerate(scores_lot)])
+                repliques.extend(scores_lot[:, ids_personnages])
+                statistiques["nb_repliques_calculees"] += len(scores_lot)
+                self._enregistrer_intervalles(ids_personnages, numpy.array(repliques), id_dernier_match)
+                if apres_lot is not None:
+                    apres_lot(len(repliques))
+        statistiques["nb_repliques"] = len(repliques)
+        return statistiques
+
+    def intervalles(self):
+        """
+        Renvoie les derniers intervalles de confiance enregistrés. Ils ne sont relus que si la base de données a été
+        modifiée par une autre connexion (par exemple par le calcul, lancé dans un autre processus).
+
+        :return: dictionnaire id du personnage -> dictionnaire (clés : score_bas, score_haut, rang_bas, rang_haut,
+        nb_repliques), vide si aucun calcul n'a été fait
+        """
+
+        version_donnees = self.bdd.version_donnees()
+        if self._cache is not None and self._cache[0] == version_donnees:
+            return self._cache[1]
+        try:
+            lignes = self.bdd.connexion.execute('''SELECT id_personnage, score_bas, score_haut, rang_bas, rang_haut,
+                                                          nb_repliques
+                                                   FROM intervalles_confiance''').fetchall()
+        except sqlite3.OperationalError:
+            # Base ouverte en lecture seule dont la table n'a pas encore été créée par le processus écrivain
+            lignes = []
+        intervalles = {ligne[0]: {"score_bas":    ligne[1],
+                                  "score_haut":   ligne[2],
+                                  "rang_bas":     ligne[3],
+                                  "rang_haut":    ligne[4],
+                                  "nb_repliques": ligne[5]} for ligne in lignes}
+        self._cache = (version_donnees, intervalles)
+        return intervalles
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestIntervallesConfiance:
+    def test_rejouer_vectorise(self):
+        import random
+        generateur = random.Random(3)
+        matchs = [tuple(generateur.sample(range(1, 6), 2)) for _ in range(50)]
+        scores = {id_personnage: 1400.0 for id_personnage in range(1, 6)}
+        for id_gagnant, id_perdant in matchs:
+            scores[id_gagnant], scores[id_perdant] = (
+                calculateur_elo.nouveau_score_gagnant(scores[id_gagnant], scores[id_perdant]),
+                calculateur_elo.nouveau_score_perdant(scores[id_perdant], scores[id_gagnant]))
+
+        gagnants = numpy.array([match[0] for match in matchs], dtype=numpy.int32)
+        perdants = numpy.array([match[1] for match in matchs], dtype=numpy.int32)
+        # Deux répliques qui rejouent l'historique tel quel donnent les scores du rejeu séquentiel
+        tirages = numpy.tile(numpy.arange(50, dtype=numpy.int32)[:, None], (1, 2))
+        resultat = rejouer_vectorise(gagnants, perdants, numpy.full(6, 1400.0), tirages, calculateur_elo.k)
+        for id_personnage, score in scores.items():
+            assert abs(resultat[0, id_personnage] - score) < 1e-9
+            assert abs(resultat[1, id_personnage] - score) < 1e-9
+
+    def test_calculer(self):
+        import random
+        from bdd import BDD
+        from evolution_bdd import appliquer_resultat_match
+        bdd = BDD(":memory:")
+        bdd.ajouter_personnages([{"nom": "Perso %d" % numero, "url_image": "", "acteur": None, "score": 1400}
+                                 for numero in range(1, 11)])
+        # Le personnage n gagne contre le personnage m avec une probabilité n / (n + m)
+        generateur = random.Random(5)
+        for _ in range(600):
+            id_personnage1, id_personnage2 = generateur.sample(range(1, 11), 2)
+            id_match_en_cours = bdd.ajouter_match_en_cours({"id_personnage1": id_personnage1,
+                                                            "id_personnage2": id_personnage2})
+            choix = 1 if generateur.random() < id_personnage1 / (id_personnage1 + id_personnage2) else 2
+            appliquer_resultat_match(bdd, id_match_en_cours, choix)
+
+        intervalles_confiance = IntervallesConfiance(bdd)
+        assert intervalles_confiance.intervalles() == {}
+        nb_repliques_lots = []
+        # Mémoire d'un processus : historique (600 matchs, 11 scores), plus celle de chaque réplique d'un lot
+        memoire_historique = 8 * 600 + 8 * 11
+        memoire_replique = 4 * 600 + 16 * 11
+        statistiques = intervalles_confiance.calculer(20, nb_processus=2,
+                                                      memoire_max=2 * (memoire_historique + 10 * memoire_replique),
+                                                      apres_lot=nb_repliques_lots.append)
+        assert statistiques == {"nb_matchs": 600, "nb_repliques": 20, "nb_repliques_calculees": 20,
+                                "nb_processus": 2, "repliques_par_lot": 10}
+        assert nb_repliques_lots == [10, 20]
+
+        intervalles = intervalles_confiance.intervalles()
+        assert set(intervalles) == set(range(1, 11))
+        for intervalle in intervalles.values():
+            assert intervalle["score_bas"] <= intervalle["score_haut"]
+            assert 1 <= intervalle["rang_bas"] <= intervalle["rang_haut"] <= 10
+            assert intervalle["nb_repliques"] == 20
+        assert intervalles[10]["rang_bas"] <= 3 and intervalles[1]["rang_haut"] >= 8
+        assert intervalles[10]["score_bas"] > intervalles[1]["score_haut"]
+
+        # Les répliques déjà enregistrées sont réutilisées : seules les répliques manquantes sont calculées
+        statistiques = intervalles_confiance.calculer(25, nb_processus=2)
+        assert statistiques["nb_repliques"] == 25 and statistiques["nb_repliques_calculees"] == 5
+        assert intervalles_confiance.calculer(25, nb_processus=2)["nb_repliques_calculees"] == 0
+
+        # Avec peu de mémoire, le nombre de processus est réduit pour que chacun calcule au moins une réplique, et la
+        # mémoire de l'ensemble des processus reste sous le plafond
+        for memoire_max, nb_processus, repliques_par_lot in ((2 * (memoire_historique + memoire_replique) - 1, 1, 3),
+                                                              (2 * (memoire_historique + memoire_replique), 2, 1)):
+            bdd.connexion.execute("DELETE FROM repliques_bootstrap")
+            statistiques = intervalles_confiance.calculer(4, nb_processus=4, memoire_max=memoire_max)
+            assert statistiques["nb_processus"] == nb_processus
+            assert statistiques["repliques_par_lot"] == repliques_par_lot
+            assert statistiques["nb_repliques_calculees"] == 4
+            assert nb_processus * (memoire_historique + repliques_par_lot * memoire_replique) <= memoire_max
+        bdd.connexion.execute("DELETE FROM repliques_bootstrap")
+        try:
+            intervalles_confiance.calculer(4, memoire_max=memoire_historique + memoire_replique - 1)
+            assert False
+        except ValueError:
+            pass
+
+        # Un personnage ajouté sans nouveau match rend les répliques enregistrées inutilisables : elles sont recalculées
+        intervalles_confiance.calculer(4, nb_processus=1)
+        bdd.ajouter_personnage({"nom": "Perso 11", "url_image": "", "acteur": None, "score": 1400})
+        statistiques = intervalles_confiance.calculer(4, nb_processus=1)
+        assert statistiques["nb_repliques_calculees"] == 4
+        assert intervalles_confiance.intervalles()[11]["rang_haut"] <= 11
+        bdd.fermer()
+
+
+if __name__ == "__main__":
+    import argparse
+    from bdd import BDD
+    from app import dossier_archives
+
+    analyseur = argparse.ArgumentParser(description="Calcule les intervalles de confiance des scores et des rangs du "
+                                                    "classement par bootstrap, à côté de l'application en marche.")
+    analyseur.add_argument("fichier_bdd", help="fichier de base de données SQLite 3")
+    analyseur.add_argument("--repliques", type=int, default=200, help="nombre de répliques bootstrap")
+    analyseur.add_argument("--processus", type=int, default=None, help="nombre de processus de calcul")
+    analyseur.add_argument("--memoire", type=int, default=256, help="mémoire maximale des processus de calcul, en Mo")
+    analyseur.add_argument("--niveau", type=float, default=0.95, help="niveau de confiance des intervalles")
+    arguments = analyseur.parse_args()
+
+    bdd = BDD(arguments.fichier_bdd)
+    bdd.attacher_archives(dossier_archives)
+    print(IntervallesConfiance(bdd, arguments.niveau).calculer(
+        arguments.repliques, arguments.processus, arguments.memoire * 2 ** 20,
+        apres_lot=lambda nb_repliques: print("%d répliques" % nb_repliques)))
+    bdd.fermer()
@@ -0,0 +1,535 @@
+import heapq
+import json
+import math
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from evolution_bdd import calculateur_elo
+
+
+# Enregistrement d'un vote dans un journal : numéro de séquence, date, id du gagnant, id du perdant
+format_enregistrement = struct.Struct("<Qdii")
+# Extension des fichiers de journal, nommés d'après leur nœud
+extension_journal = ".journal"
+# Instantané du classement publié par la fusion et lu par les nœuds
+nom_instantane = "classement.json"
+
+
+class JournalVotes:
+    """
+    Journal des votes d'un nœud, quand l'application tourne sur plusieurs machines avec un classement global. Chaque
+    nœud écrit ses votes dans son propre fichier, en ajout seulement, sous forme d'enregistrements de taille fixe
+    identifiés par (nœud, numéro de séquence, date) ; le service de fusion (voir FusionJournaux) les relit pour calculer
+    le classement global. Les dates d'un même nœud sont croissantes.
+    """
+
+    def __init__(self, dossier, noeud):
+        """
+        Ouvre le journal du nœud en ajout, en le créant si besoin. Un enregistrement incomplet en fin de fichier (écriture
+        interrompue) est supprimé.
+
+        :param dossier: dossier des journaux, partagé par les nœuds et la fusion (str)
+        :param noeud: nom du nœud, unique (str)
+        """
+
+        os.makedirs(dossier, exist_ok=True)
+        self.noeud = noeud
+        self.chemin = os.path.join(dossier, noeud + extension_journal)
+        self._fichier = open(self.chemin, "ab", buffering=0)
+        taille = self._fichier.seek(0, os.SEEK_END)
+        if taille % format_enregistrement.size:
+            self._fichier.truncate(taille - taille % format_enregistrement.size)
+        self.sequence = taille // format_enregistrement.size
+        self._derniere_date = 0.0
+        if self.sequence:
+            with open(self.chemin, "rb") as fichier:
+                fichier.seek((self.sequence - 1) * format_enregistrement.size)
+                self._derniere_date = format_enregistrement.unpack(fichier.read(format_enregistrement.size))[1]
+        self._verrou = threading.Lock()
+
+    def ajouter(self, id_gagnant, id_perdant, date=None):
+        """
+        Ajoute un vote à la fin du journal, en une seule écriture.
+
+        :param id_gagnant: identifiant du personnage gagnant (int)
+        :param id_perdant: identifiant du personnage perdant (int)
+        :param date: horodatage UNIX du vote, ou None pour maintenant (float)
+        :return: numéro de séquence du vote (int)
+        """
+
+        with self._verrou:
+            date = max(time.time() if date is None else date, self._derniere_date)
+            sequence = self.sequence
+            self._fichier.write(format_enregistrement.pack(sequence, date, id_gagnant, id_perdant))
+            self.sequence += 1
+            self._derniere_date = date
+            return sequence
+
+    def fermer(self):
+        """
+        Ferme le journal.
+
+        :return: None
+        """
+
+        self._fichier.close()
+
+
+def lire_journal(chemin, depuis_sequence=0):
+    """
+    Lit les votes d'un journal à partir d'un numéro de séquence. Un enregistrement en cours d'écriture est ignoré.
+
+    :param chemin: chemin du fichier de journal (str)
+    :param depuis_sequence: numéro de séquence du premier vote lu (int)
+    :return: liste de 4-uplets (sequence, date, id_gagnant, id_perdant)
+    """
+
+    with open(chemin, "rb") as fichier:
+        fichier.seek(depuis_sequence * format_enregistrement.size)
+        donnees = fichier.read()
+    taille_complete = len(donnees) - len(donnees) % format_enregistrement.size
+    return list(format_enregistrement.iter_unpack(donnees[:taille_complete]))
+
+
+class FusionJournaux:
+    """
+    Service de fusion : combine les journaux de tous les nœuds dans un ordre déterministe (date, nœud, séquence) et
+    rejoue les votes avec le système ELO dans la base de données canonique. Un vote n'est rejoué qu'une fois passée la
+    date limite (watermark) sous laquelle plus aucun nœud ne peut écrire : la dernière date écrite par chaque nœud, ou
+    `retard_max` secondes avant maintenant pour un nœud inactif. L'ordre de rejeu ne dépend donc pas du moment des
+    fusions, et rejouer les mêmes journaux donne toujours le même classement.
+
+    Après chaque fusion, le classement est publié dans un instantané que les nœuds relisent (voir TirageInstantanes).
+    """
+
+    def __init__(self, bdd, dossier, retard_max=5.0):
+        """
+        Crée la table des positions de lecture des journaux si elle n'existe pas déjà.
+
+        :param bdd: objet base de données canonique, ouvert en écriture (type BDD du fichier `bdd.py`)
+        :param dossier: dossier des journaux (str)
+        :param retard_max: délai maximum entre la date d'un vote et son écriture dans le journal, en secondes (float)
+        """
+
+        self.bdd = bdd
+        self.dossier = dossier
+        self.retard_max = retard_max
+        self._arret = threading.Event()
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''CREATE TABLE IF NOT EXISTS journaux_fusionnes (
+                               noeud        TEXT PRIMARY KEY,
+                               sequence     INTEGER NOT NULL,
+                               date_limite  REAL NOT NULL
+                           )''')
+        self.bdd.connexion.commit()
+
+    def _positions(self):
+        """
+        Renvoie la position de lecture de chaque journal.
+
+        :return: 2-uplet (dictionnaire nœud -> nombre de votes déjà rejoués (int) ; date limite de la dernière fusion
+        (float))
+        """
+
+        curseur = self.bdd.connexion.execute("SELECT noeud, sequence, date_limite FROM journaux_fusionnes")
+        positions = {}
+        date_limite = -math.inf
+        for noeud, sequence, date in curseur:
+            positions[noeud] = sequence
+            date_limite = max(date_limite, date)
+        return positions, date_limite
+
+    def fusionner(self, maintenant=None):
+        """
+        Rejoue les votes des journaux antérieurs à la date limite, dans une seule transaction (votes et positions de
+        lecture ensemble : une fusion interrompue ne rejoue jamais deux fois un vote), puis publie l'instantané. Un vote
+        pour un personnage inconnu de la base canonique est signalé et ignoré, sans bloquer les votes suivants.
+
+        :param maintenant: horodatage UNIX servant au calcul de la date limite, ou None pour maintenant ; math.inf
+        rejoue tous les votes, quand tous les nœuds sont arrêtés (float)
+        :return: nombre de votes rejoués (int)
+        """
+
+        if maintenant is None:
+            maintenant = time.time()
+        positions, ancienne_date_limite = self._positions()
+        votes_noeuds = {}
+        date_limite = math.inf
+        for nom_fichier in sorted(os.listdir(self.dossier)):
+            if not nom_fichier.endswith(extension_journal):
+                continue
+            noeud = nom_fichier[:-len(extension_journal)]
+            votes = lire_journal(os.path.join(self.dossier, nom_fichier), positions.get(noeud, 0))
+            votes_noeuds[noeud] = votes
+            derniere_date = votes[-1][1] if votes else -math.inf
+            date_limite = min(date_limite, max(derniere_date, maintenant - self.retard_max))
+        date_limite = max(date_limite, ancienne_date_limite)
+
+        # Fusion des journaux, chacun étant déjà trié par date
+        votes_ordonnes = heapq.merge(*[[(date, noeud, sequence, id_gagnant, id_perdant)
+                                        for sequence, date, id_gagnant, id_perdant in votes]
+                                       for noeud, votes in votes_noeuds.items()])
+        scores = dict(self.bdd.connexion.execute("SELECT id, score FROM personnages"))
+        matchs = []
+        nouvelles_positions = dict(positions)
+        date_dernier_vote = None
+        for date, noeud, sequence, id_gagnant, id_perdant in votes_ordonnes:
+            if date > date_limite:
+                break
+            nouvelles_positions[noeud] = sequence + 1
+            date_dernier_vote = date
+            if id_gagnant not in scores or id_perdant not in scores:
+                print("Vote %d du nœud %s ignoré : personnage inconnu (%d contre %d)" % (sequence, noeud, id_gagnant,
+                                                                                        id_perdant))
+                continue
+            ancien_score_gagnant = scores[id_gagnant]
+            ancien_score_perdant = scores[id_perdant]
+            scores[id_gagnant] = calculateur_elo.nouveau_score_gagnant(ancien_score_gagnant, ancien_score_perdant)
+            scores[id_perdant] = calculateur_elo.nouveau_score_perdant(ancien_score_perdant, ancien_score_gagnant)
+            matchs.append((id_gagnant, id_perdant, ancien_score_gagnant, ancien_score_perdant, scores[id_gagnant],
+                           scores[id_perdant], date))
+
+        if date_dernier_vote is not None:
+            # Après un rejeu complet (date limite infinie), la date du dernier vote lu sert de date limite
+            date_limite_enregistree = date_limite if math.isfinite(date_limite) else date_dernier_vote
+            try:
+                self._enregistrer_fusion(matchs, scores, nouvelles_positions, date_limite_enregistree)
+            except sqlite3.Error:
+                self.bdd.connexion.rollback()
+                raise
+            self.publier_instantane(scores, date_limite_enregistree)
+        return len(matchs)
+
+    def _enregistrer_fusion(self, matchs, scores, positions, date_limite):
+        """
+        Écrit les matchs rejoués, les nouveaux scores et les nouvelles positions de lecture dans une même transaction.
+
+        :param matchs: liste de 7-uplets (id_gagnant, id_perdant, ancien_score_gagnant, ancien_score_perdant,
+        nouveau_score_gagnant, nouveau_score_perdant, date)
+        :param scores: dictionnaire id_personnage -> score après les matchs
+        :param positions: dictionnaire nœud -> nombre de votes lus
+        :param date_limite: date limite de la fusion (float)
+        :return: None
+        """
+
+        curseur = self.bdd.connexion.cursor()
+        if matchs:
+            curseur.executemany('''INSERT INTO matchs (id_gagnant, id_perdant, ancien_score_gagnant,
+                                                       ancien_score_perdant, nouveau_score_gagnant,
+                                                       nouveau_score_perdant, date)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?)''', matchs)
+            ids_modifies = {match[0] for match in matchs} | {match[1] for match in matchs}
+            curseur.executemany("UPDATE personnages SET score = ? WHERE id = ?",
+                                [(scores[id_personnage], id_personnage) for id_personnage in ids_modifies])
+        curseur.executemany('''INSERT INTO journaux_fusionnes (noeud, sequence, date_limite)
+                               VALUES (?, ?, ?)
+                               ON CONFLICT (noeud) DO UPDATE SET sequence = excluded.sequence,
+                                                                 date_limite = excluded.date_limite''',
+                            [(noeud, sequence, date_limite) for noeud, sequence in positions.items()])
+        self.bdd.connexion.commit()
+
+    def publier_instantane(self, scores=None, date_limite=None):
+        """
+        Publie le classement canonique dans le dossier des journaux, sous un nom temporaire puis renommé : un nœud ne
+        lit jamais un instantané incomplet.
+
+        :param scores: dictionnaire id_personnage -> score, ou None pour le lire dans la base de données
+        :param date_limite: date limite de la dernière fusion (float), ou None pour la lire dans la base de données
+        :return: None
+        """
+
+        if scores is None:
+            scores = dict(self.bdd.connexion.execute("SELECT id, score FROM personnages"))
+        if date_limite is None:
+            date_limite = self._positions()[1]
+        nb_matchs = self.bdd.connexion.execute("SELECT COUNT(*) FROM matchs").fetchone()[0]
+        chemin = os.path.join(self.dossier, nom_instantane)
+        with open(chemin + ".tmp", "w", encoding="utf-8") as fichier:
+            json.dump({"nb_matchs": nb_matchs, "date_limite": date_limite, "scores": sorted(scores.items())}, fichier,
+                      separators=(",", ":"))
+        os.replace(chemin + ".tmp", chemin)
+
+    def demarrer(self, intervalle):
+        """
+        Lance des fusions régulières dans un fil d'exécution en arrière-plan, jusqu'à l'appel de `arreter`. Une fusion
+        qui échoue est signalée et retentée à l'intervalle suivant.
+
+        :param intervalle: durée entre deux fusions, en secondes (float)
+        :return: fil d'exécution lancé (threading.Thread)
+        """
+
+        def fusionner_regulierement():
+            while not self._arret.wait(intervalle):
+                try:
+                    self.fusionner()
+                except (sqlite3.Error, OSError) as erreur:
+                    print("Échec de la fusion des journaux : %s" % erreur)
+
+        self._arret.clear()
+        fil = threading.Thread(target=fusionner_regulierement, name="fusion-journaux", daemon=True)
+        fil.start()
+        return fil
+
+    def arreter(self):
+        """
+        Arrête les fusions régulières.
+
+        :return: None
+        """
+
+        self._arret.set()
+
+
+class TirageInstantanes:
+    """
+    Côté nœud : relit régulièrement l'instantané du classement canonique publié par la fusion et reporte les scores
+    dans la base de données locale, pour que le classement affiché par le nœud soit le classement global.
+    """
+
+    def __init__(self, bdd, dossier, apres_tirage=None, verrou=None):
+        """
+        Prépare le tirage, sans lire d'instantané.
+
+        :param bdd: objet base de données locale du nœud, ouvert en écriture (type BDD du fichier `bdd.py`)
+        :param dossier: dossier des journaux, où est publié l'instantané (str)
+        :param apres_tirage: fonction appelée sans paramètre après chaque nouvel instantané reporté (par exemple pour
+        invalider un cache), ou None
+        :param verrou: verrou pris pendant le report des scores, partagé avec les autres écritures faites sur la même
+        connexion (threading.Lock), ou None
+        """
+
+        self.bdd = bdd
+        self.verrou = verrou
+        self.chemin = os.path.join(dossier, nom_instantane)
+        self.apres_tirage = apres_tirage
+        self.nb_matchs = None
+        self._arret = threading.Event()
+
+    def tirer(self):
+        """
+        Reporte les scores de l'instantané s'il a changé depuis le dernier tirage.
+
+        :return: vrai si un nouvel instantané a été reporté (bool)
+        """
+
+        try:
+            with open(self.chemin, encoding="utf-8") as fichier:
+                instantane = json.load(fichier)
+        except FileNotFoundError:
+            return False
+        if instantane["nb_matchs"] == self.nb_matchs:
+            return False
+        if self.verrou is not None:
+            self.verrou.acquire()
+        try:
+            self.bdd.connexion.executemany("UPDATE personnages SET score = ? WHERE id = ?",
+                                           [(score, id_personnage) for id_personnage, score in instantane["scores"]])
+            self.bdd.connexion.commit()
+        finally:
+            if self.verrou is not None:
+                self.verrou.release()
+        self.nb_matchs = instantane["nb_matchs"]
+        if self.apres_tirage is not None:
+            self.apres_tirage()
+        return True
+
+    def demarrer(self, intervalle):
+        """
+        Lance des tirages réguliers dans un fil d'exécution en arrière-plan, jusqu'à l'appel de `arreter`. Un tirage
+        qui échoue est signalé et retenté à l'intervalle suivant.
+
+        :param intervalle: durée entre deux tirages, en secondes (float)
+        :return: fil d'exécution lancé (threading.Thread)
+        """
+
+        def tirer_regulierement():
+            while not self._arret.wait(intervalle):
+                try:
+                    self.tirer()
+                except (sqlite3.Error, OSError, ValueError) as erreur:
+                    print("Échec du tirage de l'instantané : %s" % erreur)
+
+        self._arret.clear()
+        fil = threading.Thread(target=tirer_regulierement, name="tirage-instantanes", daemon=True)
+        fil.start()
+        return fil
+
+    def arreter(self):
+        """
+        Arrête les tirages réguliers.
+
+        :return: None
+        """
+
+        self._arret.set()
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+def _voter_dans_noeud(arguments):
+    """
+    Simule un nœud dans un autre processus : écrit des votes aléatoires dans son journal.
+
+    :param arguments: 3-uplet (dossier des journaux, nom du nœud, nombre de votes)
+    :return: None
+    """
+
+    import random
+    dossier, noeud, nb_votes = arguments
+    journal = JournalVotes(dossier, noeud)
+    generateur = random.Random(noeud)
+    for _ in range(nb_votes):
+        journal.ajouter(*generateur.sample(range(1, 11), 2))
+        time.sleep(generateur.random() * 0.002)
+    journal.fermer()
+
+
+class TestJournalVotes:
+    @staticmethod
+    def _bdd_test():
+        """
+        Crée une base de données canonique en mémoire vive avec 10 personnages.
+
+        :return: objet base de données (type BDD du fichier `bdd.py`)
+        """
+
+        from bdd import BDD
+        bdd = BDD(":memory:")
+        bdd.ajouter_personnages([{"nom": "Personnage %d" % numero, "url_image": "", "acteur": None, "score": 1400}
+                                 for numero in range(10)])
+        return bdd
+
+    def test_journal(self):
+        import shutil
+        dossier_test = "test/test_journal_votes"
+        shutil.rmtree(dossier_test, ignore_errors=True)
+
+        journal = JournalVotes(dossier_test, "a")
+        assert journal.ajouter(1, 2, date=10.0) == 0
+        # Les dates d'un nœud restent croissantes
+        assert journal.ajouter(3, 4, date=5.0) == 1
+        journal.fermer()
+        # Un enregistrement incomplet est ignoré à la lecture et supprimé à la réouverture
+        with open(journal.chemin, "ab") as fichier:
+            fichier.write(b"\x00" * 5)
+        assert lire_journal(journal.chemin) == [(0, 10.0, 1, 2), (1, 10.0, 3, 4)]
+        journal = JournalVotes(dossier_test, "a")
+        assert journal.ajouter(5, 6, date=11.0) == 2
+        journal.fermer()
+        assert lire_journal(journal.chemin, 2) == [(2, 11.0, 5, 6)]
+
+        # Seuls les votes antérieurs à la date limite sont rejoués : le nœud b est en retard
+        JournalVotes(dossier_test, "b").fermer()
+        bdd = self._bdd_test()
+        fusion = FusionJournaux(bdd, dossier_test, retard_max=5.0)
+        assert fusion.fusionner(maintenant=14.0) == 0
+        assert fusion.fusionner(maintenant=15.5) == 2
+        assert fusion.fusionner(maintenant=15.5) == 0
+        assert fusion.fusionner(maintenant=16.5) == 1
+        assert [match["id_gagnant"] for match in bdd.matchs()] == [5, 3, 1]
+
+        # Un vote pour un personnage inconnu est ignoré sans bloquer les suivants
+        journal = JournalVotes(dossier_test, "a")
+        journal.ajouter(999, 1, date=20.0)
+        journal.ajouter(2, 1, date=21.0)
+        journal.fermer()
+        assert fusion.fusionner(maintenant=math.inf) == 1
+        assert fusion.fusionner(maintenant=math.inf) == 0
+        assert [match["id_gagnant"] for match in bdd.matchs()] == [2, 5, 3, 1]
+
+        # Une fusion régulière qui échoue est retentée à l'intervalle suivant
+        journal = JournalVotes(dossier_test, "a")
+        journal.ajouter(4, 3, date=22.0)
+        journal.fermer()
+        enregistrer_fusion = fusion._enregistrer_fusion
+        echecs = []
+
+        def enregistrer_apres_un_echec(*arguments):
+            if not echecs:
+                echecs.append(1)
+                raise sqlite3.OperationalError("database is locked")
+            enregistrer_fusion(*arguments)
+
+        fusion._enregistrer_fusion = enregistrer_apres_un_echec
+        fil = fusion.demarrer(0.01)
+        date_fin = time.time() + 5
+        while len(bdd.matchs()) < 5 and time.time() < date_fin:
+            time.sleep(0.01)
+        fusion.arreter()
+        fil.join()
+        assert echecs == [1]
+        assert bdd.matchs()[0]["id_gagnant"] == 4
+
+        # Un nœud lit l'instantané et reporte les scores canoniques
+        bdd_noeud = self._bdd_test()
+        tirages = []
+        tirage = TirageInstantanes(bdd_noeud, dossier_test, apres_tirage=lambda: tirages.append(1))
+        assert tirage.tirer()
+        assert not tirage.tirer()
+        assert [personnage["score"] for personnage in bdd_noeud.personnages()] == \
+               [personnage["score"] for personnage in bdd.personnages()]
+        assert tirages == [1]
+
+        bdd.fermer()
+        bdd_noeud.fermer()
+        shutil.rmtree(dossier_test)
+
+    def test_noeuds_concurrents(self):
+        import multiprocessing
+        import shutil
+        dossier_test = "test/test_journal_votes_noeuds"
+        shutil.rmtree(dossier_test, ignore_errors=True)
+        os.makedirs(dossier_test)
+
+        # Trois processus écrivent leurs votes pendant que la fusion tourne
+        bdd = self._bdd_test()
+        fusion = FusionJournaux(bdd, dossier_test, retard_max=0.5)
+        noeuds = [multiprocessing.Process(target=_voter_dans_noeud, args=((dossier_test, "noeud%d" % numero, 200),))
+                  for numero in range(3)]
+        for noeud in noeuds:
+            noeud.start()
+        nb_fusions = 0
+        while any(noeud.is_alive() for noeud in noeuds):
+            nb_fusions += 1
+            fusion.fusionner()
+            time.sleep(0.02)
+        for noeud in noeuds:
+            noeud.join()
+        fusion.fusionner(maintenant=math.inf)
+        assert len(bdd.matchs()) == 600
+        assert nb_fusions > 1
+        # Le système ELO ne crée ni ne détruit de points
+        assert round(sum(personnage["score"] for personnage in bdd.personnages()), 6) == 10 * 1400
+
+        # Rejouer les mêmes journaux en une seule fusion donne le même classement
+        bdd_rejeu = self._bdd_test()
+        FusionJournaux(bdd_rejeu, dossier_test).fusionner(maintenant=math.inf)
+        assert bdd_rejeu.personnages() == bdd.personnages()
+
+        bdd.fermer()
+        bdd_rejeu.fermer()
+        shutil.rmtree(dossier_test)
+
+
+if __name__ == "__main__":
+    import argparse
+    from bdd import BDD
+
+    analyseur = argparse.ArgumentParser(description="Service de fusion des journaux de votes des nœuds dans la base "
+                                                    "de données canonique.")
+    analyseur.add_argument("fichier_bdd", help="fichier de la base de données canonique SQLite 3")
+    analyseur.add_argument("dossier_journaux", help="dossier des journaux des nœuds")
+    analyseur.add_argument("--intervalle", type=float, default=1.0, help="durée entre deux fusions, en secondes")
+    analyseur.add_argument("--retard-max", type=float, default=5.0,
+                           help="délai maximum entre la date d'un vote et son écriture dans le journal, en secondes")
+    arguments = analyseur.parse_args()
+
+    fusion = FusionJournaux(BDD(arguments.fichier_bdd), arguments.dossier_journaux, arguments.retard_max)
+    fusion.publier_instantane()
+    print("Fusion des journaux de %s toutes les %g s" % (arguments.dossier_journaux, arguments.intervalle))
+    fusion.demarrer(arguments.intervalle).join()
@@ -0,0 +1,389 @@
+import threading
+
+
+# Facettes de filtrage du classement : nom dans l'URL -> titre
+facettes = {
+    "maison":     "Maison",
+    "culture":    "Culture",
+    "allegeance": "Allégeance",
+    "genre":      "Genre",
+    "vivant":     "Vivant"
+}
+
+
+class MetadonneesPersonnages:
+    """
+    Métadonnées des personnages (maison, cultures, allégeances, genre, vivant ou non, nombre d'apparitions), rangées
+    dans leurs propres tables : une ligne par personnage pour les valeurs simples et une ligne par (facette, valeur,
+    personnage) pour toutes les facettes, ce qui permet de retrouver les personnages d'une valeur par l'index. Les
+    relations entre personnages (nombre de mentions d'un personnage dans la page d'un autre) ont aussi leur table, d'où
+    est construit le graphe des relations (voir `graphe_personnages.py`).
+    """
+
+    def __init__(self, bdd):
+        """
+        Crée les tables des métadonnées si elles n'existent pas déjà (sauf pour une base ouverte en lecture seule).
+
+        :param bdd: objet base de données (type BDD du fichier `bdd.py`)
+        """
+
+        self.bdd = bdd
+        if bdd.lecture_seule:
+            return
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''CREATE TABLE IF NOT EXISTS personnages_metadonnees (
+                               id_personnage  INTEGER PRIMARY KEY,
+                               maison         TEXT,
+                               genre          TEXT,
+                               vivant         INTEGER,
+                               nb_apparitions INTEGER NOT NULL,
+                               FOREIGN KEY (id_personnage)
+                                   REFERENCES personnages(id)
+                           )''')
+        curseur.execute('''CREATE TABLE IF NOT EXISTS personnages_facettes (
+                               facette       TEXT NOT NULL,
+                               valeur        TEXT NOT NULL,
+                               id_personnage INTEGER NOT NULL,
+                               PRIMARY KEY (facette, valeur, id_personnage)
+                           ) WITHOUT ROWID''')
+        curseur.execute('''CREATE INDEX IF NOT EXISTS index_personnages_facettes_personnage
+                           ON personnages_facettes (id_personnage)''')
+        curseur.execute('''CREATE TABLE IF NOT EXISTS personnages_relations (
+                               id_personnage INTEGER NOT NULL,
+                               id_relation   INTEGER NOT NULL,
+                               mentions      INTEGER NOT NULL,
+                               PRIMARY KEY (id_personnage, id_relation)
+                           ) WITHOUT ROWID''')
+        self.bdd.connexion.commit()
+
+    @staticmethod
+    def _valeurs_facettes(infos_personnage):
+        """
+        Calcule les valeurs de chaque facette d'un personnage.
+
+        :param infos_personnage: dictionnaire (clés : voir initialisation_bdd.simplifier_infos_personnages)
+        :return: ensemble de 2-uplets (facette, valeur) (str, str)
+        """
+
+        valeurs = set()
+        if infos_personnage.get("maison"):
+            valeurs.add(("maison", infos_personnage["maison"]))
+        for culture in infos_personnage.get("cultures", []):
+            valeurs.add(("culture", culture))
+        for allegeance in infos_personnage.get("allegeances", []):
+            valeurs.add(("allegeance", allegeance))
+        if infos_personnage.get("genre"):
+            valeurs.add(("genre", infos_personnage["genre"]))
+        if infos_personnage.get("vivant") is not None:
+            valeurs.add(("vivant", "oui" if infos_personnage["vivant"] else "non"))
+        return valeurs
+
+    def enregistrer(self, infos_personnages):
+        """
+        Enregistre (ou remplace) les métadonnées de personnages déjà présents dans la base de données, retrouvés par
+        leur nom, dans une seule transaction.
+
+        :param infos_personnages: itérable de dictionnaires (clés : voir initialisation_bdd.simplifier_infos_personnages)
+        :return: nombre de personnages dont les métadonnées ont été enregistrées (int)
+        """
+
+        curseur = self.bdd.connexion.cursor()
+        ids_par_nom = dict(curseur.execute("SELECT nom, id FROM personnages"))
+        nb_personnages = 0
+        for infos_personnage in infos_personnages:
+            id_personnage = ids_par_nom.get(infos_personnage["nom"])
+            if id_personnage is None:
+                continue
+            vivant = infos_personnage.get("vivant")
+            curseur.execute('''INSERT OR REPLACE INTO personnages_metadonnees (id_personnage, maison, genre, vivant,
+                                                                              nb_apparitions)
+                               VALUES (?, ?, ?, ?, ?)''',
+                            (id_personnage, infos_personnage.get("maison"), infos_personnage.get("genre"),
+                             None if vivant is None else int(vivant), infos_personnage.get("nb_apparitions", 0)))
+            curseur.execute("DELETE FROM personnages_facettes WHERE id_personnage = ?", (id_personnage,))
+            curseur.execute("DELETE FROM personnages_relations WHERE id_personnage = ?", (id_personnage,))
+            # Seules les relations avec des personnages présents dans la base de données sont gardées
+            mentions = {}
+            for nom_relation, nb_mentions in infos_personnage.get("relations", []):
+                id_relation = ids_par_nom.get(nom_relation)
+                if id_relation is not None and id_relation != id_personnage:
+                    mentions[id_relation] = mentions.get(id_relation, 0) + nb_mentions
+            curseur.executemany('''INSERT INTO personnages_relations (id_personnage, id_relation, mentions)
+                                   VALUES (?, ?, ?)''',
+                                [(id_personnage, id_relation, nb_mentions)
+                                 for id_relation, nb_mentions in sorted(mentions.items())])
+            curseur.executemany('''INSERT INTO personnages_facettes (facette, valeur, id_personnage)
+                                   VALUES (?, ?, ?)''',
+                                [(facette, valeur, id_personnage)
+                                 for facette, valeur in sorted(self._valeurs_facettes(infos_personnage))])
+            nb_personnages += 1
+        self.bdd.connexion.commit()
+        return nb_personnages
+
+    def metadonnees(self, id_personnage):
+        """
+        Renvoie les métadonnées d'un personnage.
+
+        :param id_personnage: identifiant du personnage (int)
+        :return: dictionnaire (clés : maison, genre, vivant (bool ou None), nb_apparitions, cultures (liste de str),
+        allegeances (liste de str)), ou None si le personnage n'a pas de métadonnées
+        """
+
+        curseur = self.bdd.connexion.cursor()
+        curseur.execute('''SELECT maison, genre, vivant, nb_apparitions
+                           FROM personnages_metadonnees
+                           WHERE id_personnage = ?''', (id_personnage,))
+        ligne = curseur.fetchone()
+        if ligne is None:
+            return None
+        curseur.execute('''SELECT facette, valeur
+                           FROM personnages_facettes
+                           WHERE id_personnage = ? AND facette IN ('culture', 'allegeance')
+                           ORDER BY valeur''', (id_personnage,))
+        valeurs = curseur.fetchall()
+        return {
+            "maison":         ligne[0],
+            "genre":          ligne[1],
+            "vivant":         None if ligne[2] is None else bool(ligne[2]),
+            "nb_apparitions": ligne[3],
+            "cultures":       [valeur for facette, valeur in valeurs if facette == "culture"],
+            "allegeances":    [valeur for facette, valeur in valeurs if facette == "allegeance"]
+        }
+
+    def relations(self):
+        """
+        Renvoie toutes les relations entre personnages.
+
+        :return: liste de 3-uplets (id_personnage, id_relation, mentions) (int, int, int) triés par identifiants
+        """
+
+        return self.bdd.connexion.execute('''SELECT id_personnage, id_relation, mentions
+                                             FROM personnages_relations
+                                             ORDER BY id_personnage, id_relation''').fetchall()
+
+    def signature_relations(self):
+        """
+        Calcule une signature du contenu de la table des relations, qui change dès qu'une relation est ajoutée,
+        supprimée ou modifiée (en pratique), sans renvoyer les relations elles-mêmes.
+
+        :return: 3-uplet d'int
+        """
+
+        return tuple(valeur or 0 for valeur in self.bdd.connexion.execute(
+            '''SELECT COUNT(*), SUM(mentions), SUM((id_personnage * 1000003 + id_relation) * (mentions + 7))
+               FROM personnages_relations''').fetchone())
+
+    def facettes_personnages(self):
+        """
+        Renvoie les valeurs des facettes de tous les personnages.
+
+        :return: dictionnaire (clés : 2-uplets (facette, valeur) ; valeurs : ensembles d'identifiants de personnages)
+        """
+
+        membres = {}
+        for facette, valeur, id_personnage in self.bdd.connexion.execute('''SELECT facette, valeur, id_personnage
+                                                                            FROM personnages_facettes'''):
+            membres.setdefault((facette, valeur), set()).add(id_personnage)
+        return membres
+
+
+class ClassementsFacettes:
+    """
+    Classements filtrés par facette ("meilleurs personnages de la maison Stark", "vivants seulement") servis depuis des
+    index en mémoire : pour chaque valeur de chaque facette, la liste de ses personnages triés par score. Les index
+    sont reconstruits en un seul parcours du classement du cache des personnages (déjà trié) quand celui-ci change,
+    au plus une fois par version ; une requête ne fait ensuite ni tri ni lecture de la base de données.
+    """
+
+    def __init__(self, cache_personnages, metadonnees):
+        """
+        Prépare les index, construits à la première lecture.
+
+        :param cache_personnages: cache des personnages (type CachePersonnages du fichier `cache_personnages.py`)
+        :param metadonnees: métadonnées des personnages (type MetadonneesPersonnages)
+        """
+
+        self.cache_personnages = cache_personnages
+        self.metadonnees = metadonnees
+        # (facette, valeur) -> ensemble d'identifiants, lu une fois : les métadonnées ne changent pas avec les votes
+        self._membres = None
+        # (version du cache, dictionnaire (facette, valeur) -> liste de personnages triés par score décroissant)
+        self._index = (None, {})
+        self._verrou = threading.Lock()
+
+    def _index_a_jour(self):
+        """
+        Renvoie les index correspondant à la version actuelle du cache des personnages, en les reconstruisant si besoin.
+
+        :return: dictionnaire (facette, valeur) -> liste de lignes compactes (LignePersonnage du fichier `bdd.py`)
+        """
+
+        personnages, version = self.cache_personnages.personnages_et_version()
+        version_index, index = self._index
+        if version_index == version:
+            return index
+        with self._verrou:
+            if self._membres is None:
+                self._membres = self.metadonnees.facettes_personnages()
+            facettes_par_id = {}
+            for cle, ids_personnages in self._membres.items():
+                for id_personnage in ids_personnages:
+                    facettes_par_id.setdefault(id_personnage, []).append(cle)
+            index = {cle: [] for cle in self._membres}
+            for personnage in personnages:
+                for cle in facettes_par_id.get(personnage.id, ()):
+                    index[cle].append(personnage)
+            self._index = (version, index)
+            return index
+
+    def invalider_metadonnees(self):
+        """
+        Signale que les métadonnées ont changé : elles seront relues à la construction suivante des index.
+
+        :return: None
+        """
+
+        with self._verrou:
+            self._membres = None
+            self._index = (None, {})
+
+    def valeurs(self, facette):
+        """
+        Renvoie les valeurs d'une facette, avec leur nombre de personnages.
+
+        :param facette: nom de la facette (str, clé de `facettes`)
+        :return: liste de 2-uplets (valeur (str), nombre de personnages (int)) triée par valeur
+        """
+
+        return sorted((cle[1], len(personnages)) for cle, personnages in self._index_a_jour().items()
+                      if cle[0] == facette)
+
+    def filtres_connus(self, filtres):
+        """
+        Renvoie les filtres dont la valeur existe pour sa facette, les autres étant ignorés : le nombre de filtres
+        différents reste ainsi borné par le nombre de valeurs connues.
+
+        :param filtres: dictionnaire facette -> valeur (str -> str)
+        :return: dictionnaire facette -> valeur (str -> str), sous-ensemble de filtres
+        """
+
+        index = self._index_a_jour()
+        return {facette: valeur for facette, valeur in filtres.items() if (facette, valeur) in index}
+
+    def classement(self, filtres, nb_max=None):
+        """
+        Renvoie le classement des personnages qui ont toutes les valeurs de facettes demandées. Avec plusieurs filtres,
+        la liste la plus courte est parcourue et ses personnages sont gardés s'ils sont dans les autres.
+
+        :param filtres: dictionnaire facette -> valeur (str -> str) ; vide pour le classement complet
+        :param nb_max: nombre maximum de personnages renvoyés (int), ou None pour tous
+        :return: liste de lignes compactes (LignePersonnage du fichier `bdd.py`) triées par score décroissant, à ne pas
+        modifier
+        """
+
+        if not filtres:
+            personnages = self.cache_personnages.personnages()
+            return personnages if nb_max is None else personnages[:nb_max]
+        index = self._index_a_jour()
+        listes = sorted((index.get(cle, []) for cle in filtres.items()), key=len)
+        if len(listes) == 1:
+            resultat = listes[0]
+        else:
+            autres = [{personnage.id for personnage in liste} for liste in listes[1:]]
+            resultat = [personnage for personnage in listes[0]
+                        if all(personnage.id in ensemble for ensemble in autres)]
+        return resultat if nb_max is None else resultat[:nb_max]
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestMetadonnees:
+    @staticmethod
+    def _bdd_test():
+        """
+        Crée une base de données en mémoire vive avec les personnages de la sauvegarde de l'API.
+
+        :return: 2-uplet (objet base de données (type BDD du fichier `bdd.py`), métadonnées)
+        """
+
+        import json
+        from bdd import BDD
+        from initialisation_bdd import simplifier_infos_personnages
+        with open("../API_backup/characters_backup.json", encoding="utf-8") as fichier:
+            infos_personnages = simplifier_infos_personnages(json.load(fichier), 20)
+        bdd = BDD(":memory:")
+        bdd.ajouter_personnages([dict(infos, score=1400 + numero) for numero, infos in enumerate(infos_personnages)])
+        metadonnees = MetadonneesPersonnages(bdd)
+        assert metadonnees.enregistrer(infos_personnages) == len(infos_personnages)
+        return bdd, metadonnees
+
+    def test_metadonnees(self):
+        bdd, metadonnees = self._bdd_test()
+        id_personnage = bdd.connexion.execute("SELECT id FROM personnages WHERE nom = 'Jon Snow'").fetchone()[0]
+        infos = metadonnees.metadonnees(id_personnage)
+        assert infos["maison"] == "House Stark"
+        assert infos["genre"] == "male"
+        assert "Night's Watch" in infos["allegeances"]
+        assert infos["nb_apparitions"] > 60
+        assert metadonnees.metadonnees(100000) is None
+        # Enregistrer de nouveau remplace les métadonnées
+        metadonnees.enregistrer([{"nom": "Jon Snow", "maison": "House Targaryen", "vivant": True}])
+        assert metadonnees.metadonnees(id_personnage)["maison"] == "House Targaryen"
+        assert metadonnees.metadonnees(id_personnage)["allegeances"] == []
+        bdd.fermer()
+
+    def test_classements_facettes(self):
+        from cache_personnages import CachePersonnages
+        bdd, metadonnees = self._bdd_test()
+        cache_personnages = CachePersonnages(bdd)
+        classements = ClassementsFacettes(cache_personnages, metadonnees)
+
+        def attendu(condition, parametres):
+            return [ligne[0] for ligne in bdd.connexion.execute('''SELECT id
+                                                                   FROM personnages
+                                                                   JOIN personnages_metadonnees
+                                                                       ON id = id_personnage
+                                                                   WHERE %s
+                                                                   ORDER BY score DESC''' % condition, parametres)]
+
+        starks = [personnage.id for personnage in classements.classement({"maison": "House Stark"})]
+        assert starks and starks == attendu("maison = ?", ("House Stark",))
+        starks_vivants = classements.classement({"maison": "House Stark", "vivant": "oui"})
+        assert [personnage.id for personnage in starks_vivants] == attendu("maison = ? AND vivant = 1",
+                                                                           ("House Stark",))
+        assert len(classements.classement({"maison": "House Stark"}, nb_max=2)) == 2
+        assert classements.classement({"maison": "Maison inconnue"}) == []
+        assert classements.filtres_connus({"maison": "Maison inconnue", "vivant": "oui"}) == {"vivant": "oui"}
+        assert classements.classement({}) == cache_personnages.personnages()
+        assert ("House Stark", len(starks)) in classements.valeurs("maison")
+
+        # Les index suivent les changements de score
+        bdd.changer_score_personnage(starks[-1], 5000)
+        cache_personnages.invalider()
+        assert classements.classement({"maison": "House Stark"})[0].id == starks[-1]
+        bdd.fermer()
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from bdd import BDD
+    from initialisation_bdd import recuperer_infos_personnages, simplifier_infos_personnages
+    from app import nb_apparences_min
+
+    analyseur = argparse.ArgumentParser(description="Ajoute les métadonnées (maison, culture, allégeances...) aux "
+                                                    "personnages d'une base de données existante.")
+    analyseur.add_argument("fichier_bdd", help="fichier de base de données SQLite 3")
+    analyseur.add_argument("--fichier", help="sauvegarde JSON de l'API des personnages (par défaut, l'API est appelée)")
+    arguments = analyseur.parse_args()
+
+    if arguments.fichier is None:
+        infos_personnages = recuperer_infos_personnages(nb_apparences_min)
+    else:
+        with open(arguments.fichier, encoding="utf-8") as fichier:
+            infos_personnages = simplifier_infos_personnages(json.load(fichier), nb_apparences_min)
+    bdd = BDD(arguments.fichier_bdd)
+    print("Métadonnées de %d personnages enregistrées" % MetadonneesPersonnages(bdd).enregistrer(infos_personnages))
+    bdd.fermer()
@@ -0,0 +1,327 @@
+import concurrent.futures
+import glob
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+
+# Tests de TestBDD (fichier `bdd.py`) qui portent sur les fonctionnalités demandées dans le sujet ; les autres tests
+# concernent des évolutions propres à la correction
+tests_sujet = ["test_constructeur", "test_ajouter_personnage", "test_ajouter_personnages", "test_personnage",
+               "test_personnages", "test_changer_score_personnage", "test_match", "test_match_en_cours"]
+# Taille de la charge de travail standard : nombre de personnages insérés, de votes et de lectures du classement
+taille_performances = {"personnages": 2000, "votes": 2000, "classements": 50}
+# Fichier contenant les tests de référence
+fichier_tests_reference = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bdd.py")
+
+
+def _charger_module(nom_module, chemin_fichier):
+    """
+    Charge un fichier Python comme un module, sans l'enregistrer sous le nom "bdd" : le fichier de référence et le
+    fichier rendu peuvent ainsi être chargés côte à côte.
+
+    :param nom_module: nom donné au module (str)
+    :param chemin_fichier: chemin du fichier Python (str)
+    :return: module chargé
+    """
+
+    specification = importlib.util.spec_from_file_location(nom_module, chemin_fichier)
+    module = importlib.util.module_from_spec(specification)
+    specification.loader.exec_module(module)
+    return module
+
+
+def _message_erreur(erreur):
+    """
+    Résume une exception en une ligne, avec la ligne du test qui a échoué pour une assertion.
+
+    :param erreur: exception
+    :return: message (str)
+    """
+
+    pile = traceback.extract_tb(erreur.__traceback__)
+    lieu = " (ligne %d : %s)" % (pile[-1].lineno, pile[-1].line) if pile else ""
+    return "%s%s%s" % (type(erreur).__name__, ": %s" % erreur if str(erreur) else "", lieu)
+
+
+def executer_tests(classe_bdd, noms_tests):
+    """
+    Exécute les tests de référence (TestBDD du fichier `bdd.py` de la correction) sur une autre implémentation de la
+    classe BDD : le module de référence est rechargé et sa classe BDD remplacée, les tests l'utilisant par son nom.
+
+    :param classe_bdd: classe BDD à tester
+    :param noms_tests: noms des méthodes de TestBDD à exécuter (liste de str)
+    :return: dictionnaire (clés : noms des tests, valeurs : None si le test a réussi, sinon message d'erreur (str))
+    """
+
+    module_reference = _charger_module("bdd_reference", fichier_tests_reference)
+    module_reference.BDD = classe_bdd
+    resultats = {}
+    for nom_test in noms_tests:
+        try:
+            getattr(module_reference.TestBDD(), nom_test)()
+            resultats[nom_test] = None
+        except Exception as erreur:
+            resultats[nom_test] = _message_erreur(erreur)
+    return resultats
+
+
+def mesurer_performances(classe_bdd, chemin_fichier_bdd, taille=None):
+    """
+    Exécute la charge de travail standard sur une implémentation de la classe BDD et mesure son débit pour chaque
+    étape : insertion des personnages en une fois, cycle de vote (création du match en cours, lecture des personnages,
+    enregistrement du résultat) et lecture du classement et de l'historique des matchs.
+
+    :param classe_bdd: classe BDD à mesurer
+    :param chemin_fichier_bdd: fichier de base de données à créer pour la mesure (str)
+    :param taille: taille de la charge de travail (dictionnaire, voir taille_performances), ou None pour la taille
+    standard
+    :return: dictionnaire (clés : personnages, votes, classements ; valeurs : nombre d'opérations par seconde (float))
+    """
+
+    taille = taille or taille_performances
+    if os.path.exists(chemin_fichier_bdd):
+        os.remove(chemin_fichier_bdd)
+    bdd = classe_bdd(chemin_fichier_bdd)
+    debits = {}
+
+    debut = time.perf_counter()
+    bdd.ajouter_personnages([{"nom": "Personnage %d" % numero, "url_image": "./image%d.jpg" % numero,
+                              "acteur": "Acteur %d" % numero, "score": 1400}
+                             for numero in range(taille["personnages"])])
+    debits["personnages"] = taille["personnages"] / (time.perf_counter() - debut)
+
+    nb_personnages = bdd.nombre_personnages()
+    debut = time.perf_counter()
+    for numero in range(taille["votes"]):
+        id_gagnant = 1 + numero % nb_personnages
+        id_perdant = 1 + (numero * 7 + 1) % nb_personnages
+        if id_perdant == id_gagnant:
+            id_perdant = 1 + id_gagnant % nb_personnages
+        id_match_en_cours = bdd.ajouter_match_en_cours({"id_personnage1": id_gagnant, "id_personnage2": id_perdant})
+        match_en_cours = bdd.match_en_cours(id_match_en_cours)
+        gagnant = bdd.personnage(match_en_cours["id_personnage1"])
+        perdant = bdd.personnage(match_en_cours["id_personnage2"])
+        bdd.changer_score_personnage(gagnant["id"], gagnant["score"] + 16)
+        bdd.changer_score_personnage(perdant["id"], perdant["score"] - 16)
+        bdd.ajouter_match({"id_gagnant": gagnant["id"], "id_perdant": perdant["id"],
+                           "ancien_score_gagnant": gagnant["score"], "ancien_score_perdant": perdant["score"],
+                           "nouveau_score_gagnant": gagnant["score"] + 16,
+                           "nouveau_score_perdant": perdant["score"] - 16})
+        bdd.supprimer_match_en_cours(id_match_en_cours)
+    debits["votes"] = taille["votes"] / (time.perf_counter() - debut)
+
+    debut = time.perf_counter()
+    for _ in range(taille["classements"]):
+        bdd.personnages()
+        bdd.matchs()
+    debits["classements"] = taille["classements"] / (time.perf_counter() - debut)
+
+    bdd.fermer()
+    os.remove(chemin_fichier_bdd)
+    return debits
+
+
+def evaluer_rendu(chemin_rendu, noms_tests=None, taille=None):
+    """
+    Évalue un fichier `bdd.py` rendu : exécution des tests de référence puis, si le module se charge, mesure des
+    performances. À exécuter dans un processus dédié (voir `noter_rendus`), le dossier courant devant contenir un
+    sous-dossier test.
+
+    :param chemin_rendu: chemin du fichier rendu (str)
+    :param noms_tests: noms des tests à exécuter (liste de str), ou None pour les tests du sujet
+    :param taille: taille de la charge de travail (dictionnaire), ou None pour la taille standard
+    :return: dictionnaire (clés : tests (voir executer_tests), performances (voir mesurer_performances, ou None),
+    erreur (message d'erreur (str) ou None))
+    """
+
+    resultat = {"tests": {}, "performances": None, "erreur": None}
+    # Un rendu peut importer ses propres modules
+    sys.path.insert(0, os.path.dirname(os.path.abspath(chemin_rendu)))
+    try:
+        classe_bdd = _charger_module("bdd_rendu", chemin_rendu).BDD
+    except BaseException as erreur:
+        resultat["erreur"] = "Chargement impossible : %s" % _message_erreur(erreur)
+        return resultat
+
+    resultat["tests"] = executer_tests(classe_bdd, noms_tests or tests_sujet)
+    try:
+        resultat["performances"] = mesurer_performances(classe_bdd, os.path.join("test", "performances.db"), taille)
+    except Exception as erreur:
+        resultat["erreur"] = "Mesure des performances impossible : %s" % _message_erreur(erreur)
+    return resultat
+
+
+def _evaluer_dans_processus(chemin_rendu, delai, taille):
+    """
+    Évalue un rendu dans un nouveau processus Python, lancé dans un dossier temporaire qui lui est propre : un rendu
+    qui plante, boucle indéfiniment ou laisse des fichiers derrière lui n'affecte pas les autres.
+
+    :param chemin_rendu: chemin du fichier rendu (str)
+    :param delai: durée maximale de l'évaluation, en secondes (float)
+    :param taille: taille de la charge de travail (dictionnaire), ou None pour la taille standard
+    :return: dictionnaire (voir evaluer_rendu, avec en plus la clé duree (float))
+    """
+
+    debut = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="notation_") as dossier:
+        os.mkdir(os.path.join(dossier, "test"))
+        fichier_resultat = os.path.join(dossier, "resultat.json")
+        commande = [sys.executable, os.path.abspath(__file__), "--evaluer", os.path.abspath(chemin_rendu),
+                    "--resultat", fichier_resultat]
+        if taille is not None:
+            commande += ["--taille", json.dumps(taille)]
+        try:
+            processus = subprocess.run(commande, cwd=dossier, timeout=delai, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except subprocess.TimeoutExpired:
+            resultat = {"tests": {}, "performances": None, "erreur": "Délai de %g s dépassé" % delai}
+        else:
+            if os.path.exists(fichier_resultat):
+                with open(fichier_resultat, encoding="utf-8") as fichier:
+                    resultat = json.load(fichier)
+            else:
+                message = processus.stderr.decode("utf-8", "replace").strip().splitlines()
+                resultat = {"tests": {}, "performances": None,
+                            "erreur": "Arrêt anormal (code %d) : %s" % (processus.returncode,
+                                                                        message[-1] if message else "")}
+    resultat["duree"] = time.perf_counter() - debut
+    return resultat
+
+
+def trouver_rendus(dossier_rendus):
+    """
+    Trouve les rendus d'une classe : soit un sous-dossier par groupe contenant un fichier bdd.py, soit un fichier .py
+    par groupe.
+
+    :param dossier_rendus: dossier des rendus (str)
+    :return: dictionnaire (clés : noms des groupes, valeurs : chemins des fichiers rendus), trié par nom de groupe
+    """
+
+    rendus = {}
+    for chemin in glob.glob(os.path.join(dossier_rendus, "*", "bdd.py")):
+        rendus[os.path.basename(os.path.dirname(chemin))] = chemin
+    for chemin in glob.glob(os.path.join(dossier_rendus, "*.py")):
+        rendus[os.path.splitext(os.path.basename(chemin))[0]] = chemin
+    return dict(sorted(rendus.items()))
+
+
+def noter_rendus(rendus, nb_processus=None, delai=60, taille=None):
+    """
+    Évalue des rendus en parallèle, chacun dans son propre processus (voir `_evaluer_dans_processus`).
+
+    :param rendus: dictionnaire (clés : noms des groupes, valeurs : chemins des fichiers rendus)
+    :param nb_processus: nombre d'évaluations simultanées (int), ou None pour le nombre de cœurs
+    :param delai: durée maximale de l'évaluation d'un rendu, en secondes (float)
+    :param taille: taille de la charge de travail (dictionnaire), ou None pour la taille standard
+    :return: dictionnaire (clés : noms des groupes, valeurs : résultats (voir _evaluer_dans_processus))
+    """
+
+    nb_processus = nb_processus or os.cpu_count() or 1
+    # Les fils d'exécution ne font qu'attendre leur processus d'évaluation
+    with concurrent.futures.ThreadPoolExecutor(nb_processus) as executeur:
+        futurs = {groupe: executeur.submit(_evaluer_dans_processus, chemin, delai, taille)
+                  for groupe, chemin in rendus.items()}
+        return {groupe: futur.result() for groupe, futur in futurs.items()}
+
+
+def rapport_texte(resultats):
+    """
+    Met en forme les résultats de la notation sous forme de tableau, suivi du détail des échecs.
+
+    :param resultats: résultats renvoyés par noter_rendus
+    :return: rapport (str)
+    """
+
+    lignes = ["%-20s %8s %14s %10s %14s %8s" % ("Groupe", "Tests", "Personnages/s", "Votes/s", "Classements/s",
+                                                 "Durée")]
+    details = []
+    for groupe, resultat in resultats.items():
+        nb_reussis = sum(1 for message in resultat["tests"].values() if message is None)
+        performances = resultat["performances"] or {}
+        lignes.append("%-20s %8s %14s %10s %14s %7.1fs" % (
+            groupe[:20], "%d/%d" % (nb_reussis, len(resultat["tests"])),
+            *("%.0f" % performances[etape] if etape in performances else "-"
+              for etape in ("personnages", "votes", "classements")),
+            resultat["duree"]))
+        echecs = ["  %s : %s" % (nom_test, message) for nom_test, message in resultat["tests"].items()
+                  if message is not None]
+        if resultat["erreur"] is not None:
+            echecs.insert(0, "  %s" % resultat["erreur"])
+        if echecs:
+            details.append("%s\n%s" % (groupe, "\n".join(echecs)))
+    return "\n".join(lignes) + ("\n\n" + "\n\n".join(details) if details else "")
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestNotation:
+    def test_noter_rendus(self):
+        import shutil
+        dossier_rendus = "test/test_notation_rendus"
+        shutil.rmtree(dossier_rendus, ignore_errors=True)
+        os.makedirs(os.path.join(dossier_rendus, "correction"))
+        shutil.copy(fichier_tests_reference, os.path.join(dossier_rendus, "correction", "bdd.py"))
+        with open(os.path.join(dossier_rendus, "squelette.py"), "w", encoding="utf-8") as fichier:
+            fichier.write("class BDD:\n    def __init__(self, chemin_fichier_bdd):\n        pass\n")
+        with open(os.path.join(dossier_rendus, "syntaxe.py"), "w", encoding="utf-8") as fichier:
+            fichier.write("class BDD\n")
+        with open(os.path.join(dossier_rendus, "boucle.py"), "w", encoding="utf-8") as fichier:
+            fichier.write("while True:\n    pass\n")
+
+        rendus = trouver_rendus(dossier_rendus)
+        assert list(rendus) == ["boucle", "correction", "squelette", "syntaxe"]
+        resultats = noter_rendus(rendus, delai=5,
+                                 taille={"personnages": 100, "votes": 50, "classements": 5})
+
+        assert resultats["correction"]["erreur"] is None
+        assert resultats["correction"]["tests"] == {nom_test: None for nom_test in tests_sujet}
+        assert set(resultats["correction"]["performances"]) == {"personnages", "votes", "classements"}
+        assert all(message is not None for message in resultats["squelette"]["tests"].values())
+        assert resultats["squelette"]["erreur"].startswith("Mesure des performances impossible")
+        assert resultats["syntaxe"]["erreur"].startswith("Chargement impossible : SyntaxError")
+        assert resultats["boucle"]["erreur"] == "Délai de 5 s dépassé"
+
+        rapport = rapport_texte(resultats)
+        assert "correction" in rapport and "8/8" in rapport and "0/8" in rapport
+        shutil.rmtree(dossier_rendus)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    analyseur = argparse.ArgumentParser(description="Note les fichiers bdd.py rendus par les groupes d'élèves : tests "
+                                                    "de référence de la correction et mesure des performances.")
+    analyseur.add_argument("dossier_rendus", nargs="?",
+                           help="dossier des rendus : un sous-dossier par groupe contenant bdd.py, ou un fichier .py "
+                                "par groupe")
+    analyseur.add_argument("--processus", type=int, default=None, help="nombre d'évaluations simultanées")
+    analyseur.add_argument("--delai", type=float, default=60, help="durée maximale de l'évaluation d'un rendu (s)")
+    analyseur.add_argument("--rapport", help="fichier JSON où enregistrer les résultats détaillés")
+    # Options internes, utilisées par le processus d'évaluation d'un rendu
+    analyseur.add_argument("--evaluer", help=argparse.SUPPRESS)
+    analyseur.add_argument("--resultat", help=argparse.SUPPRESS)
+    analyseur.add_argument("--taille", type=json.loads, default=None, help=argparse.SUPPRESS)
+    arguments = analyseur.parse_args()
+
+    if arguments.evaluer is not None:
+        resultat = evaluer_rendu(arguments.evaluer, taille=arguments.taille)
+        with open(arguments.resultat, "w", encoding="utf-8") as fichier:
+            json.dump(resultat, fichier, ensure_ascii=False)
+    else:
+        if arguments.dossier_rendus is None:
+            analyseur.error("le dossier des rendus est obligatoire")
+        debut = time.perf_counter()
+        resultats = noter_rendus(trouver_rendus(arguments.dossier_rendus), arguments.processus, arguments.delai)
+        print(rapport_texte(resultats))
+        print("\n%d rendus notés en %.1f s" % (len(resultats), time.perf_counter() - debut))
+        if arguments.rapport:
+            with open(arguments.rapport, "w", encoding="utf-8") as fichier:
+                json.dump(resultats, fichier, ensure_ascii=False, indent=2)
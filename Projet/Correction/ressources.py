@@ -0,0 +1,159 @@
+import hashlib
+import mimetypes
+import os
+import re
+
+from compression import choisir_encodage, compresser, encodages_disponibles
+
+
+# Niveaux de compression des ressources, compressées une seule fois au démarrage : autant compresser au maximum
+niveaux_ressources = {"gzip": 9, "br": 11}
+
+
+def minifier_css(texte):
+    """
+    Réduit la taille d'une feuille de style en supprimant les commentaires et les espaces inutiles. Les chaînes de
+    caractères ne sont pas protégées : elles ne doivent pas contenir de caractères parmi { } ; , > ni de suites
+    d'espaces ou de "/*".
+
+    :param texte: feuille de style CSS (str)
+    :return: feuille de style minifiée (str)
+    """
+
+    texte = re.sub(r"/\*.*?\*/", "", texte, flags=re.DOTALL)
+    texte = re.sub(r"\s+", " ", texte)
+    texte = re.sub(r"\s*([{};,>])\s*", r"\1", texte)
+    # Les espaces avant ":" sont gardés, ils sont significatifs dans un sélecteur ("a :hover" et "a:hover" diffèrent)
+    texte = re.sub(r":\s+", ":", texte)
+    return texte.replace(";}", "}").strip()
+
+
+class RessourcesStatiques:
+    """
+    Chaîne de préparation des ressources statiques (feuilles de style, scripts) : chaque fichier est lu une fois,
+    minifié s'il s'agit d'une feuille de style, compressé dans tous les formats disponibles et renommé avec une
+    empreinte de son contenu (par exemple css/style.3f2a9c1b0d4e.css). Le nom changeant avec le contenu, les
+    navigateurs peuvent garder les ressources en cache indéfiniment sans jamais utiliser une version périmée.
+    """
+
+    def __init__(self, dossier):
+        """
+        Initialise une chaîne sans ressource.
+
+        :param dossier: dossier des fichiers statiques (str)
+        """
+
+        self.dossier = dossier
+        # Chemin d'origine -> nom avec empreinte
+        self._noms = {}
+        # Nom avec empreinte -> (type MIME, empreinte, dictionnaire format de compression (ou None) -> contenu)
+        self._ressources = {}
+
+    def ajouter(self, chemin):
+        """
+        Prépare une ressource.
+
+        :param chemin: chemin du fichier, relatif au dossier des fichiers statiques (str, par exemple "css/style.css")
+        :return: nom de la ressource avec empreinte (str)
+        """
+
+        with open(os.path.join(self.dossier, chemin), "rb") as fichier:
+            contenu = fichier.read()
+        if chemin.endswith(".css"):
+            contenu = minifier_css(contenu.decode("utf-8")).encode("utf-8")
+
+        empreinte = hashlib.sha256(contenu).hexdigest()[:12]
+        base, extension = os.path.splitext(chemin)
+        nom = "%s.%s%s" % (base, empreinte, extension)
+        variantes = {None: contenu}
+        for encodage in encodages_disponibles():
+            variantes[encodage] = compresser(contenu, encodage, niveaux_ressources[encodage])
+        type_mime = mimetypes.guess_type(chemin)[0] or "application/octet-stream"
+
+        self._noms[chemin] = nom
+        self._ressources[nom] = (type_mime, empreinte, variantes)
+        return nom
+
+    def nom(self, chemin):
+        """
+        Renvoie le nom avec empreinte d'une ressource, en la préparant si ce n'est pas déjà fait.
+
+        :param chemin: chemin du fichier, relatif au dossier des fichiers statiques (str)
+        :return: nom de la ressource avec empreinte (str)
+        """
+
+        if chemin not in self._noms:
+            return self.ajouter(chemin)
+        return self._noms[chemin]
+
+    def reponse(self, nom, requete):
+        """
+        Construit la réponse servant une ressource, dans le format de compression accepté par le client, avec des
+        en-têtes de cache permanents.
+
+        :param nom: nom de la ressource avec empreinte (str)
+        :param requete: requête Flask (flask.request)
+        :return: réponse Flask, ou None si la ressource n'existe pas
+        """
+
+        import flask
+        if nom not in self._ressources:
+            return None
+        type_mime, empreinte, variantes = self._ressources[nom]
+        encodage = choisir_encodage(requete.accept_encodings)
+
+        reponse = flask.Response(variantes[encodage], mimetype=type_mime)
+        if encodage is not None:
+            reponse.headers["Content-Encoding"] = encodage
+        reponse.vary.add("Accept-Encoding")
+        reponse.set_etag(empreinte, weak=True)
+        reponse.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return reponse.make_conditional(requete)
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestRessources:
+    def test_minifier_css(self):
+        css = """/* Barre de navigation */
+nav > a:hover {
+  color: white;
+  margin: 0 8px;
+}
+
+li:last-child,
+.details {
+  border-bottom: 0;
+}
+"""
+        assert minifier_css(css) == "nav>a:hover{color:white;margin:0 8px}li:last-child,.details{border-bottom:0}"
+
+    def test_ressources_statiques(self):
+        import gzip
+        import flask
+        ressources = RessourcesStatiques("static")
+        nom = ressources.nom("css/style.css")
+        assert re.fullmatch(r"css/style\.[0-9a-f]{12}\.css", nom)
+        assert ressources.nom("css/style.css") == nom
+
+        app = flask.Flask(__name__)
+        with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+            reponse = ressources.reponse(nom, flask.request)
+            assert reponse.headers["Content-Encoding"] == "gzip"
+            assert "immutable" in reponse.headers["Cache-Control"]
+            css = gzip.decompress(reponse.get_data()).decode("utf-8")
+            assert "/*" not in css and "\n" not in css
+            with open("static/css/style.css", encoding="utf-8") as fichier:
+                assert len(css) < len(fichier.read())
+            assert ressources.reponse("css/inconnu.css", flask.request) is None
+
+        with app.test_request_context():
+            assert "Content-Encoding" not in ressources.reponse(nom, flask.request).headers
+
+
+# Si on n'utilise pas pytest depuis le terminal, lancer les tests directement
+if __name__ == "__main__":
+    import pytest
+    pytest.main(["ressources.py"])
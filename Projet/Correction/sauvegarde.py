@@ -0,0 +1,259 @@
+import datetime
+import glob
+import os
+import shutil
+import sqlite3
+import threading
+
+
+class ServiceSauvegarde:
+    """
+    Sauvegarde à chaud de la base de données, pendant que l'application la modifie. La copie passe par l'API de
+    sauvegarde de SQLite, qui garantit une copie cohérente (contrairement à une simple copie du fichier), par petites
+    étapes de quelques pages : entre deux étapes, le verrou de lecture est relâché et les votes peuvent être écrits.
+
+    La base de données est passée en mode WAL à la première sauvegarde (le mode est enregistré dans le fichier) : sans
+    lui, la copie tiendrait un verrou de lecture qui bloque les écritures, et une base qui ne peut pas y passer n'est
+    pas sauvegardée.
+
+    Les sauvegardes sont horodatées et seules les plus récentes sont gardées. Chaque sauvegarde peut aussi être publiée
+    comme réplique en lecture seule (voir `BDD.chemin_replique`) pour les longues lectures.
+    """
+
+    def __init__(self, chemin_fichier_bdd, dossier_sauvegardes, nb_sauvegardes=24, pages_par_etape=256, pause=0.005,
+                 chemin_replique=None, nb_redemarrages_max=5):
+        """
+        Prépare le service, sans lancer de sauvegarde.
+
+        :param chemin_fichier_bdd: chemin du fichier de base de données à sauvegarder (str)
+        :param dossier_sauvegardes: dossier des sauvegardes, créé si besoin (str)
+        :param nb_sauvegardes: nombre de sauvegardes gardées, les plus anciennes étant supprimées (int)
+        :param pages_par_etape: nombre de pages copiées à chaque étape (int)
+        :param pause: pause entre deux étapes, en secondes (float)
+        :param chemin_replique: fichier où publier chaque sauvegarde comme réplique en lecture seule (str), ou None
+        :param nb_redemarrages_max: nombre de fois où une copie par étapes peut être recommencée (SQLite la recommence
+        depuis le début quand une autre connexion modifie la base pendant la copie) avant de copier en une seule étape
+        (int)
+        """
+
+        self.chemin_fichier_bdd = chemin_fichier_bdd
+        self.dossier_sauvegardes = dossier_sauvegardes
+        self.nb_sauvegardes = nb_sauvegardes
+        self.pages_par_etape = pages_par_etape
+        self.pause = pause
+        self.chemin_replique = chemin_replique
+        self.nb_redemarrages_max = nb_redemarrages_max
+        self._arret = threading.Event()
+        self._verrou = threading.Lock()
+
+    def _copier(self, source, destination):
+        """
+        Copie la base de données par étapes. Si la copie est recommencée trop souvent à cause des écritures, elle est
+        faite en une seule étape : la base étant en mode WAL (voir _activer_wal), elle ne bloque alors toujours pas les
+        écritures, qui restent seulement invisibles pour la copie.
+
+        :param source: connexion à la base de données à copier
+        :param destination: connexion à la copie
+        :return: None
+        """
+
+        class CopieRecommencee(Exception):
+            pass
+
+        etat = {"restantes": None, "redemarrages": 0}
+
+        def progression(statut, restantes, total):
+            # Le nombre de pages restantes ne peut augmenter que si la copie a été recommencée
+            if etat["restantes"] is not None and restantes > etat["restantes"]:
+                etat["redemarrages"] += 1
+                if etat["redemarrages"] > self.nb_redemarrages_max:
+                    raise CopieRecommencee()
+            etat["restantes"] = restantes
+
+        try:
+            source.backup(destination, pages=self.pages_par_etape, progress=progression, sleep=self.pause)
+        except CopieRecommencee:
+            source.backup(destination, pages=-1)
+
+    def sauvegarder(self):
+        """
+        Fait une sauvegarde, supprime les sauvegardes les plus anciennes et publie la réplique. La sauvegarde est écrite
+        sous un nom temporaire puis renommée : le dossier ne contient jamais de sauvegarde incomplète.
+
+        :return: chemin du fichier de la sauvegarde (str)
+        """
+
+        with self._verrou:
+            os.makedirs(self.dossier_sauvegardes, exist_ok=True)
+            nom = "bdd-%s.db" % datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            chemin_sauvegarde = os.path.join(self.dossier_sauvegardes, nom)
+            chemin_temporaire = chemin_sauvegarde + ".tmp"
+
+            source = sqlite3.connect(self.chemin_fichier_bdd)
+            try:
+                self._activer_wal(source)
+            except sqlite3.Error:
+                source.close()
+                raise
+            destination = sqlite3.connect(chemin_temporaire)
+            try:
+                self._copier(source, destination)
+                # La copie est écrite en mode de journal classique : un seul fichier, lisible en lecture seule
+                destination.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                destination.close()
+                source.close()
+            os.replace(chemin_temporaire, chemin_sauvegarde)
+
+            for ancienne_sauvegarde in self.sauvegardes()[self.nb_sauvegardes:]:
+                os.remove(ancienne_sauvegarde)
+
+            if self.chemin_replique is not None:
+                # Les connexions déjà ouvertes sur l'ancienne réplique continuent de la lire, les suivantes lisent
+                # la nouvelle
+                shutil.copyfile(chemin_sauvegarde, self.chemin_replique + ".tmp")
+                os.replace(self.chemin_replique + ".tmp", self.chemin_replique)
+            return chemin_sauvegarde
+
+    def sauvegardes(self):
+        """
+        Liste les sauvegardes existantes.
+
+        :return: chemins des fichiers de sauvegarde, de la plus récente à la plus ancienne (liste de str)
+        """
+
+        return sorted(glob.glob(os.path.join(self.dossier_sauvegardes, "bdd-*.db")), reverse=True)
+
+    @staticmethod
+    def _activer_wal(source):
+        """
+        Passe la base de données en mode WAL si elle n'y est pas déjà, ou lève une erreur sqlite3.OperationalError si
+        c'est impossible. Le changement de mode attend que les autres connexions aient terminé leurs transactions.
+
+        :param source: connexion à la base de données à sauvegarder
+        :return: None
+        """
+
+        journal_mode = source.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if journal_mode.lower() != "wal":
+            raise sqlite3.OperationalError("La base de données ne peut pas passer en mode WAL (mode %s), elle n'est "
+                                           "pas sauvegardée pour ne pas bloquer les écritures" % journal_mode)
+
+    def demarrer(self, intervalle):
+        """
+        Lance des sauvegardes régulières dans un fil d'exécution en arrière-plan, jusqu'à l'appel de `arreter`. Une
+        sauvegarde qui échoue est signalée et retentée à l'intervalle suivant.
+
+        :param intervalle: durée entre deux sauvegardes, en secondes (float)
+        :return: fil d'exécution lancé (threading.Thread)
+        """
+
+        def sauvegarder_regulierement():
+            while not self._arret.is_set():
+                try:
+                    self.sauvegarder()
+                except (sqlite3.Error, OSError) as erreur:
+                    print("Échec de la sauvegarde : %s" % erreur)
+                self._arret.wait(intervalle)
+
+        self._arret.clear()
+        fil = threading.Thread(target=sauvegarder_regulierement, name="sauvegarde-bdd", daemon=True)
+        fil.start()
+        return fil
+
+    def arreter(self):
+        """
+        Arrête les sauvegardes régulières (une sauvegarde en cours se termine normalement).
+
+        :return: None
+        """
+
+        self._arret.set()
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestSauvegarde:
+    def test_sauvegarder(self):
+        from bdd import BDD
+        fichier_bdd_test = "test/test_sauvegarde.db"
+        dossier_test = "test/test_sauvegarde"
+        chemin_replique = "test/test_sauvegarde_replique.db"
+        for fichier in (fichier_bdd_test, fichier_bdd_test + "-wal", fichier_bdd_test + "-shm", chemin_replique):
+            if os.path.exists(fichier):
+                os.remove(fichier)
+        shutil.rmtree(dossier_test, ignore_errors=True)
+
+        # Une base encore en mode de journal classique (DELETE, par exemple créée par une ancienne version de BDD)
+        # est passée en mode WAL par le service
+        bdd = BDD(fichier_bdd_test)
+        assert bdd.connexion.execute("PRAGMA journal_mode = DELETE").fetchone()[0] == "delete"
+        bdd.ajouter_personnages([{"nom": "Personnage %d" % numero, "url_image": "", "acteur": None, "score": 1400}
+                                 for numero in range(2000)])
+
+        # Des votes sont écrits pendant les sauvegardes, copiées une page à la fois
+        service = ServiceSauvegarde(fichier_bdd_test, dossier_test, nb_sauvegardes=2, pages_par_etape=1, pause=0,
+                                    chemin_replique=chemin_replique)
+        arret_votes = threading.Event()
+
+        def voter():
+            bdd_votes = BDD(fichier_bdd_test)
+            while not arret_votes.is_set():
+                bdd_votes.ajouter_match({"id_gagnant": 1, "id_perdant": 2, "ancien_score_gagnant": 1400,
+                                         "ancien_score_perdant": 1400, "nouveau_score_gagnant": 1416,
+                                         "nouveau_score_perdant": 1384})
+            bdd_votes.fermer()
+
+        fil_votes = threading.Thread(target=voter)
+        chemins = [service.sauvegarder()]
+        fil_votes.start()
+        chemins += [service.sauvegarder() for _ in range(2)]
+        arret_votes.set()
+        fil_votes.join()
+
+        with sqlite3.connect(fichier_bdd_test) as connexion:
+            assert connexion.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+        # Seules les 2 sauvegardes les plus récentes sont gardées, et elles sont cohérentes
+        assert service.sauvegardes() == chemins[:0:-1]
+        for chemin in service.sauvegardes():
+            with sqlite3.connect(chemin) as connexion:
+                assert connexion.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+                assert connexion.execute("SELECT COUNT(*) FROM personnages").fetchone()[0] == 2000
+        assert not glob.glob(os.path.join(dossier_test, "*.tmp"))
+
+        # Les longues lectures passent par la réplique
+        nb_matchs_replique = sqlite3.connect(chemin_replique).execute("SELECT COUNT(*) FROM matchs").fetchone()[0]
+        bdd.chemin_replique = chemin_replique
+        bdd.ajouter_match({"id_gagnant": 1, "id_perdant": 2, "ancien_score_gagnant": 1400,
+                           "ancien_score_perdant": 1400, "nouveau_score_gagnant": 1416, "nouveau_score_perdant": 1384})
+        assert len(list(bdd.parcourir_matchs(connexion_dediee=True))) == nb_matchs_replique
+        assert len(bdd.matchs()) > nb_matchs_replique
+
+        bdd.fermer()
+        for fichier in (fichier_bdd_test, fichier_bdd_test + "-wal", fichier_bdd_test + "-shm", chemin_replique):
+            if os.path.exists(fichier):
+                os.remove(fichier)
+        shutil.rmtree(dossier_test)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    analyseur = argparse.ArgumentParser(description="Sauvegarde à chaud la base de données, sans bloquer les votes.")
+    analyseur.add_argument("fichier_bdd", help="fichier de base de données SQLite 3")
+    analyseur.add_argument("dossier_sauvegardes", help="dossier des sauvegardes")
+    analyseur.add_argument("--nb-sauvegardes", type=int, default=24, help="nombre de sauvegardes gardées")
+    analyseur.add_argument("--replique", help="fichier où publier chaque sauvegarde comme réplique en lecture seule")
+    analyseur.add_argument("--intervalle", type=float, default=None,
+                           help="sauvegarde toutes les INTERVALLE secondes au lieu d'une seule fois")
+    arguments = analyseur.parse_args()
+
+    service = ServiceSauvegarde(arguments.fichier_bdd, arguments.dossier_sauvegardes, arguments.nb_sauvegardes,
+                                chemin_replique=arguments.replique)
+    if arguments.intervalle is None:
+        print("Sauvegarde écrite dans %s" % service.sauvegarder())
+    else:
+        service.demarrer(arguments.intervalle).join()
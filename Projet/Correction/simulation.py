@@ -0,0 +1,358 @@
+import concurrent.futures
+import contextlib
+import os
+import random
+import time
+
+import numpy
+
+import evolution_bdd
+from elo import CalculateurElo
+from graphe_personnages import GrapheRelations
+
+
+# Stratégies de choix des matchs : nom -> description. Les deux premières sont celles de
+# `evolution_bdd.creer_nouveau_match_en_cours` ; la dernière n'existe que dans la simulation, pour la comparer
+strategies = {
+    "aleatoire": "deux personnages aléatoires",
+    "rival":     "un personnage aléatoire contre l'un de ses proches dans le graphe des relations",
+    "proches":   "un personnage aléatoire contre un personnage proche de lui dans le classement"
+}
+
+
+def correlation_rangs(valeurs1, valeurs2):
+    """
+    Calcule la corrélation de rangs de Spearman entre deux séries de valeurs : 1 si elles classent les éléments dans
+    le même ordre, -1 dans l'ordre inverse.
+
+    :param valeurs1: première série de valeurs (liste de float ou numpy.ndarray)
+    :param valeurs2: seconde série de valeurs, de même longueur
+    :return: corrélation (float)
+    """
+
+    rangs1 = numpy.argsort(numpy.argsort(valeurs1))
+    rangs2 = numpy.argsort(numpy.argsort(valeurs2))
+    return float(numpy.corrcoef(rangs1, rangs2)[0, 1])
+
+
+class Simulation:
+    """
+    Simulation de votes pour comparer les stratégies de choix des matchs et les valeurs du coefficient K du système
+    Elo. Les personnages ont une force réelle cachée, et les votants choisissent le plus fort avec la probabilité du
+    système Elo calculée sur ces forces, sauf une part de votes faits au hasard (bruit). La qualité du classement est
+    sa corrélation de rangs avec les forces réelles.
+
+    Les votes sont simulés en mémoire, avec exactement les mêmes tirages et les mêmes calculs que
+    `evolution_bdd.creer_nouveau_match_en_cours` et `evolution_bdd.appliquer_resultat_match` : pour une même graine,
+    `simuler` et `simuler_bdd` (qui passe par la base de données) donnent les mêmes scores, mais `simuler` va une
+    vingtaine de fois plus vite.
+    """
+
+    def __init__(self, nb_personnages=200, ecart_forces=200, bruit=0.1, degre_relations=5, graine=0):
+        """
+        Tire les forces réelles des personnages et le graphe de leurs relations.
+
+        :param nb_personnages: nombre de personnages (int)
+        :param ecart_forces: écart type des forces réelles, en points Elo (float)
+        :param bruit: part des votes faits au hasard (float, entre 0 et 1)
+        :param degre_relations: nombre de relations tirées au hasard pour chaque personnage (int)
+        :param graine: graine des tirages des forces et des relations (int)
+        """
+
+        generateur = random.Random(graine)
+        self.nb_personnages = nb_personnages
+        self.bruit = bruit
+        # Forces indicées par l'id du personnage (de 1 à nb_personnages, comme dans une base de données remplie)
+        self.forces = [0.0] + [generateur.gauss(0, ecart_forces) for _ in range(nb_personnages)]
+        relations = [(id_personnage, id_relation, generateur.randint(1, 5))
+                     for id_personnage in range(1, nb_personnages + 1)
+                     for id_relation in generateur.sample(range(1, nb_personnages + 1), min(degre_relations,
+                                                                                            nb_personnages))
+                     if id_relation != id_personnage]
+        self.graphe = GrapheRelations.construire(relations, nb_personnages)
+
+    def voter(self, id_personnage1, id_personnage2, generateur):
+        """
+        Simule le vote d'un utilisateur.
+
+        :param id_personnage1: identifiant du premier personnage (int)
+        :param id_personnage2: identifiant du second personnage (int)
+        :param generateur: générateur de nombres aléatoires (random.Random ou module random)
+        :return: choix du votant (int, 1 ou 2)
+        """
+
+        if generateur.random() < self.bruit:
+            return generateur.randint(1, 2)
+        probabilite1 = 1 / (1 + 10 ** ((self.forces[id_personnage2] - self.forces[id_personnage1]) / 400))
+        return 1 if generateur.random() < probabilite1 else 2
+
+    def simuler(self, strategie="aleatoire", k=32, nb_votes_max=1000000, pas_mesure=1000, correlation_cible=0.9,
+                graine=0):
+        """
+        Simule des votes en mémoire jusqu'à ce que le classement atteigne la corrélation cible avec les forces réelles,
+        ou jusqu'à nb_votes_max votes.
+
+        :param strategie: stratégie de choix des matchs (str, clé de `strategies`)
+        :param k: coefficient K du système Elo (float)
+        :param nb_votes_max: nombre maximal de votes (int)
+        :param pas_mesure: nombre de votes entre deux mesures de la corrélation (int)
+        :param correlation_cible: corrélation à atteindre (float), ou None pour faire tous les votes
+        :param graine: graine des tirages des matchs et des votes (int)
+        :return: dictionnaire (clés : votes_necessaires (int, ou None si la cible n'est pas atteinte), correlations
+        (liste de 2-uplets (nombre de votes, corrélation)), nb_votes (int), votes_par_seconde (float), scores (liste
+        de float indicée par l'id du personnage))
+        """
+
+        if strategie not in strategies:
+            raise ValueError("Stratégie inconnue : %r" % strategie)
+        generateur = random.Random(graine)
+        calculateur = CalculateurElo(k)
+        nb_personnages = self.nb_personnages
+        scores = [0.0] + [1400.0] * nb_personnages
+        forces = numpy.array(self.forces[1:])
+        # Classement utilisé par la stratégie "proches", recalculé à chaque mesure : ids dans l'ordre des scores, et
+        # position de chaque id
+        ordre = list(range(1, nb_personnages + 1))
+        positions = {id_personnage: position for position, id_personnage in enumerate(ordre)}
+        fenetre = max(1, nb_personnages // 20)
+
+        resultat = {"votes_necessaires": None, "correlations": [], "nb_votes": 0}
+        debut = time.perf_counter()
+        for numero_vote in range(1, nb_votes_max + 1):
+            # Mêmes tirages que `evolution_bdd.creer_nouveau_match_en_cours`
+            id_personnage1 = generateur.randint(1, nb_personnages)
+            if strategie == "proches":
+                position = positions[id_personnage1] + generateur.randint(-fenetre, fenetre - 1)
+                if position >= positions[id_personnage1]:
+                    position += 1
+                id_personnage2 = ordre[min(max(position, 0), nb_personnages - 1)]
+            else:
+                id_personnage2 = self.graphe.tirer_voisin(id_personnage1, generateur) if strategie == "rival" else None
+            if id_personnage2 is None or id_personnage2 == id_personnage1 or \
+                    not 1 <= id_personnage2 <= nb_personnages:
+                id_personnage2 = generateur.randint(1, nb_personnages - 1)
+                if id_personnage2 == id_personnage1:
+                    id_personnage2 = nb_personnages
+
+            # Mêmes calculs que `evolution_bdd.appliquer_resultat_match`
+            if self.voter(id_personnage1, id_personnage2, generateur) == 1:
+                id_gagnant, id_perdant = id_personnage1, id_personnage2
+            else:
+                id_gagnant, id_perdant = id_personnage2, id_personnage1
+            score_gagnant, score_perdant = scores[id_gagnant], scores[id_perdant]
+            scores[id_gagnant] = calculateur.nouveau_score_gagnant(score_gagnant, score_perdant)
+            scores[id_perdant] = calculateur.nouveau_score_perdant(score_perdant, score_gagnant)
+
+            if numero_vote % pas_mesure == 0 or numero_vote == nb_votes_max:
+                correlation = correlation_rangs(scores[1:], forces)
+                resultat["correlations"].append((numero_vote, correlation))
+                if strategie == "proches":
+                    ordre.sort(key=scores.__getitem__)
+                    positions = {id_personnage: position for position, id_personnage in enumerate(ordre)}
+                if correlation_cible is not None and correlation >= correlation_cible:
+                    resultat["votes_necessaires"] = numero_vote
+                    break
+        resultat["nb_votes"] = numero_vote
+        resultat["votes_par_seconde"] = numero_vote / (time.perf_counter() - debut)
+        resultat["scores"] = scores
+        return resultat
+
+    def simuler_bdd(self, strategie="aleatoire", k=32, nb_votes=1000, graine=0):
+        """
+        Simule des votes en passant par le vrai code de l'application : une base de données en mémoire vive,
+        `evolution_bdd.creer_nouveau_match_en_cours` et `evolution_bdd.appliquer_resultat_match`. Sert à vérifier que
+        `simuler` a le même comportement, et à mesurer le débit du vrai code.
+
+        :param strategie: "aleatoire" ou "rival" (les stratégies de `evolution_bdd`)
+        :param k: coefficient K du système Elo (float)
+        :param nb_votes: nombre de votes (int)
+        :param graine: graine des tirages des matchs et des votes (int)
+        :return: dictionnaire (clés : nb_votes (int), votes_par_seconde (float), scores (liste de float indicée par l'id
+        du personnage))
+        """
+
+        from bdd import BDD
+        if strategie not in ("aleatoire", "rival"):
+            raise ValueError("Stratégie absente de evolution_bdd : %r" % strategie)
+
+        bdd = BDD(":memory:")
+        bdd.ajouter_personnages([{"nom": "Personnage %d" % id_personnage, "url_image": "", "acteur": None,
+                                  "score": 1400.0} for id_personnage in range(1, self.nb_personnages + 1)])
+        graphe = self.graphe if strategie == "rival" else None
+        # evolution_bdd tire ses nombres avec le module random : même graine que le générateur de `simuler`
+        etat_random = random.getstate()
+        ancien_k = evolution_bdd.calculateur_elo.k
+        random.seed(graine)
+        evolution_bdd.calculateur_elo.k = k
+        debut = time.perf_counter()
+        try:
+            # appliquer_resultat_match affiche chaque match
+            with open(os.devnull, "w") as sortie_vide, contextlib.redirect_stdout(sortie_vide):
+                for _ in range(nb_votes):
+                    id_match_en_cours, personnage1, personnage2 = evolution_bdd.creer_nouveau_match_en_cours(bdd,
+                                                                                                             graphe)
+                    choix = self.voter(personnage1["id"], personnage2["id"], random)
+                    evolution_bdd.appliquer_resultat_match(bdd, id_match_en_cours, choix)
+            duree = time.perf_counter() - debut
+            scores = [0.0] + [personnage["score"] for personnage in sorted(bdd.personnages(),
+                                                                         key=lambda personnage: personnage["id"])]
+        finally:
+            evolution_bdd.calculateur_elo.k = ancien_k
+            random.setstate(etat_random)
+            bdd.fermer()
+        return {"nb_votes": nb_votes, "votes_par_seconde": nb_votes / duree, "scores": scores}
+
+
+def _simuler_dans_processus(simulation, strategie, k, graine, options):
+    """
+    Lance une simulation dans un processus de calcul (voir `comparer`), sans renvoyer les scores.
+
+    :param simulation: simulation (type Simulation)
+    :param strategie: stratégie de choix des matchs (str)
+    :param k: coefficient K du système Elo (float)
+    :param graine: graine des tirages des matchs et des votes (int)
+    :param options: autres paramètres de Simulation.simuler (dictionnaire)
+    :return: résultat de Simulation.simuler, sans la clé scores
+    """
+
+    resultat = simulation.simuler(strategie, k, graine=graine, **options)
+    del resultat["scores"]
+    return resultat
+
+
+def comparer(simulation, noms_strategies=None, valeurs_k=(16, 32, 64), nb_repetitions=5, nb_processus=None,
+             **options):
+    """
+    Compare des stratégies de choix des matchs et des valeurs de K : chaque combinaison est simulée nb_repetitions
+    fois avec des graines différentes, les simulations étant réparties sur plusieurs processus.
+
+    :param simulation: simulation (type Simulation)
+    :param noms_strategies: stratégies à comparer (liste de str), ou None pour toutes
+    :param valeurs_k: valeurs de K à comparer (liste de float)
+    :param nb_repetitions: nombre de simulations par combinaison (int)
+    :param nb_processus: nombre de processus de calcul (int), ou None pour le nombre de cœurs
+    :param options: autres paramètres de Simulation.simuler (nb_votes_max, pas_mesure, correlation_cible)
+    :return: liste de dictionnaires, un par combinaison (clés : strategie, k, votes_necessaires (médiane, ou None si
+    la cible n'est atteinte que par moins de la moitié des simulations), nb_atteintes (nombre de simulations qui ont
+    atteint la cible), correlation_finale (moyenne), votes_par_seconde (moyenne))
+    """
+
+    noms_strategies = noms_strategies or list(strategies)
+    combinaisons = [(strategie, k) for strategie in noms_strategies for k in valeurs_k]
+    with concurrent.futures.ProcessPoolExecutor(nb_processus or os.cpu_count() or 1) as executeur:
+        futurs = {combinaison: [executeur.submit(_simuler_dans_processus, simulation, *combinaison, graine, options)
+                                for graine in range(nb_repetitions)]
+                  for combinaison in combinaisons}
+        resultats = []
+        for (strategie, k), futurs_combinaison in futurs.items():
+            simulations = [futur.result() for futur in futurs_combinaison]
+            # Les simulations qui n'atteignent pas la cible comptent comme les plus lentes pour la médiane
+            votes = sorted(simulation_faite["votes_necessaires"] or float("inf") for simulation_faite in simulations)
+            mediane = votes[(len(votes) - 1) // 2]
+            resultats.append({
+                "strategie":          strategie,
+                "k":                  k,
+                "votes_necessaires":  mediane if mediane != float("inf") else None,
+                "nb_atteintes":       sum(1 for nb_votes in votes if nb_votes != float("inf")),
+                "correlation_finale": sum(simulation_faite["correlations"][-1][1]
+                                          for simulation_faite in simulations) / len(simulations),
+                "votes_par_seconde":  sum(simulation_faite["votes_par_seconde"]
+                                          for simulation_faite in simulations) / len(simulations)
+            })
+    return resultats
+
+
+def rapport_texte(resultats, correlation_cible):
+    """
+    Met en forme les résultats de la comparaison sous forme de tableau, du plus petit nombre de votes nécessaires au
+    plus grand.
+
+    :param resultats: résultats renvoyés par comparer
+    :param correlation_cible: corrélation cible utilisée (float)
+    :return: rapport (str)
+    """
+
+    lignes = ["%-10s %6s %16s %10s %12s %10s" % ("Stratégie", "K", "Votes (ρ≥%.2f)" % correlation_cible, "Atteinte",
+                                                   "ρ finale", "Votes/s")]
+    for resultat in sorted(resultats, key=lambda resultat: (resultat["votes_necessaires"] is None,
+                                                            resultat["votes_necessaires"] or 0)):
+        lignes.append("%-10s %6g %16s %10s %12.3f %10.0f" % (
+            resultat["strategie"], resultat["k"],
+            resultat["votes_necessaires"] if resultat["votes_necessaires"] is not None else "-",
+            resultat["nb_atteintes"], resultat["correlation_finale"], resultat["votes_par_seconde"]))
+    return "\n".join(lignes)
+
+
+# =============================================
+# =================== Tests ===================
+# =============================================
+
+class TestSimulation:
+    def test_memes_scores_que_bdd(self):
+        simulation = Simulation(nb_personnages=20, graine=1)
+        for strategie in ("aleatoire", "rival"):
+            resultat = simulation.simuler(strategie, k=24, nb_votes_max=300, correlation_cible=None, graine=4)
+            resultat_bdd = simulation.simuler_bdd(strategie, k=24, nb_votes=300, graine=4)
+            assert resultat["nb_votes"] == 300
+            assert resultat["scores"] == resultat_bdd["scores"]
+        # Le coefficient K de l'application n'a pas été modifié
+        assert evolution_bdd.calculateur_elo.k == 32
+
+    def test_comparer(self):
+        import pytest
+        simulation = Simulation(nb_personnages=30, ecart_forces=400, bruit=0, graine=2)
+        resultat = simulation.simuler("proches", nb_votes_max=20000, pas_mesure=500, correlation_cible=0.8)
+        assert resultat["votes_necessaires"] is not None and resultat["votes_necessaires"] % 500 == 0
+        assert resultat["correlations"][-1][0] == resultat["votes_necessaires"]
+        assert resultat["correlations"][-1][1] >= 0.8
+        with pytest.raises(ValueError):
+            simulation.simuler("inconnue")
+        with pytest.raises(ValueError):
+            simulation.simuler_bdd("proches")
+
+        resultats = comparer(simulation, ["aleatoire", "rival"], [16, 64], nb_repetitions=3, nb_processus=2,
+                             nb_votes_max=20000, pas_mesure=500, correlation_cible=0.8)
+        assert [(resultat["strategie"], resultat["k"]) for resultat in resultats] == [
+            ("aleatoire", 16), ("aleatoire", 64), ("rival", 16), ("rival", 64)]
+        for resultat in resultats:
+            assert resultat["nb_atteintes"] == 3
+            assert resultat["votes_necessaires"] % 500 == 0
+            assert resultat["votes_par_seconde"] > 0
+        rapport = rapport_texte(resultats, 0.8)
+        assert len(rapport.splitlines()) == 5 and "aleatoire" in rapport and "rival" in rapport
+
+
+if __name__ == "__main__":
+    import argparse
+
+    analyseur = argparse.ArgumentParser(description="Simule des votes pour comparer les stratégies de choix des matchs "
+                                                    "et les valeurs de K : nombre de votes nécessaires pour que le "
+                                                    "classement atteigne une corrélation de rangs cible avec les "
+                                                    "forces réelles des personnages.")
+    analyseur.add_argument("--personnages", type=int, default=200, help="nombre de personnages")
+    analyseur.add_argument("--ecart-forces", type=float, default=200, help="écart type des forces réelles (points Elo)")
+    analyseur.add_argument("--bruit", type=float, default=0.1, help="part des votes faits au hasard")
+    analyseur.add_argument("--strategies", nargs="+", choices=list(strategies), default=None,
+                           help="stratégies comparées (toutes par défaut)")
+    analyseur.add_argument("--k", type=float, nargs="+", default=[16, 32, 64], help="valeurs de K comparées")
+    analyseur.add_argument("--cible", type=float, default=0.9, help="corrélation de rangs cible")
+    analyseur.add_argument("--votes-max", type=int, default=1000000, help="nombre maximal de votes par simulation")
+    analyseur.add_argument("--pas-mesure", type=int, default=1000, help="nombre de votes entre deux mesures")
+    analyseur.add_argument("--repetitions", type=int, default=5, help="nombre de simulations par combinaison")
+    analyseur.add_argument("--processus", type=int, default=None, help="nombre de processus de calcul")
+    analyseur.add_argument("--bdd", type=int, default=0,
+                           help="nombre de votes simulés en plus avec le vrai code de l'application, pour comparer "
+                                "les débits")
+    arguments = analyseur.parse_args()
+
+    simulation_cli = Simulation(arguments.personnages, arguments.ecart_forces, arguments.bruit)
+    debut = time.perf_counter()
+    resultats_cli = comparer(simulation_cli, arguments.strategies, arguments.k, arguments.repetitions,
+                             arguments.processus, nb_votes_max=arguments.votes_max, pas_mesure=arguments.pas_mesure,
+                             correlation_cible=arguments.cible)
+    print(rapport_texte(resultats_cli, arguments.cible))
+    print("\n%d simulations en %.1f s" % (len(resultats_cli) * arguments.repetitions, time.perf_counter() - debut))
+    if arguments.bdd:
+        for strategie_bdd in ("aleatoire", "rival"):
+            print("Vrai code (%s) : %.0f votes/s" % (
+                strategie_bdd, simulation_cli.simuler_bdd(strategie_bdd, nb_votes=arguments.bdd)["votes_par_seconde"]))
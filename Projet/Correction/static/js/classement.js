@@ -0,0 +1,69 @@
+// Mise à jour de la page de classement à partir des événements envoyés par /classement/flux après chaque vote :
+// seuls les scores et les rangs qui ont changé sont modifiés, et les nouveaux matchs sont ajoutés en haut de la liste.
+(function () {
+    "use strict";
+
+    var adresseFlux = document.currentScript.dataset.flux;
+    var corpsClassement = document.getElementById("classement");
+    var listeMatchs = document.getElementById("derniers-matchs");
+    if (!window.EventSource || !corpsClassement || !listeMatchs) {
+        return;
+    }
+
+    function span(classe, texte) {
+        var element = document.createElement("span");
+        element.className = classe;
+        element.textContent = texte;
+        return element;
+    }
+
+    function mettreAJourClassement(personnages) {
+        if (personnages.length === 0) {
+            return;
+        }
+        var lignes = {};
+        Array.prototype.forEach.call(corpsClassement.rows, function (ligne) {
+            lignes[ligne.dataset.id] = ligne;
+        });
+        personnages.forEach(function (personnage) {
+            var ligne = lignes[personnage.id];
+            if (ligne) {
+                ligne.dataset.rang = personnage.rang;
+                ligne.cells[0].textContent = personnage.rang;
+                ligne.querySelector(".score").textContent = Math.trunc(personnage.score);
+            }
+        });
+        // Les rangs reçus sont ceux de tous les personnages qui ont bougé : trier les lignes par rang suffit
+        var lignesTriees = Array.prototype.slice.call(corpsClassement.rows).sort(function (a, b) {
+            return a.dataset.rang - b.dataset.rang;
+        });
+        lignesTriees.forEach(function (ligne) {
+            corpsClassement.appendChild(ligne);
+        });
+    }
+
+    function ajouterMatch(match) {
+        var element = document.createElement("li");
+        element.append(
+            match.nom_gagnant + " ",
+            span("gagne", " +" + Math.trunc(match.nouveau_score_gagnant - match.ancien_score_gagnant)),
+            " ",
+            span("details", "(" + Math.trunc(match.ancien_score_gagnant) + " → " +
+                            Math.trunc(match.nouveau_score_gagnant) + ")"),
+            document.createElement("br"),
+            match.nom_perdant + " ",
+            span("perdu", " -" + Math.trunc(match.ancien_score_perdant - match.nouveau_score_perdant)),
+            " ",
+            span("details", "(" + Math.trunc(match.ancien_score_perdant) + " → " +
+                            Math.trunc(match.nouveau_score_perdant) + ")")
+        );
+        listeMatchs.insertBefore(element, listeMatchs.firstChild);
+    }
+
+    var flux = new EventSource(adresseFlux);
+    flux.addEventListener("match", function (evenement) {
+        var delta = JSON.parse(evenement.data);
+        mettreAJourClassement(delta.personnages);
+        delta.matchs.forEach(ajouterMatch);
+    });
+})();
@@ -1,49 +1,260 @@
+import bisect
+import mmap
+import os
+import struct
+from array import array
+
+
+# Signature et en-tête des fichiers d'annuaire : nombre de contacts, nombre de chaînes, taille de la table des
+# chaînes, nombre de trigrammes, taille du texte des trigrammes, nombre total d'entrées de l'index de trigrammes,
+# nombre de contacts sans trigramme, nombre d'entrées de l'index des mots, nombre d'entrées de l'index des numéros
+SIGNATURE_FICHIER = b"ANNUAIR1"
+FORMAT_EN_TETE = "<9Q"
+
+
 class Annuaire:
     """
     Permet de stocker un ensemble de contacts ainsi que leurs numéro de téléphone
     et adresse e-mail.
+
+    Les contacts sont rangés par colonnes : un tableau compact (module array) par champ, dont la case d'indice id
+    concerne le contact id. Les chaînes de caractères (noms, prénoms, adresses e-mail) ne sont stockées qu'une fois
+    dans une table de chaînes, les colonnes ne contenant que leur indice dans cette table (-1 pour une valeur absente),
+    et les numéros de téléphone à 10 chiffres sont stockés sous forme d'entiers (les autres, par exemple
+    "+33 6 12 34 56 78", sont rangés dans la table des chaînes et leur colonne contient -2 - indice de la chaîne).
+    L'annuaire peut être enregistré dans un fichier et rechargé presque instantanément : le fichier est projeté en
+    mémoire (module mmap) et lu directement, sans copie.
+
+    Pour que les recherches restent rapides avec un très grand nombre de contacts, l'annuaire tient à jour des index :
+    - un index de trigrammes (suites de 3 caractères) : pour chaque trigramme, la liste des contacts dont le texte de
+      recherche le contient. Une recherche n'examine que les contacts qui contiennent le trigramme le plus rare du
+      motif ;
+    - un arbre préfixe des mots des contacts, stocké à plat pour pouvoir être enregistré : la liste triée des mots (et
+      celle des numéros), dans laquelle les mots d'un même sous-arbre, c'est-à-dire commençant par un même préfixe,
+      sont contigus et se trouvent par dichotomie. Il sert à la recherche par début de mot et à l'autocomplétion.
     """
 
     def __init__(self):
         """
         Construit un nouvel annuaire vide.
         """
-        self.__liste_dictionnaires_contacts = []
+        # Table des chaînes : les chaînes lues dans un fichier (positions dans le fichier, décodées à la demande)
+        # puis les chaînes ajoutées depuis
+        self.__positions_chaines = array("Q", [0])
+        self.__octets_chaines = b""
+        self.__nb_chaines_fichier = 0
+        self.__chaines = []
+        # Chaîne -> indice dans la table des chaînes, construit à la première insertion
+        self.__indices_chaines = None
+
+        # Colonnes des contacts
+        self.__noms = array("i")
+        self.__prenoms = array("i")
+        self.__emails = array("i")
+        self.__numeros = array("q")
+
+        # Trigramme -> tableau des identifiants des contacts qui le contiennent, par ordre croissant
+        self.__index_trigrammes = {}
+        # Contacts dont le texte de recherche est trop court pour contenir un trigramme
+        self.__contacts_courts = array("I")
+        # Arbre préfixe à plat : indices des mots dans la table des chaînes triés par ordre alphabétique des mots, et
+        # contacts correspondants ; de même pour les numéros de téléphone
+        self.__mots_tries = array("i")
+        self.__contacts_mots = array("I")
+        self.__numeros_tries = array("q")
+        self.__contacts_numeros = array("I")
+        # Entrées pas encore rangées dans l'arbre préfixe (elles le sont en une fois à la recherche suivante)
+        self.__mots_en_attente = []
+        self.__numeros_en_attente = []
+
+        # Fichier projeté en mémoire dont sont lues les données, le cas échéant
+        self.__projection = None
+
+    # ----- Table des chaînes -----
+
+    def __chaine(self, indice):
+        """
+        Renvoie une chaîne de la table des chaînes.
+        :param indice: entier, indice de la chaîne dans la table
+        :return: chaîne de caractères, ou None si l'indice vaut -1
+        """
+        if indice < 0:
+            return None
+        if indice < self.__nb_chaines_fichier:
+            return str(self.__octets_chaines[self.__positions_chaines[indice]:self.__positions_chaines[indice + 1]],
+                       "utf-8")
+        return self.__chaines[indice - self.__nb_chaines_fichier]
+
+    def __indice_chaine(self, chaine):
+        """
+        Renvoie l'indice d'une chaîne dans la table des chaînes, en l'y ajoutant si elle n'y est pas encore.
+        :param chaine: chaîne de caractères ou None
+        :return: entier, indice de la chaîne (-1 pour None)
+        """
+        if chaine is None:
+            return -1
+        if self.__indices_chaines is None:
+            self.__indices_chaines = {self.__chaine(indice): indice for indice in range(self.__nb_chaines_fichier)}
+        indice = self.__indices_chaines.get(chaine)
+        if indice is None:
+            indice = self.__nb_chaines_fichier + len(self.__chaines)
+            self.__chaines.append(chaine)
+            self.__indices_chaines[chaine] = indice
+        return indice
+
+    # ----- Ajout de contacts -----
+
+    def __rendre_modifiable(self):
+        """
+        Copie dans des tableaux modifiables les colonnes et index lus dans un fichier, avant un premier ajout.
+        :return: None
+        """
+        if self.__projection is None:
+            return
+        self.__noms = array("i", self.__noms)
+        self.__prenoms = array("i", self.__prenoms)
+        self.__emails = array("i", self.__emails)
+        self.__numeros = array("q", self.__numeros)
+        self.__contacts_courts = array("I", self.__contacts_courts)
+        self.__mots_tries = array("i", self.__mots_tries)
+        self.__contacts_mots = array("I", self.__contacts_mots)
+        self.__numeros_tries = array("q", self.__numeros_tries)
+        self.__contacts_numeros = array("I", self.__contacts_numeros)
+        # Les listes de l'index de trigrammes sont copiées une par une, à leur première modification
+        self.__projection = None
 
     def ajouter_contact(self, nom, prenom = None, numero = None, email = None):
         """
         Ajoute un contact à l'annuaire.
         :param nom: chaîne de caractères, nom de famille ou surnom du contact
         :param prenom: chaîne de caractères (optionnel), prénom du contact
-        :param numero: entier (optionnel), numéro de téléphone du contact
+        :param numero: entier ou chaîne de caractères (optionnel), numéro de téléphone du contact
         :param email: chaîne de caractères (optionnel), adresse e-mail du contact
         :return: None
         """
-        self.__liste_dictionnaires_contacts.append({
-            "nom": nom,
-            "prenom": prenom,
-            "numero": numero,
-            "email": email
-        })
+        self.ajouter_contacts([(nom, prenom, numero, email)])
+
+    def __code_numero(self, numero):
+        """
+        Convertit un numéro de téléphone en la valeur stockée dans la colonne des numéros.
+        :param numero: entier, chaîne de caractères ou None
+        :return: entier, numéro lui-même s'il compte 10 chiffres (zéros de tête compris), -1 s'il est absent, sinon
+        -2 - indice de la chaîne du numéro
+        """
+        if numero is None:
+            return -1
+        if isinstance(numero, int) and 0 <= numero < 10 ** 10:
+            return numero
+        numero = str(numero)
+        if len(numero) == 10 and numero.isdigit() and numero.isascii():
+            return int(numero)
+        return -2 - self.__indice_chaine(numero)
+
+    def ajouter_contacts(self, contacts):
+        """
+        Ajoute plusieurs contacts à l'annuaire, plus rapidement que des appels successifs à ajouter_contact.
+        :param contacts: itérable de 4-uplets (nom, prenom, numero, email), mêmes valeurs que pour ajouter_contact
+        :return: None
+        """
+        self.__rendre_modifiable()
+        index_trigrammes = self.__index_trigrammes
+        for nom, prenom, numero, email in contacts:
+            id = len(self.__noms)
+            # Toutes les valeurs sont converties avant d'être ajoutées : une erreur laisse les colonnes de même longueur
+            valeurs = (self.__indice_chaine(nom), self.__indice_chaine(prenom), self.__indice_chaine(email),
+                       self.__code_numero(numero))
+            self.__noms.append(valeurs[0])
+            self.__prenoms.append(valeurs[1])
+            self.__emails.append(valeurs[2])
+            self.__numeros.append(valeurs[3])
+
+            chaine_recherche = self.__chaine_recherche(id)
+            if len(chaine_recherche) < 3:
+                self.__contacts_courts.append(id)
+            for trigramme in set(chaine_recherche[i:i + 3] for i in range(len(chaine_recherche) - 2)):
+                liste_contacts = index_trigrammes.get(trigramme)
+                if liste_contacts is None:
+                    index_trigrammes[trigramme] = array("I", [id])
+                elif isinstance(liste_contacts, array):
+                    liste_contacts.append(id)
+                else:
+                    # Liste lue dans un fichier, pas encore modifiable
+                    index_trigrammes[trigramme] = array("I", liste_contacts)
+                    index_trigrammes[trigramme].append(id)
+
+            for champ in (nom, prenom, email):
+                if champ is not None:
+                    for mot in champ.split():
+                        self.__mots_en_attente.append((self.__indice_chaine(mot), id))
+            if valeurs[3] >= 0:
+                self.__numeros_en_attente.append((valeurs[3], id))
+            elif valeurs[3] <= -2:
+                # Numéro non numérique : rangé avec les mots, tel quel
+                self.__mots_en_attente.append((-2 - valeurs[3], id))
+
+    def __ranger_en_attente(self):
+        """
+        Range dans l'arbre préfixe les mots et numéros ajoutés depuis la dernière recherche par préfixe : ils sont
+        triés puis fusionnés avec les entrées déjà triées, ce qui coûte bien moins cher qu'une insertion à la fois.
+        :return: None
+        """
+        if self.__mots_en_attente:
+            entrees = list(zip(self.__mots_tries, self.__contacts_mots)) + self.__mots_en_attente
+            entrees.sort(key=lambda entree: (self.__chaine(entree[0]), entree[1]))
+            self.__mots_tries = array("i", (indice for indice, _ in entrees))
+            self.__contacts_mots = array("I", (id for _, id in entrees))
+            self.__mots_en_attente = []
+        if self.__numeros_en_attente:
+            entrees = sorted(list(zip(self.__numeros_tries, self.__contacts_numeros)) + self.__numeros_en_attente)
+            self.__numeros_tries = array("q", (numero for numero, _ in entrees))
+            self.__contacts_numeros = array("I", (id for _, id in entrees))
+            self.__numeros_en_attente = []
+
+    # ----- Affichage -----
 
     def nombre_contacts(self):
         """
         Permet de connaître le nombre de contacts présents dans l'annuaire.
         :return: entier, nombre de contacts
         """
-        return len(self.__liste_dictionnaires_contacts)
+        return len(self.__noms)
+
+    def __texte_numero(self, numero):
+        """
+        Met en forme un numéro de téléphone stocké dans la colonne des numéros.
+        :param numero: entier, valeur stockée (voir __code_numero)
+        :return: chaîne de caractères, ou None si le numéro est absent
+        """
+        if numero == -1:
+            return None
+        if numero <= -2:
+            return self.__chaine(-2 - numero)
+        return str(numero).rjust(10, "0")
+
+    def __dictionnaire_contact(self, id):
+        """
+        Reconstitue la représentation d'un contact sous forme de dictionnaire à partir des colonnes.
+        :param id: entier, identifiant du contact
+        :return: dictionnaire (clés : nom, prenom, numero, email)
+        """
+        return {
+            "nom": self.__chaine(self.__noms[id]),
+            "prenom": self.__chaine(self.__prenoms[id]),
+            "numero": self.__texte_numero(self.__numeros[id]),
+            "email": self.__chaine(self.__emails[id])
+        }
 
     def __afficher_dictionnaire_contact(self, dictionnaire_contact):
         """
-        Affiche un contact à partir de sa représentation interne (dictionnaire).
-        :param dictionnaire_contact: dictionnaire, représentation interne du contact
+        Affiche un contact à partir de sa représentation sous forme de dictionnaire.
+        :param dictionnaire_contact: dictionnaire, représentation du contact
         :return: None
         """
         print("- Nom :", dictionnaire_contact["nom"])
         if dictionnaire_contact["prenom"] is not None:
             print("  Prenom :", dictionnaire_contact["prenom"])
         if dictionnaire_contact["numero"] is not None:
-            print("  Numéro :", dictionnaire_contact["numero"].rjust(10, "0"))
+            print("  Numéro :", dictionnaire_contact["numero"])
         if dictionnaire_contact["email"] is not None:
             print("  E-mail :", dictionnaire_contact["email"])
 
@@ -53,17 +264,35 @@ class Annuaire:
         :param id: entier, identifiant du contact à afficher.
         :return: None
         """
-        assert id < len(self.__liste_dictionnaires_contacts)
-        dictionnaire_contact = self.__liste_dictionnaires_contacts[id]
-        self.__afficher_dictionnaire_contact(dictionnaire_contact)
+        assert id < self.nombre_contacts()
+        self.__afficher_dictionnaire_contact(self.__dictionnaire_contact(id))
 
     def afficher_tous_contacts(self):
         """
         Affiche tous les contacts
         :return: None
         """
-        for dictionnaire_contact in self.__liste_dictionnaires_contacts:
-            self.__afficher_dictionnaire_contact(dictionnaire_contact)
+        for id in range(self.nombre_contacts()):
+            self.__afficher_dictionnaire_contact(self.__dictionnaire_contact(id))
+
+    # ----- Recherche -----
+
+    def __chaine_recherche(self, id):
+        """
+        Construit le texte dans lequel sont recherchés les motifs pour un contact.
+        :param id: entier, identifiant du contact
+        :return: chaîne de caractères, nom, prénom suivi du nom, numéro et adresse e-mail séparés par des espaces
+        """
+        dictionnaire_contact = self.__dictionnaire_contact(id)
+        recherche = dictionnaire_contact["nom"]
+        if dictionnaire_contact["prenom"] is not None:
+            recherche += (" " + dictionnaire_contact["prenom"]
+                          + " " + dictionnaire_contact["nom"])
+        if dictionnaire_contact["numero"] is not None:
+            recherche += (" " + dictionnaire_contact["numero"])
+        if dictionnaire_contact["email"] is not None:
+            recherche += (" " + dictionnaire_contact["email"])
+        return recherche
 
     def rechercher_contacts(self, requete):
         """
@@ -72,21 +301,185 @@ class Annuaire:
         :param requete: chaîne de caractère, motif à rechercher
         :return: liste d'entiers, identifiants des contacts correspondants
         """
-        contacts = []
-        for id in range(len(self.__liste_dictionnaires_contacts)):
-            dictionnaire_contact = self.__liste_dictionnaires_contacts[id]
-            recherche = self.__liste_dictionnaires_contacts[id]["nom"]
-            if dictionnaire_contact["prenom"] is not None:
-                recherche += (" " + dictionnaire_contact["prenom"]
-                              + " " + self.__liste_dictionnaires_contacts[id]["nom"])
-            if dictionnaire_contact["numero"] is not None:
-                recherche += (" " + dictionnaire_contact["numero"].rjust(10, "0"))
-            if dictionnaire_contact["email"] is not None:
-                recherche += (" " + dictionnaire_contact["email"])
+        if requete == "":
+            return list(range(self.nombre_contacts()))
+        if len(requete) < 3:
+            # Motif trop court pour être cherché directement dans l'index : les contacts correspondants sont ceux dont
+            # un trigramme contient le motif, ainsi que les contacts sans trigramme qui le contiennent
+            candidats = set()
+            for trigramme, liste_contacts in self.__index_trigrammes.items():
+                if requete in trigramme:
+                    candidats.update(liste_contacts)
+            candidats.update(id for id in self.__contacts_courts if requete in self.__chaine_recherche(id))
+            return sorted(candidats)
+
+        # Un contact correspondant contient tous les trigrammes du motif : il suffit d'examiner les contacts qui
+        # contiennent le plus rare d'entre eux
+        candidats = None
+        for i in range(len(requete) - 2):
+            liste_contacts = self.__index_trigrammes.get(requete[i:i + 3])
+            if liste_contacts is None:
+                return []
+            if candidats is None or len(liste_contacts) < len(candidats):
+                candidats = liste_contacts
+        return [id for id in candidats if requete in self.__chaine_recherche(id)]
+
+    def __intervalle_mots(self, prefixe):
+        """
+        Renvoie l'intervalle des mots commençant par un préfixe dans la liste triée des mots.
+        :param prefixe: chaîne de caractères
+        :return: 2-uplet d'entiers (début inclus, fin exclue)
+        """
+        self.__ranger_en_attente()
+        debut = bisect.bisect_left(self.__mots_tries, prefixe, key=self.__chaine)
+        # Tous les mots commençant par le préfixe sont inférieurs au préfixe suivi du plus grand caractère possible
+        fin = bisect.bisect_left(self.__mots_tries, prefixe + "\U0010ffff", lo=debut, key=self.__chaine)
+        return debut, fin
+
+    def __intervalle_numeros(self, prefixe):
+        """
+        Renvoie l'intervalle des numéros commençant par un préfixe dans la liste triée des numéros : les numéros à 10
+        chiffres commençant par le préfixe p de k chiffres sont les entiers de p × 10^(10-k) inclus à
+        (p + 1) × 10^(10-k) exclu.
+        :param prefixe: chaîne de caractères
+        :return: 2-uplet d'entiers (début inclus, fin exclue)
+        """
+        self.__ranger_en_attente()
+        if not prefixe.isdigit() or len(prefixe) > 10:
+            return 0, 0
+        facteur = 10 ** (10 - len(prefixe))
+        debut = bisect.bisect_left(self.__numeros_tries, int(prefixe) * facteur)
+        fin = bisect.bisect_left(self.__numeros_tries, (int(prefixe) + 1) * facteur, lo=debut)
+        return debut, fin
+
+    def rechercher_prefixe(self, prefixe):
+        """
+        Permet de rechercher les contacts dont un des mots (nom, prénom, numéro de téléphone ou adresse e-mail) commence
+        par un préfixe.
+        :param prefixe: chaîne de caractères, début de mot à rechercher
+        :return: liste d'entiers, identifiants des contacts correspondants par ordre croissant
+        """
+        debut, fin = self.__intervalle_mots(prefixe)
+        contacts = set(self.__contacts_mots[debut:fin])
+        debut, fin = self.__intervalle_numeros(prefixe)
+        contacts.update(self.__contacts_numeros[debut:fin])
+        return sorted(contacts)
+
+    def completer(self, prefixe, nb_max=10):
+        """
+        Propose des mots de l'annuaire commençant par un préfixe (autocomplétion), par ordre alphabétique. Seuls les
+        mots proposés sont lus : les doublons d'un mot sont sautés par dichotomie, la complétion coûte
+        O(nb_max × log(nombre de mots)) quel que soit le nombre de contacts qui partagent un mot.
+        :param prefixe: chaîne de caractères, début de mot saisi
+        :param nb_max: entier, nombre maximum de propositions
+        :return: liste de chaînes de caractères, mots proposés
+        """
+        mots = []
+        position, fin = self.__intervalle_mots(prefixe)
+        while position < fin and len(mots) < nb_max:
+            mot = self.__chaine(self.__mots_tries[position])
+            mots.append(mot)
+            position = bisect.bisect_right(self.__mots_tries, mot, lo=position, hi=fin, key=self.__chaine)
+        position, fin = self.__intervalle_numeros(prefixe)
+        while position < fin and len(mots) < nb_max:
+            numero = self.__numeros_tries[position]
+            mots.append(self.__texte_numero(numero))
+            position = bisect.bisect_right(self.__numeros_tries, numero, lo=position, hi=fin)
+        return sorted(mots)
 
-            if requete in recherche:
-                contacts.append(id)
-        return contacts
+    # ----- Enregistrement -----
+
+    def enregistrer(self, chemin):
+        """
+        Enregistre l'annuaire, avec ses index, dans un fichier. Le fichier est écrit sous un nom temporaire puis
+        renommé : un fichier existant n'est remplacé qu'une fois le nouveau complet.
+        :param chemin: chaîne de caractères, chemin du fichier
+        :return: None
+        """
+        self.__ranger_en_attente()
+        nb_chaines = self.__nb_chaines_fichier + len(self.__chaines)
+        positions_chaines = array("Q", [0])
+        morceaux_chaines = []
+        for indice in range(nb_chaines):
+            octets = self.__chaine(indice).encode("utf-8")
+            morceaux_chaines.append(octets)
+            positions_chaines.append(positions_chaines[-1] + len(octets))
+
+        # Chaque trigramme compte exactement 3 caractères : ils sont simplement mis bout à bout
+        trigrammes = sorted(self.__index_trigrammes)
+        texte_trigrammes = "".join(trigrammes).encode("utf-8")
+        positions_listes = array("Q", [0])
+        for trigramme in trigrammes:
+            positions_listes.append(positions_listes[-1] + len(self.__index_trigrammes[trigramme]))
+
+        en_tete = struct.pack(FORMAT_EN_TETE, self.nombre_contacts(), nb_chaines, positions_chaines[-1],
+                              len(trigrammes), len(texte_trigrammes), positions_listes[-1],
+                              len(self.__contacts_courts), len(self.__mots_tries), len(self.__numeros_tries))
+        sections = [
+            self.__noms, self.__prenoms, self.__emails, self.__numeros,
+            positions_chaines, b"".join(morceaux_chaines),
+            texte_trigrammes, positions_listes,
+            b"".join(bytes(self.__index_trigrammes[trigramme]) for trigramme in trigrammes),
+            self.__contacts_courts,
+            self.__mots_tries, self.__contacts_mots, self.__numeros_tries, self.__contacts_numeros
+        ]
+
+        chemin_temporaire = chemin + ".tmp"
+        with open(chemin_temporaire, "wb") as fichier:
+            fichier.write(SIGNATURE_FICHIER + en_tete)
+            for section in sections:
+                octets = bytes(section)
+                # Chaque section commence sur un multiple de 8 octets
+                fichier.write(octets + b"\0" * (-len(octets) % 8))
+        os.replace(chemin_temporaire, chemin)
+
+    @classmethod
+    def charger(cls, chemin):
+        """
+        Charge un annuaire enregistré par enregistrer. Le fichier est projeté en mémoire : rien n'est copié ni décodé
+        au chargement, les données sont lues dans le fichier à la demande.
+        :param chemin: chaîne de caractères, chemin du fichier
+        :return: objet Annuaire
+        """
+        with open(chemin, "rb") as fichier:
+            projection = mmap.mmap(fichier.fileno(), 0, access=mmap.ACCESS_READ)
+        vue = memoryview(projection)
+        assert bytes(vue[:len(SIGNATURE_FICHIER)]) == SIGNATURE_FICHIER, "Fichier d'annuaire invalide"
+        position = len(SIGNATURE_FICHIER)
+        (nb_contacts, nb_chaines, taille_chaines, nb_trigrammes, taille_trigrammes, nb_entrees_trigrammes,
+         nb_contacts_courts, nb_mots, nb_numeros) = struct.unpack_from(FORMAT_EN_TETE, vue, position)
+        position += struct.calcsize(FORMAT_EN_TETE)
+
+        def section(nb_elements, type_elements):
+            nonlocal position
+            taille = nb_elements * struct.calcsize(type_elements)
+            morceau = vue[position:position + taille]
+            position += taille + (-taille % 8)
+            return morceau if type_elements == "B" else morceau.cast(type_elements)
+
+        annuaire = cls()
+        annuaire.__projection = projection
+        annuaire.__noms = section(nb_contacts, "i")
+        annuaire.__prenoms = section(nb_contacts, "i")
+        annuaire.__emails = section(nb_contacts, "i")
+        annuaire.__numeros = section(nb_contacts, "q")
+        annuaire.__positions_chaines = section(nb_chaines + 1, "Q")
+        annuaire.__octets_chaines = section(taille_chaines, "B")
+        annuaire.__nb_chaines_fichier = nb_chaines
+
+        texte_trigrammes = str(section(taille_trigrammes, "B"), "utf-8")
+        positions_listes = section(nb_trigrammes + 1, "Q")
+        listes = section(nb_entrees_trigrammes, "I")
+        for indice in range(nb_trigrammes):
+            annuaire.__index_trigrammes[texte_trigrammes[3 * indice:3 * indice + 3]] = \
+                listes[positions_listes[indice]:positions_listes[indice + 1]]
+
+        annuaire.__contacts_courts = section(nb_contacts_courts, "I")
+        annuaire.__mots_tries = section(nb_mots, "i")
+        annuaire.__contacts_mots = section(nb_mots, "I")
+        annuaire.__numeros_tries = section(nb_numeros, "q")
+        annuaire.__contacts_numeros = section(nb_numeros, "I")
+        return annuaire
 
 
 if __name__ == '__main__':
@@ -94,9 +487,61 @@ if __name__ == '__main__':
     assert annuaire.nombre_contacts() == 0
     annuaire.ajouter_contact("Dupond", "Martin", "0123456789", "martin.dupond@fournisseur.fr")
     annuaire.ajouter_contact("Dupond", "Sylvie", "0123456787", "sylvie.dupond@fournisseur.fr")
-    annuaire.ajouter_contact("Kenz", "Amine", "0987654321", "amine.kenz@autref.fr")
-    annuaire.ajouter_contact("Grassa", "Sarah", "0987654323", "sarah.grassa@autref.fr")
+    annuaire.ajouter_contacts([("Kenz", "Amine", "0987654321", "amine.kenz@autref.fr"),
+                               ("Grassa", "Sarah", 987654323, "sarah.grassa@autref.fr")])
     assert annuaire.nombre_contacts() == 4
     annuaire.afficher_tous_contacts()
     for id_contact in annuaire.rechercher_contacts("pond"):
         annuaire.afficher_contact(id_contact)
+
+    def verifier_recherches(annuaire):
+        assert annuaire.rechercher_contacts("pond") == [0, 1]
+        assert annuaire.rechercher_contacts("Sylvie Dupond") == [1]
+        assert annuaire.rechercher_contacts("autref.fr") == [2, 3]
+        assert annuaire.rechercher_contacts("87") == [1, 2, 3]
+        assert annuaire.rechercher_contacts("") == [0, 1, 2, 3]
+        assert annuaire.rechercher_contacts("0987654323") == [3]
+        assert annuaire.rechercher_contacts("Dupont") == []
+        assert annuaire.rechercher_prefixe("Dup") == [0, 1]
+        assert annuaire.rechercher_prefixe("09876") == [2, 3]
+        assert annuaire.rechercher_prefixe("pond") == []
+        assert annuaire.completer("S") == ["Sarah", "Sylvie"]
+        assert annuaire.completer("s", nb_max=1) == ["sarah.grassa@autref.fr"]
+        assert annuaire.completer("01234") == ["0123456787", "0123456789"]
+        assert annuaire.completer("x") == []
+
+    verifier_recherches(annuaire)
+
+    # Enregistrement puis rechargement
+    annuaire.enregistrer("annuaire_test.bin")
+    annuaire_charge = Annuaire.charger("annuaire_test.bin")
+    assert annuaire_charge.nombre_contacts() == 4
+    verifier_recherches(annuaire_charge)
+    annuaire_charge.ajouter_contact("Li", None, None, None)
+    annuaire_charge.ajouter_contact("Durand", "Hélène", None, "helene@fournisseur.fr")
+    assert annuaire_charge.rechercher_contacts("Li") == [4]
+    assert annuaire_charge.rechercher_contacts("fournisseur") == [0, 1, 5]
+    assert annuaire_charge.rechercher_prefixe("Du") == [0, 1, 5]
+    assert annuaire_charge.completer("H") == ["Hélène"]
+    annuaire_charge.enregistrer("annuaire_test.bin")
+    assert Annuaire.charger("annuaire_test.bin").rechercher_contacts("Hélène Durand") == [5]
+    os.remove("annuaire_test.bin")
+
+    # Numéros qui ne sont pas 10 chiffres : gardés tels quels, sans fausser les colonnes
+    annuaire = Annuaire()
+    annuaire.ajouter_contact("Martin", "Paul", "+33 6 12 34 56 78")
+    annuaire.ajouter_contact("Bernard", None, "+33612345678")
+    annuaire.ajouter_contact("Petit", None, "0612345678")
+    assert annuaire.rechercher_contacts("+33 6") == [0]
+    assert annuaire.rechercher_contacts("+336") == [1]
+    assert annuaire.rechercher_prefixe("+33") == [0, 1]
+    assert annuaire.completer("+") == ["+33 6 12 34 56 78", "+33612345678"]
+    annuaire.afficher_contact(1)
+    annuaire.enregistrer("annuaire_test.bin")
+    assert Annuaire.charger("annuaire_test.bin").rechercher_contacts("+336") == [1]
+    os.remove("annuaire_test.bin")
+
+    # Un mot partagé par de nombreux contacts n'est proposé qu'une fois
+    annuaire.ajouter_contacts([("Dupond", "Jean", None, None)] * 1000)
+    assert annuaire.completer("Du") == ["Dupond"]
+    assert annuaire.completer("", nb_max=3) == ["+33 6 12 34 56 78", "+33612345678", "Bernard"]
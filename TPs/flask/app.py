@@ -1,10 +1,16 @@
 import flask
 import datetime
+import os
+
+from etat_partage import EtatPartage
 
 app = flask.Flask(__name__)
 
-nb_visites = 0
-contenu_liste_interactive = []
+# Compteur de visites et liste interactive, partagés entre toutes les requêtes (voir etat_partage.py), dans un
+# fichier rangé à côté de celui-ci quel que soit le dossier depuis lequel l'application est lancée
+etat = EtatPartage(os.path.join(os.path.dirname(os.path.abspath(__file__)), "etat_partage.db"),
+                   taille_max_listes=1000)
+taille_page_liste = 20
 
 
 @app.route('/')
@@ -20,8 +26,7 @@ def heure():
 
 @app.route('/compteur/')
 def compteur():
-    global nb_visites
-    nb_visites += 1
+    nb_visites = etat.incrementer("visites")
     return f"Cette page a été visitée {nb_visites} fois."
 
 @app.route('/liste/')
@@ -34,16 +39,21 @@ def liste():
 
 @app.route('/liste_interactive/', methods=['GET', 'POST'])
 def liste_interactive():
-    global contenu_liste_interactive
     nouvel_element = flask.request.form.get('element')
 
     if nouvel_element is not None:
-        contenu_liste_interactive.append(nouvel_element)
+        etat.ajouter_element("liste_interactive", nouvel_element)
 
+    nb_pages = max(1, -(-etat.nombre_elements("liste_interactive") // taille_page_liste))
+    # Après un ajout, on affiche la dernière page, celle qui contient le nouvel élément
+    page_par_defaut = nb_pages if nouvel_element is not None else 1
+    page = min(max(flask.request.args.get('page', page_par_defaut, type=int), 1), nb_pages)
     return flask.Response(flask.render_template(
         "liste_interactive.html.jinja2",
         auteur_liste="Prénom Nom",
-        contenu_liste=contenu_liste_interactive
+        contenu_liste=etat.elements("liste_interactive", page, taille_page_liste),
+        page=page,
+        nb_pages=nb_pages
     ))
 
 
@@ -0,0 +1,168 @@
+import sqlite3
+import threading
+
+
+class EtatPartage:
+    """
+    Permet de partager des compteurs et des listes entre toutes les requêtes d'une application Flask, même quand le
+    serveur traite les requêtes dans plusieurs fils d'exécution ou plusieurs processus : les données sont stockées dans
+    une base de données SQLite et chaque modification est faite par une seule requête SQL (ou une seule transaction),
+    donc de façon atomique.
+    """
+
+    def __init__(self, chemin_fichier, taille_max_listes = 1000):
+        """
+        Ouvre (ou crée) la base de données de l'état partagé.
+        :param chemin_fichier: chaîne de caractères, chemin du fichier de base de données
+        :param taille_max_listes: entier, nombre maximum d'éléments gardés dans chaque liste (les plus anciens sont
+        supprimés au-delà)
+        """
+        self.chemin_fichier = chemin_fichier
+        self.taille_max_listes = taille_max_listes
+        # Une connexion par fil d'exécution
+        self.__connexions = threading.local()
+
+        connexion = self.__connexion()
+        connexion.execute("PRAGMA journal_mode = WAL")
+        connexion.execute('''CREATE TABLE IF NOT EXISTS compteurs (
+                                 nom    TEXT PRIMARY KEY,
+                                 valeur INTEGER NOT NULL
+                             )''')
+        connexion.execute('''CREATE TABLE IF NOT EXISTS elements_listes (
+                                 id      INTEGER PRIMARY KEY AUTOINCREMENT,
+                                 liste   TEXT NOT NULL,
+                                 element TEXT NOT NULL
+                             )''')
+        connexion.execute("CREATE INDEX IF NOT EXISTS index_elements_listes ON elements_listes (liste, id)")
+
+    def __connexion(self):
+        """
+        Renvoie la connexion à la base de données du fil d'exécution courant, en l'ouvrant si besoin.
+        :return: connexion SQLite
+        """
+        connexion = getattr(self.__connexions, "connexion", None)
+        if connexion is None:
+            # isolation_level None : chaque requête est validée immédiatement, sauf dans un BEGIN explicite
+            connexion = sqlite3.connect(self.chemin_fichier, isolation_level=None)
+            # Attendre jusqu'à 5 secondes plutôt qu'échouer si un autre processus est en train d'écrire
+            connexion.execute("PRAGMA busy_timeout = 5000")
+            # En mode WAL, NORMAL suffit à garantir la cohérence de la base et évite une synchronisation par écriture
+            connexion.execute("PRAGMA synchronous = NORMAL")
+            self.__connexions.connexion = connexion
+        return connexion
+
+    def incrementer(self, nom, pas = 1):
+        """
+        Augmente un compteur et renvoie sa nouvelle valeur. Un compteur qui n'existe pas encore vaut 0.
+        :param nom: chaîne de caractères, nom du compteur
+        :param pas: entier, valeur ajoutée au compteur
+        :return: entier, nouvelle valeur du compteur
+        """
+        return self.__connexion().execute('''INSERT INTO compteurs (nom, valeur) VALUES (?, ?)
+                                             ON CONFLICT (nom) DO UPDATE SET valeur = valeur + excluded.valeur
+                                             RETURNING valeur''', (nom, pas)).fetchone()[0]
+
+    def valeur(self, nom):
+        """
+        Renvoie la valeur d'un compteur.
+        :param nom: chaîne de caractères, nom du compteur
+        :return: entier, valeur du compteur (0 s'il n'existe pas)
+        """
+        ligne = self.__connexion().execute("SELECT valeur FROM compteurs WHERE nom = ?", (nom,)).fetchone()
+        return 0 if ligne is None else ligne[0]
+
+    def ajouter_element(self, liste, element):
+        """
+        Ajoute un élément à la fin d'une liste. Si la liste dépasse sa taille maximale, ses éléments les plus anciens
+        sont supprimés.
+        :param liste: chaîne de caractères, nom de la liste
+        :param element: chaîne de caractères, élément à ajouter
+        :return: None
+        """
+        connexion = self.__connexion()
+        # BEGIN IMMEDIATE prend le verrou d'écriture dès le début : l'ajout et la suppression se font d'un seul bloc
+        connexion.execute("BEGIN IMMEDIATE")
+        try:
+            connexion.execute("INSERT INTO elements_listes (liste, element) VALUES (?, ?)", (liste, element))
+            connexion.execute('''DELETE FROM elements_listes
+                                 WHERE liste = ? AND id <= (SELECT id FROM elements_listes
+                                                            WHERE liste = ?
+                                                            ORDER BY id DESC
+                                                            LIMIT 1 OFFSET ?)''',
+                              (liste, liste, self.taille_max_listes))
+            connexion.execute("COMMIT")
+        except BaseException:
+            connexion.execute("ROLLBACK")
+            raise
+
+    def nombre_elements(self, liste):
+        """
+        Renvoie le nombre d'éléments d'une liste.
+        :param liste: chaîne de caractères, nom de la liste
+        :return: entier, nombre d'éléments
+        """
+        return self.__connexion().execute("SELECT COUNT(*) FROM elements_listes WHERE liste = ?",
+                                          (liste,)).fetchone()[0]
+
+    def elements(self, liste, page = 1, taille_page = 20):
+        """
+        Renvoie une page des éléments d'une liste, du plus ancien au plus récent.
+        :param liste: chaîne de caractères, nom de la liste
+        :param page: entier, numéro de la page (à partir de 1)
+        :param taille_page: entier, nombre d'éléments par page
+        :return: liste de chaînes de caractères, éléments de la page
+        """
+        curseur = self.__connexion().execute('''SELECT element FROM elements_listes
+                                                WHERE liste = ?
+                                                ORDER BY id
+                                                LIMIT ? OFFSET ?''',
+                                             (liste, taille_page, (max(page, 1) - 1) * taille_page))
+        return [ligne[0] for ligne in curseur]
+
+
+def _incrementer_depuis_processus(arguments):
+    """
+    Incrémente un compteur plusieurs fois depuis un processus séparé (utilisé par les vérifications ci-dessous).
+    :param arguments: 2-uplet (chemin du fichier, nombre d'incréments)
+    :return: None
+    """
+    chemin_fichier, nb_increments = arguments
+    etat = EtatPartage(chemin_fichier)
+    for _ in range(nb_increments):
+        etat.incrementer("visites")
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    import os
+
+    chemin_test = "etat_partage_test.db"
+    for fichier in (chemin_test, chemin_test + "-wal", chemin_test + "-shm"):
+        if os.path.exists(fichier):
+            os.remove(fichier)
+
+    etat = EtatPartage(chemin_test, taille_max_listes=5)
+    assert etat.valeur("visites") == 0
+    assert etat.incrementer("visites") == 1
+    assert etat.incrementer("visites", 2) == 3
+
+    # Plusieurs fils d'exécution dans plusieurs processus : aucun incrément n'est perdu
+    with multiprocessing.Pool(4) as processus:
+        processus.map(_incrementer_depuis_processus, [(chemin_test, 250)] * 4)
+    fils = [threading.Thread(target=_incrementer_depuis_processus, args=((chemin_test, 250),)) for _ in range(4)]
+    for fil in fils:
+        fil.start()
+    for fil in fils:
+        fil.join()
+    assert etat.valeur("visites") == 3 + 2000
+
+    for numero in range(8):
+        etat.ajouter_element("courses", "Élément %d" % numero)
+    assert etat.nombre_elements("courses") == 5
+    assert etat.elements("courses", page=1, taille_page=2) == ["Élément 3", "Élément 4"]
+    assert etat.elements("courses", page=3, taille_page=2) == ["Élément 7"]
+    assert etat.elements("autre liste") == []
+
+    for fichier in (chemin_test, chemin_test + "-wal", chemin_test + "-shm"):
+        if os.path.exists(fichier):
+            os.remove(fichier)